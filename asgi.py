@@ -0,0 +1,467 @@
+"""
+ASGI entry point for the web UI.
+
+/ask and /ask/stream are served natively on the event loop, with Gemini calls
+going through the SDK's async client and conversation file I/O offloaded to a
+thread pool, so a single process can keep hundreds of generations in flight.
+Every other route is delegated to the Flask app through asgiref's WSGI adapter.
+
+Run with:
+    uvicorn asgi:app --host 127.0.0.1 --port 5000
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from http.cookies import SimpleCookie
+from typing import Dict, List, Optional, Tuple
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+
+import metrics
+import tracing
+from assistant_core import (
+    EXACT_TOKEN_COUNT,
+    AssistantError,
+    BackendUnavailableError,
+    ask_gemini_async,
+    ask_gemini_stream_async,
+    start_stream_async,
+)
+from conversation_manager import ConversationManager
+from conversation_summary import schedule_summary
+from gemini_client import GEMINI_WARMUP, warm_up_async
+from web_ui import (
+    ASK_FLIGHTS,
+    app as flask_app,
+    _ask_flight_key,
+    _conversation_history,
+    _exchange,
+    _idempotency_key,
+    _idempotent_answer,
+    _idempotent_conversation_id,
+    _remember_context_cache,
+    _replayed_stream,
+    _retry_after_headers,
+    _sse,
+)
+
+logger = logging.getLogger("asgi")
+logger.setLevel(logging.INFO)
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+_wsgi_app = WsgiToAsgi(flask_app)
+
+UNEXPECTED_ERROR = "An unexpected error occurred while processing your request."
+
+
+async def app(scope, receive, send):
+    """ASGI application: native async /ask routes, Flask for everything else."""
+    if scope["type"] == "lifespan":
+        await _handle_lifespan(receive, send)
+        return
+
+    if scope["type"] == "http" and scope["method"] == "POST":
+        if scope["path"] == "/ask":
+            await _instrumented("/ask", _handle_ask, scope, receive, send)
+            return
+        if scope["path"] == "/ask/stream":
+            await _instrumented("/ask/stream", _handle_ask_stream, scope, receive, send)
+            return
+
+    # asgiref keeps the request's sync executor in a context variable, and
+    # asyncio can hand that context to the next request on a keep-alive
+    # connection (CPython issue 140947), which then finds the finished
+    # executor and fails with "CurrentThreadExecutor already quit". A fresh
+    # context per delegated request avoids it without needing uvicorn's
+    # --reset-contextvars.
+    await asyncio.create_task(
+        _wsgi_app(scope, receive, send), context=contextvars.Context()
+    )
+
+
+async def _instrumented(route, handler, scope, receive, send):
+    """
+    Run a native route handler, counting, timing and tracing it like the
+    Flask routes (which are instrumented in web_ui). The sampling profiler is
+    left to the Flask routes: on the event loop it would mix in every other
+    request being served.
+    """
+    started = time.perf_counter()
+    status = "500"
+    trace = tracing.start(f"POST {route}", profile=False)
+
+    async def send_and_capture(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = str(message["status"])
+            if trace is not None:
+                message = dict(message, headers=list(message.get("headers", [])) + [
+                    (b"server-timing", trace.server_timing().encode("latin-1")),
+                ])
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_and_capture)
+    finally:
+        metrics.HTTP_REQUESTS.inc(route=route, method="POST", status=status)
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, route=route, method="POST"
+        )
+        tracing.finish(trace, status=int(status))
+
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if GEMINI_WARMUP:
+                await warm_up_async()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _handle_ask(scope, receive, send):
+    data = await _read_json(receive)
+    session = _load_session(scope)
+    prompt = data.get("prompt", "")
+    conversation_id = data.get("conversation_id") or session.get("conversation_id")
+    temperature = data.get("temperature", 0.7)
+    max_tokens = data.get("max_tokens", 2048)
+
+    logger.info("/ask received prompt length=%d, conversation_id=%s",
+                len(prompt), conversation_id)
+
+    timings = {}
+    try:
+        idempotency_key = _idempotency_key(_header(scope, b"idempotency-key"), data)
+        with tracing.span("history_load", timings):
+            conversation_id, conversation = await _load_or_create_conversation(
+                conversation_id, session, idempotency_key
+            )
+        if idempotency_key:
+            answer = _idempotent_answer(conversation, idempotency_key)
+            if answer is not None:
+                logger.info("/ask replaying stored answer for idempotency key")
+                await _send_json(send, 200, {
+                    "response": answer,
+                    "conversation_id": conversation_id,
+                    "cached": True
+                }, session)
+                return
+
+        async def generate():
+            summary, conversation_history = _conversation_history(conversation)
+            context_cache = conversation.get("context_cache") or {}
+            metadata = {"timings": timings}
+            answer = await ask_gemini_async(
+                prompt,
+                conversation_history=conversation_history,
+                temperature=temperature,
+                max_output_tokens=max_tokens,
+                history_summary=summary,
+                context_cache=context_cache,
+                metadata=metadata
+            )
+            with tracing.span("persistence", timings):
+                await asyncio.to_thread(
+                    _remember_context_cache, conversation_id, context_cache, metadata
+                )
+                schedule_summary(await ConversationManager.add_messages_async(
+                    conversation_id, _exchange(prompt, answer, idempotency_key)
+                ))
+            return answer, metadata.get("cached", False)
+
+        key = _ask_flight_key(
+            conversation_id, conversation, prompt, temperature, max_tokens, idempotency_key
+        )
+        (answer, cached), _ = await ASK_FLIGHTS.do_async(key, generate)
+
+        await _send_json(send, 200, {
+            "response": answer,
+            "conversation_id": conversation_id,
+            "cached": cached
+        }, session)
+    except BackendUnavailableError as e:
+        logger.warning("Gemini unavailable (%d): %s", e.status_code, e)
+        await _send_json(send, e.status_code, {"error": str(e)}, session, _retry_after_headers(e))
+    except AssistantError as e:
+        logger.warning("AssistantError: %s", e)
+        await _send_json(send, 400, {"error": str(e)}, session)
+    except Exception as e:
+        logger.exception("Unhandled exception in /ask: %s", e)
+        await _send_json(send, 500, {"error": UNEXPECTED_ERROR}, session)
+    finally:
+        metrics.observe_stages("/ask", timings)
+
+
+async def _handle_ask_stream(scope, receive, send):
+    data = await _read_json(receive)
+    session = _load_session(scope)
+    prompt = data.get("prompt", "")
+    conversation_id = data.get("conversation_id") or session.get("conversation_id")
+    temperature = data.get("temperature", 0.7)
+    max_tokens = data.get("max_tokens", 2048)
+
+    logger.info("/ask/stream received prompt length=%d, conversation_id=%s",
+                len(prompt), conversation_id)
+
+    timings = {}
+    try:
+        idempotency_key = _idempotency_key(_header(scope, b"idempotency-key"), data)
+        with tracing.span("history_load", timings):
+            conversation_id, conversation = await _load_or_create_conversation(
+                conversation_id, session, idempotency_key
+            )
+        answer = _idempotent_answer(conversation, idempotency_key) if idempotency_key else None
+        if answer is not None:
+            logger.info("/ask/stream replaying stored answer for idempotency key")
+            metrics.observe_stages("/ask/stream", timings)
+            await _send_replay(send, conversation_id, answer, session)
+            return
+        summary, conversation_history = _conversation_history(conversation)
+        context_cache = conversation.get("context_cache") or {}
+        metadata = {"timings": timings}
+        stream_args = dict(
+            conversation_history=conversation_history,
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+            history_summary=summary,
+            context_cache=context_cache,
+            metadata=metadata
+        )
+        if EXACT_TOKEN_COUNT:
+            # Preparing the request makes blocking count_tokens calls.
+            chunks = await asyncio.to_thread(ask_gemini_stream_async, prompt, **stream_args)
+        else:
+            chunks = ask_gemini_stream_async(prompt, **stream_args)
+        # Admission and the call up to the first token, so that rejections
+        # still get a status code and Retry-After rather than an SSE error.
+        chunks = await start_stream_async(chunks)
+    except BackendUnavailableError as e:
+        logger.warning("Gemini unavailable (%d): %s", e.status_code, e)
+        metrics.observe_stages("/ask/stream", timings)
+        await _send_json(send, e.status_code, {"error": str(e)}, session, _retry_after_headers(e))
+        return
+    except AssistantError as e:
+        logger.warning("AssistantError: %s", e)
+        metrics.observe_stages("/ask/stream", timings)
+        await _send_json(send, 400, {"error": str(e)}, session)
+        return
+    except Exception as e:
+        logger.exception("Unhandled exception in /ask/stream: %s", e)
+        metrics.observe_stages("/ask/stream", timings)
+        await _send_json(send, 500, {"error": UNEXPECTED_ERROR}, session)
+        return
+
+    headers = [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ]
+    headers.extend(_session_headers(session))
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+    parts: List[str] = []
+    completed = False
+
+    async def send_event(event, payload):
+        await send({
+            "type": "http.response.body",
+            "body": _sse(event, payload).encode("utf-8"),
+            "more_body": True,
+        })
+
+    async def produce():
+        nonlocal completed
+        try:
+            await send_event("start", {"conversation_id": conversation_id})
+            async for chunk in chunks:
+                parts.append(chunk)
+                await send_event("chunk", {"text": chunk})
+            completed = True
+            await send_event("done", {
+                "conversation_id": conversation_id,
+                "cached": metadata.get("cached", False)
+            })
+        except AssistantError as e:
+            logger.warning("AssistantError during stream: %s", e)
+            await send_event("error", {"error": str(e)})
+        except Exception as e:
+            logger.exception("Unhandled exception in /ask/stream: %s", e)
+            await send_event("error", {"error": UNEXPECTED_ERROR})
+
+    producer = asyncio.ensure_future(produce())
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive))
+    await asyncio.wait({producer, watcher}, return_when=asyncio.FIRST_COMPLETED)
+
+    disconnected = watcher.done()
+    if disconnected:
+        # Client went away; stop generating but keep whatever was produced.
+        logger.info("/ask/stream client disconnected after %d chunks", len(parts))
+        producer.cancel()
+    else:
+        watcher.cancel()
+    await asyncio.gather(producer, watcher, return_exceptions=True)
+
+    if completed or (disconnected and parts):
+        with tracing.span("persistence", timings):
+            await asyncio.to_thread(
+                _remember_context_cache, conversation_id, context_cache, metadata
+            )
+            # Only a complete answer is replayed to retries
+            key = idempotency_key if completed else None
+            try:
+                schedule_summary(await ConversationManager.add_messages_async(
+                    conversation_id, _exchange(prompt, "".join(parts), key)
+                ))
+            except Exception as e:
+                logger.exception("Failed to persist streamed exchange: %s", e)
+    metrics.observe_stages("/ask/stream", timings)
+
+    if not disconnected:
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def _send_replay(send, conversation_id: str, answer: str, session: Dict) -> None:
+    headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+    headers.extend(_session_headers(session))
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({
+        "type": "http.response.body",
+        "body": "".join(_replayed_stream(conversation_id, answer)).encode("utf-8"),
+        "more_body": False,
+    })
+
+
+async def _load_or_create_conversation(
+    conversation_id: Optional[str], session: Dict, idempotency_key: Optional[str] = None
+) -> Tuple[str, Dict]:
+    """Async counterpart of web_ui._load_or_create_conversation."""
+    if not conversation_id:
+        if idempotency_key:
+            conversation_id = await ConversationManager.create_conversation_async(
+                _idempotent_conversation_id(idempotency_key)
+            )
+        else:
+            conversation_id = await ConversationManager.create_conversation_async()
+        session["conversation_id"] = conversation_id
+
+    conversation = await ConversationManager.load_conversation_async(conversation_id)
+    if not conversation:
+        # Conversation was deleted, create a new one
+        conversation_id = await ConversationManager.create_conversation_async()
+        session["conversation_id"] = conversation_id
+        conversation = await ConversationManager.load_conversation_async(conversation_id)
+        if not conversation:
+            raise AssistantError("Failed to create or load conversation. Please try again.")
+    return conversation_id, conversation
+
+
+async def _read_json(receive) -> Dict:
+    """Read the full request body and decode it as a JSON object (or {})."""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            break
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def _wait_for_disconnect(receive) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _send_json(
+    send, status: int, payload: Dict, session: Dict, extra_headers: Optional[Dict] = None
+) -> None:
+    body = json.dumps(payload).encode("utf-8")
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode("ascii")),
+    ]
+    headers.extend(
+        (name.lower().encode("latin-1"), value.encode("latin-1"))
+        for name, value in (extra_headers or {}).items()
+    )
+    headers.extend(_session_headers(session))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    """Value of the first request header called name (lowercase), if any."""
+    for header, value in scope.get("headers", []):
+        if header == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _load_session(scope) -> Dict:
+    """
+    Decode the Flask session cookie so the native routes share the
+    conversation_id fallback with the WSGI routes. Invalid cookies are ignored.
+    """
+    raw_cookie = b""
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            raw_cookie = value
+            break
+    if not raw_cookie:
+        return _SessionDict()
+
+    cookie = SimpleCookie()
+    cookie.load(raw_cookie.decode("latin-1"))
+    morsel = cookie.get(flask_app.config["SESSION_COOKIE_NAME"])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if morsel is None or serializer is None:
+        return _SessionDict()
+
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return _SessionDict(serializer.loads(morsel.value, max_age=max_age))
+    except BadSignature:
+        return _SessionDict()
+
+
+def _session_headers(session: Dict) -> List[Tuple[bytes, bytes]]:
+    """Return a Set-Cookie header when the session was changed by the handler."""
+    if not getattr(session, "modified", False):
+        return []
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return []
+    value = serializer.dumps(dict(session))
+    cookie = (
+        f"{flask_app.config['SESSION_COOKIE_NAME']}={value}; "
+        f"Path={flask_app.config.get('SESSION_COOKIE_PATH') or '/'}; HttpOnly"
+    )
+    return [(b"set-cookie", cookie.encode("latin-1"))]
+
+
+class _SessionDict(dict):
+    """Plain dict that remembers whether a handler wrote to it."""
+
+    modified = False
+
+    def __setitem__(self, key, value):
+        self.modified = True
+        super().__setitem__(key, value)
@@ -1,14 +1,18 @@
 # assistant.py
-from google import genai
+import argparse
+import sys
+from typing import List, Optional
+
 from config import GEMINI_API_KEY
+from gemini_client import get_client
 
 def fetch_gemini_data(query):
     """
     Fetches a response from the Gemini API using the official SDK.
     """
     try:
-        # Initialize the client
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        # Reuse the process-wide pooled client
+        client = get_client(GEMINI_API_KEY)
         
         # Generate content
         response = client.models.generate_content(
@@ -20,10 +24,51 @@ def fetch_gemini_data(query):
     except Exception as e:
         return f"An error occurred: {e}"
 
-if __name__ == "__main__":
+def main(argv: Optional[List[str]] = None) -> None:
+    """Connectivity smoke test, or `batch` to run a JSONL file of prompts."""
+    parser = argparse.ArgumentParser(description="Gemini assistant CLI")
+    commands = parser.add_subparsers(dest="command")
+    batch_parser = commands.add_parser("batch", help="Run a JSONL file of prompts")
+    batch_parser.add_argument("input", help="JSONL prompts file, or - for stdin")
+    batch_parser.add_argument("-o", "--output", default="-", help="JSONL results file (default: stdout)")
+    batch_parser.add_argument("-c", "--concurrency", type=int, default=8)
+    batch_parser.add_argument("--rate", type=float, help="Max requests per second")
+    batch_parser.add_argument("--burst", type=float, help="Requests allowed in a burst (default: rate)")
+    batch_parser.add_argument("--order", default="completion", choices=["completion", "input"])
+    batch_parser.add_argument("--mode", default="thread", choices=["thread", "asyncio"])
+    batch_parser.add_argument("--resume", action="store_true", help="Skip ids already answered in the output file")
+    batch_parser.add_argument("--model", help="Default model for lines that don't set one")
+    batch_parser.add_argument("--temperature", type=float, help="Default temperature")
+    batch_parser.add_argument("--max-output-tokens", type=int, help="Default max output tokens")
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        # Imported here so the smoke test stays lightweight
+        from batch_runner import run_batch
+
+        if args.resume and args.output == "-":
+            parser.error("--resume needs --output")
+        defaults = {
+            key: value for key, value in (
+                ("model", args.model),
+                ("temperature", args.temperature),
+                ("max_output_tokens", args.max_output_tokens),
+            ) if value is not None
+        }
+        summary = run_batch(
+            args.input, args.output,
+            concurrency=args.concurrency, rate=args.rate, burst=args.burst,
+            order=args.order, mode=args.mode, resume=args.resume, defaults=defaults,
+        )
+        print(summary.format(), file=sys.stderr)
+        return
+
     # Simple test call
     user_query = "Hello, world! Tell me a fun fact about space."
     print(f"Query: {user_query}")
     result = fetch_gemini_data(user_query)
     print("Response:")
     print(result)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,28 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple,
+)
 
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types as genai_types
 
+import call_policy
+import metrics
+import tracing
+from gemini_client import ClientProxy
+from prompt_classifier import Classification, PromptClassifier
+from rate_limiter import ADMISSION, AdmissionRejected
+
 # Load environment variables from .env
 load_dotenv()
 
@@ -22,12 +38,50 @@ logger.addHandler(_console)
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 EXTRA_ASSISTANT_CONTEXT = (os.getenv("ASSISTANT_EXTRA_CONTEXT") or "").strip()
 
+# Opt-in cache for deterministic (temperature 0) generations.
+RESPONSE_CACHE_ENABLED = os.getenv("ASSISTANT_RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_DIR = os.getenv("ASSISTANT_RESPONSE_CACHE_DIR")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("ASSISTANT_RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL = int(os.getenv("ASSISTANT_RESPONSE_CACHE_TTL", "3600"))
+# Time-sensitive prompts are not cached unless this is set to a positive TTL.
+RESPONSE_CACHE_TIME_SENSITIVE_TTL = int(os.getenv("ASSISTANT_RESPONSE_CACHE_TIME_SENSITIVE_TTL", "0"))
+
+# Input-token budget for the whole request (preamble + history + prompt).
+# ASSISTANT_MODEL_TOKEN_BUDGETS overrides it per model: "gemini-2.5-pro=64000,...".
+HISTORY_TOKEN_BUDGET = int(os.getenv("ASSISTANT_HISTORY_TOKEN_BUDGET", "32000"))
+MODEL_TOKEN_BUDGETS: Dict[str, int] = {
+    name.strip(): int(budget)
+    for name, _, budget in (
+        item.partition("=")
+        for item in (os.getenv("ASSISTANT_MODEL_TOKEN_BUDGETS") or "").split(",")
+        if item.strip()
+    )
+}
+# Count history tokens with the API's count_tokens call instead of estimating.
+EXACT_TOKEN_COUNT = os.getenv("ASSISTANT_EXACT_TOKEN_COUNT", "false").lower() == "true"
+# Rough per-turn cost of role/turn markers on top of the text itself.
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Opt-in server-side caching of a conversation's stable prefix (system
+# preamble plus older history) through the Gemini caching API.
+CONTEXT_CACHE_ENABLED = os.getenv("ASSISTANT_CONTEXT_CACHE", "false").lower() == "true"
+CONTEXT_CACHE_TTL = int(os.getenv("ASSISTANT_CONTEXT_CACHE_TTL", "3600"))
+# Prefixes smaller than this are not worth caching (the API rejects tiny ones).
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("ASSISTANT_CONTEXT_CACHE_MIN_TOKENS", "2048"))
+# The cached history prefix grows in steps of this many messages, so a long
+# chat recreates its cache every few turns rather than on every turn.
+CONTEXT_CACHE_STEP = int(os.getenv("ASSISTANT_CONTEXT_CACHE_STEP", "10"))
+# Recreate caches this many seconds before they expire.
+CONTEXT_CACHE_REFRESH_MARGIN = 60
+# After a failed cache creation, don't retry the same prefix for this long.
+CONTEXT_CACHE_RETRY_AFTER = 600
+
 if not GEMINI_API_KEY:
     logger.error("GEMINI_API_KEY is not set. Check your .env file.")
     raise RuntimeError("GEMINI_API_KEY environment variable is required.")
 
-# Create a single shared client.
-client = genai.Client(api_key=GEMINI_API_KEY)
+# Shared, pooled client from the process-wide registry (re-resolved after fork).
+client = ClientProxy(GEMINI_API_KEY)
 
 # Choose a default model – adjust if you want Pro instead of Flash.
 DEFAULT_MODEL = "gemini-2.5-flash"
@@ -40,6 +94,13 @@ BASE_SYSTEM_PROMPT_TEMPLATE = (
     "and the current time is {current_time} when answering time-sensitive questions."
 )
 
+# Clock-free preamble used inside cached context; the date and time are then
+# sent with every prompt instead.
+CACHED_SYSTEM_PROMPT = BASE_SYSTEM_PROMPT_TEMPLATE.format(
+    current_date="the date stated in the user's latest message",
+    current_time="the time stated there",
+)
+
 RESEARCH_KEYWORDS = {
     "research",
     "study",
@@ -86,6 +147,28 @@ TIME_SENSITIVE_KEYWORDS = {
     "breaking",
 }
 
+SUMMARY_MAX_WORDS = 250
+
+SUMMARY_PROMPT_TEMPLATE = (
+    "You maintain a running summary of a conversation between a user and an AI "
+    "assistant. Update the current summary with the new messages below. Keep "
+    "facts, decisions, open questions, names and user preferences; drop "
+    "pleasantries. Reply with the updated summary only, in at most {max_words} words."
+    "\n\nCurrent summary:\n{summary}\n\nNew messages:\n{messages}"
+)
+
+# Extra classifier categories/weights (JSON, see prompt_classifier)
+PROMPT_CLASSIFIER_CONFIG = os.getenv("ASSISTANT_CLASSIFIER_CONFIG")
+
+PROMPT_CLASSIFIER = PromptClassifier.from_config(
+    {
+        "sensitive": SENSITIVE_KEYWORDS,
+        "research": RESEARCH_KEYWORDS,
+        "time_sensitive": TIME_SENSITIVE_KEYWORDS,
+    },
+    PROMPT_CLASSIFIER_CONFIG,
+)
+
 RELAXED_SAFETY_SETTINGS = [
     genai_types.SafetySetting(
         category=genai_types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
@@ -93,19 +176,384 @@ RELAXED_SAFETY_SETTINGS = [
     ),
 ]
 
+# Export every Gemini attempt (latency, outcome, error class) to /metrics
+call_policy.add_attempt_listener(metrics.record_attempt)
+
 
 class AssistantError(Exception):
     """Custom exception for assistant-related errors."""
     pass
 
 
+class BackendUnavailableError(AssistantError):
+    """Gemini kept failing with transient errors (throttling, 5xx, timeouts)."""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitedError(BackendUnavailableError):
+    """The call was turned away by client-side admission control."""
+
+    status_code = 429
+
+
+class ResponseCache:
+    """
+    LRU cache of generated answers keyed by a request hash, with an optional
+    on-disk tier (one JSON file per entry) shared between processes.
+
+    Entries carry their own expiry; expired entries are dropped on read.
+    """
+
+    def __init__(self, max_entries: int = 1024, directory: Optional[str] = None):
+        self.max_entries = max_entries
+        self.directory = Path(directory) if directory else None
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, text: str, ttl: float) -> None:
+        if ttl <= 0 or not text:
+            return
+        entry = (time.time() + ttl, text)
+        with self._lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+        if self.directory and self.directory.exists():
+            for path in self.directory.glob("*/*.json"):
+                path.unlink(missing_ok=True)
+
+    def _remember(self, key: str, entry: Tuple[float, str]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _read_disk(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        if not self.directory:
+            return None
+        path = self._disk_path(key)
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            expires_at, text = float(data["expires_at"]), data["text"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unreadable response cache entry %s: %s", path, e)
+            return None
+        if expires_at <= now:
+            path.unlink(missing_ok=True)
+            return None
+        return expires_at, text
+
+    def _write_disk(self, key: str, entry: Tuple[float, str]) -> None:
+        if not self.directory:
+            return
+        path = self._disk_path(key)
+        # Unique per thread as well: threads of one process may write the same key
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tmp_path.open("w", encoding="utf-8") as f:
+                json.dump({"expires_at": entry[0], "text": entry[1]}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Failed to write response cache entry %s: %s", path, e)
+            tmp_path.unlink(missing_ok=True)
+
+
+response_cache: Optional[ResponseCache] = (
+    ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_DIR)
+    if RESPONSE_CACHE_ENABLED else None
+)
+
+
+class _PreparedRequest(NamedTuple):
+    contents: List[genai_types.Content]
+    config: genai_types.GenerateContentConfig
+    cache_key: Optional[str]
+    cache_ttl: float
+    history_stats: Dict
+    # Pieces used to rebuild the request around a server-side context cache
+    stable_system: str
+    dynamic_context: str
+    history_turns: List[Tuple[str, str]]
+    # Index of history_turns[0] in the whole history passed in; the window
+    # moves forward once a conversation outgrows the token budget
+    history_start: int
+    prompt: str
+    # Estimated input tokens, charged against the tokens-per-minute limit
+    input_tokens: int
+
+
+ACKNOWLEDGEMENT_TEXT = "Understood. I'll follow these guidelines."
+
+
+class _Preamble(NamedTuple):
+    lines: List[str]
+    system_content: genai_types.Content
+    tokens: int
+    # Pieces used when the stable part is served from a context cache
+    stable_system: str
+    dynamic_context: str
+
+
+class PromptBuilder:
+    """
+    Assembles the preamble and history turns of Gemini requests.
+
+    The preamble for each combination of prompt flags (and history summary)
+    is rendered at most once per minute, since the clock it shows only has
+    minute resolution; the acknowledgement turn is one shared Content; and
+    history messages are converted to Content objects once, so each turn of
+    a conversation only converts its new messages. Converted messages are
+    kept least recently used first, up to max_history_entries messages and
+    max_history_bytes of text in all.
+    """
+
+    def __init__(
+        self,
+        max_history_entries: int = 4096,
+        max_variants: int = 1024,
+        max_history_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.max_history_entries = max_history_entries
+        self.max_history_bytes = max_history_bytes
+        self.max_variants = max_variants
+        self.ack_content = genai_types.Content(
+            role="model", parts=[genai_types.Part(text=ACKNOWLEDGEMENT_TEXT)]
+        )
+        self._lock = threading.Lock()
+        self._clock_key = None
+        self._clock = ("", "")
+        self._variants: Dict[Tuple, _Preamble] = {}
+        # (role, text) -> (Content, UTF-8 size of text)
+        self._history: "OrderedDict[Tuple[str, str], Tuple[genai_types.Content, int]]" = (
+            OrderedDict()
+        )
+        self._history_bytes = 0
+
+    def clock(self) -> Tuple[str, str]:
+        """The (date, time) strings for the current minute."""
+        # Keyed on the standing instructions as well, so changing them takes
+        # effect immediately.
+        key = (int(time.time() // 60), EXTRA_ASSISTANT_CONTEXT)
+        with self._lock:
+            if key != self._clock_key:
+                self._clock = _current_datetime_strings()
+                self._clock_key = key
+                self._variants.clear()
+            return self._clock
+
+    def preamble(
+        self, flags: Tuple[bool, bool, bool], summary: Optional[str] = None
+    ) -> _Preamble:
+        """Return the rendered preamble for the prompt flags and summary."""
+        current_date, current_time = self.clock()
+        key = (flags, summary or "")
+        with self._lock:
+            cached = self._variants.get(key)
+            clock_key = self._clock_key
+        if cached is not None:
+            return cached
+
+        flag_lines = _flag_instructions(*flags, current_date, current_time)
+        # Flag lines depend on the prompt and clock; the ones below are stable
+        # for a conversation and may be served from a context cache.
+        stable_lines = []
+        if EXTRA_ASSISTANT_CONTEXT:
+            stable_lines.append(EXTRA_ASSISTANT_CONTEXT)
+        if summary:
+            stable_lines.append("Summary of the earlier part of this conversation:\n" + summary)
+
+        system_instruction = BASE_SYSTEM_PROMPT_TEMPLATE.format(
+            current_date=current_date,
+            current_time=current_time,
+        )
+        system_text = system_instruction
+        if flag_lines or stable_lines:
+            system_text += "\n\n" + "\n".join(flag_lines + stable_lines)
+        preamble = _Preamble(
+            lines=[system_instruction] + flag_lines + stable_lines,
+            system_content=genai_types.Content(
+                role="user", parts=[genai_types.Part(text=system_text)]
+            ),
+            tokens=estimate_tokens(system_text),
+            stable_system="\n\n".join([CACHED_SYSTEM_PROMPT] + stable_lines),
+            dynamic_context="\n".join(
+                [f"Context: The current date is {current_date} and the current time is {current_time}."]
+                + flag_lines
+            ),
+        )
+
+        with self._lock:
+            if self._clock_key == clock_key:
+                if len(self._variants) >= self.max_variants:
+                    self._variants.clear()
+                self._variants[key] = preamble
+        return preamble
+
+    def history_content(self, role: str, text: str) -> genai_types.Content:
+        """Return the (shared) Content for one history turn."""
+        key = (role, text)
+        with self._lock:
+            entry = self._history.get(key)
+            if entry is not None:
+                self._history.move_to_end(key)
+                return entry[0]
+        content = genai_types.Content(role=role, parts=[genai_types.Part(text=text)])
+        size = len(text.encode("utf-8"))
+        if size > self.max_history_bytes:
+            return content
+        with self._lock:
+            previous = self._history.pop(key, None)
+            if previous is not None:
+                self._history_bytes -= previous[1]
+            self._history[key] = (content, size)
+            self._history_bytes += size
+            while (
+                len(self._history) > self.max_history_entries
+                or self._history_bytes > self.max_history_bytes
+            ):
+                _, (_, evicted) = self._history.popitem(last=False)
+                self._history_bytes -= evicted
+        return content
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clock_key = None
+            self._variants.clear()
+            self._history.clear()
+            self._history_bytes = 0
+
+
+PROMPT_BUILDER = PromptBuilder()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap local token estimate: about four ASCII characters per token, and one
+    token per non-ASCII character (which keeps CJK text from being undercounted).
+    """
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def token_budget_for(model: str) -> int:
+    """Return the input-token budget configured for the given model."""
+    return MODEL_TOKEN_BUDGETS.get(model, HISTORY_TOKEN_BUDGET)
+
+
+# Least recently used first; shared by request threads
+_exact_token_counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+_exact_token_counts_lock = threading.Lock()
+_EXACT_TOKEN_COUNTS_MAX = 4096
+
+
+def _count_tokens(text: str, model: str) -> int:
+    """Token count for one turn, exact (memoized API call) or estimated."""
+    if not EXACT_TOKEN_COUNT:
+        return estimate_tokens(text) + MESSAGE_TOKEN_OVERHEAD
+
+    key = (model, hashlib.sha256(text.encode("utf-8")).hexdigest())
+    with _exact_token_counts_lock:
+        count = _exact_token_counts.get(key)
+        if count is not None:
+            _exact_token_counts.move_to_end(key)
+    if count is None:
+        # Counted outside the lock; two threads may count the same text once each.
+        try:
+            result = client.models.count_tokens(model=model, contents=text)
+            count = int(result.total_tokens)
+        except Exception as e:
+            logger.warning("count_tokens failed, falling back to estimate: %s", e)
+            return estimate_tokens(text) + MESSAGE_TOKEN_OVERHEAD
+        with _exact_token_counts_lock:
+            _exact_token_counts[key] = count
+            while len(_exact_token_counts) > _EXACT_TOKEN_COUNTS_MAX:
+                _exact_token_counts.popitem(last=False)
+    return count + MESSAGE_TOKEN_OVERHEAD
+
+
+def select_history(
+    turns: List[Tuple[str, str]],
+    token_budget: int,
+    model: str = DEFAULT_MODEL,
+) -> Tuple[List[Tuple[str, str]], Dict]:
+    """
+    Keep the newest (role, text) turns that fit in token_budget.
+
+    Turns are taken newest-first and selection stops at the first turn that
+    does not fit, so the window is always a contiguous suffix of the history.
+    A leading model turn is dropped so the window starts with the user.
+    Returns the window and stats: messages, tokens, dropped.
+    """
+    selected = []
+    used = 0
+    for role, text in reversed(turns):
+        cost = _count_tokens(text, model)
+        if used + cost > token_budget:
+            break
+        selected.append((role, text, cost))
+        used += cost
+
+    selected.reverse()
+    while selected and selected[0][0] == "model":
+        used -= selected.pop(0)[2]
+
+    window = [(role, text) for role, text, _ in selected]
+    return window, {
+        "messages": len(window),
+        "tokens": used,
+        "dropped": len(turns) - len(window),
+    }
+
+
 def ask_gemini(
     prompt: str, 
     conversation_history: Optional[List[Dict]] = None, 
     *, 
     model: str = DEFAULT_MODEL,
     temperature: float = 0.7,
-    max_output_tokens: int = 2048
+    max_output_tokens: int = 2048,
+    history_summary: Optional[str] = None,
+    context_cache: Optional[Dict] = None,
+    metadata: Optional[Dict] = None
 ) -> str:
     """
     Send a prompt to Gemini with optional conversation history and return the response text.
@@ -116,9 +564,472 @@ def ask_gemini(
         model: The Gemini model to use
         temperature: Controls randomness (0.0-2.0). Lower = more focused, Higher = more creative. Default: 0.7
         max_output_tokens: Maximum tokens in response (256-8192). Default: 2048
+        history_summary: Summary of older turns that are no longer passed in
+            conversation_history; it is added to the system context
+        context_cache: The conversation's context cache record (as returned
+            in metadata["context_cache"] by the previous call), or {} if it
+            has none yet. Passing it opts the call into server-side caching
+            of the stable prefix when ASSISTANT_CONTEXT_CACHE is enabled.
+        metadata: Optional dict filled in with details about the call
+            ("cached": True when the answer came from the response cache,
+            "history": messages/tokens/dropped for the history window sent,
+            "context_cache": the record to store for the conversation,
+            "timings": seconds spent in prompt_assembly and gemini_call,
+            "usage": token counts from the response's usage metadata)
+
+    Raises AssistantError on failure.
+    """
+    call_info = metadata if metadata is not None else {}
+    timings = call_info.setdefault("timings", {})
+    with tracing.span("prompt_assembly", timings):
+        request = _prepare_request(
+            prompt, conversation_history, temperature, max_output_tokens, model,
+            history_summary
+        )
+    cached = _cache_lookup(request, metadata)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    contents, config, cache_record = _resolve_context_cache(request, model, context_cache)
+    try:
+        with ADMISSION.admit(model, request.input_tokens):
+            try:
+                args = _generate_args(request, model, contents, config)
+                response = call_policy.call(
+                    _charge_fallbacks(
+                        lambda m: client.models.generate_content(**args(m)),
+                        model, request.input_tokens,
+                    ),
+                    model, metadata=call_info,
+                )
+            except Exception as e:
+                if cache_record is None or call_policy.is_retryable(e):
+                    raise
+                logger.warning("Request with cached context failed, retrying without it: %s", e)
+                cache_record = None
+                args = _generate_args(request, model, request.contents, request.config)
+                response = call_policy.call(
+                    _charge_fallbacks(
+                        lambda m: client.models.generate_content(**args(m)),
+                        model, request.input_tokens,
+                    ),
+                    model, metadata=call_info,
+                )
+
+        text = _extract_text(response)
+        if not text:
+            logger.warning("Gemini returned no text field.")
+            raise AssistantError("The assistant didn't return any text. Try again.")
+
+        logger.info("ask_gemini succeeded")
+        _record_usage(call_info, model, response)
+        if call_info.get("model", model) == model:
+            _cache_store(request, text)
+        _record_context_cache(metadata, context_cache, cache_record)
+        return text
+
+    except AssistantError:
+        raise
+
+    except AdmissionRejected as e:
+        raise _backend_error(e) from e
+
+    except Exception as e:
+        logger.exception("Unexpected error calling Gemini API: %s", e)
+        raise _backend_error(e) from e
+
+    finally:
+        tracing.record("gemini_call", time.perf_counter() - started, timings)
+
+
+def ask_gemini_stream(
+    prompt: str,
+    conversation_history: Optional[List[Dict]] = None,
+    *,
+    model: str = DEFAULT_MODEL,
+    temperature: float = 0.7,
+    max_output_tokens: int = 2048,
+    history_summary: Optional[str] = None,
+    context_cache: Optional[Dict] = None,
+    metadata: Optional[Dict] = None
+) -> Iterator[str]:
+    """
+    Streaming variant of ask_gemini that yields response text chunks as they arrive.
+
+    The stream is opened eagerly, up to its first chunk: an empty prompt, a
+    rejected admission (RateLimitedError/BackendUnavailableError) or a failure
+    before the first token raises AssistantError from this call, before the
+    caller has started a response. Errors later in the stream are raised as
+    AssistantError from the returned iterator.
+    """
+    call_info = metadata if metadata is not None else {}
+    timings = call_info.setdefault("timings", {})
+    with tracing.span("prompt_assembly", timings):
+        request = _prepare_request(
+            prompt, conversation_history, temperature, max_output_tokens, model,
+            history_summary
+        )
+
+    def _stream() -> Iterator[str]:
+        cached = _cache_lookup(request, metadata)
+        if cached is not None:
+            yield cached
+            return
+
+        started = time.perf_counter()
+        contents, config, cache_record = _resolve_context_cache(request, model, context_cache)
+        parts = []
+        chunk = None
+        try:
+            with ADMISSION.admit(model, request.input_tokens):
+                try:
+                    args = _generate_args(request, model, contents, config)
+                    for chunk in call_policy.open_stream(
+                        _charge_fallbacks(
+                            lambda m: client.models.generate_content_stream(**args(m)),
+                            model, request.input_tokens,
+                        ),
+                        model, metadata=call_info,
+                    ):
+                        text = _extract_text(chunk)
+                        if text:
+                            parts.append(text)
+                            yield text
+                except Exception as e:
+                    if cache_record is None or parts or call_policy.is_retryable(e):
+                        raise
+                    logger.warning("Stream with cached context failed, retrying without it: %s", e)
+                    cache_record = None
+                    args = _generate_args(request, model, request.contents, request.config)
+                    for chunk in call_policy.open_stream(
+                        _charge_fallbacks(
+                            lambda m: client.models.generate_content_stream(**args(m)),
+                            model, request.input_tokens,
+                        ),
+                        model, metadata=call_info,
+                    ):
+                        text = _extract_text(chunk)
+                        if text:
+                            parts.append(text)
+                            yield text
+        except AdmissionRejected as e:
+            raise _backend_error(e) from e
+        except Exception as e:
+            logger.exception("Unexpected error streaming from Gemini API: %s", e)
+            raise _backend_error(e) from e
+        finally:
+            tracing.record("gemini_call", time.perf_counter() - started, timings)
+
+        if not parts:
+            logger.warning("Gemini stream returned no text.")
+            raise AssistantError("The assistant didn't return any text. Try again.")
+
+        logger.info("ask_gemini_stream succeeded")
+        # The final chunk carries the usage metadata for the whole stream
+        _record_usage(call_info, model, chunk)
+        if call_info.get("model", model) == model:
+            _cache_store(request, "".join(parts))
+        _record_context_cache(metadata, context_cache, cache_record)
+
+    return start_stream(_stream())
+
+
+def start_stream(stream: Iterator[str]) -> Iterator[str]:
+    """
+    Run a chunk stream up to its first chunk now and return an iterator over
+    all of its chunks. Admission and the request up to the first token then
+    happen here, so their errors reach the caller before it has committed
+    to a streamed 200 response.
+    """
+    try:
+        first = next(stream)
+    except StopIteration:
+        return iter(())
+
+    def chunks() -> Iterator[str]:
+        yield first
+        yield from stream
+
+    return chunks()
+
+
+async def start_stream_async(stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Asyncio variant of start_stream, for ask_gemini_stream_async iterators."""
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def chunks() -> AsyncIterator[str]:
+        if first is None:
+            return
+        yield first
+        async for chunk in stream:
+            yield chunk
+
+    return chunks()
+
+
+async def ask_gemini_async(
+    prompt: str,
+    conversation_history: Optional[List[Dict]] = None,
+    *,
+    model: str = DEFAULT_MODEL,
+    temperature: float = 0.7,
+    max_output_tokens: int = 2048,
+    history_summary: Optional[str] = None,
+    context_cache: Optional[Dict] = None,
+    metadata: Optional[Dict] = None
+) -> str:
+    """
+    Asyncio variant of ask_gemini built on the SDK's async client (client.aio),
+    so the event loop can keep many generations in flight at once.
 
     Raises AssistantError on failure.
     """
+    call_info = metadata if metadata is not None else {}
+    timings = call_info.setdefault("timings", {})
+    with tracing.span("prompt_assembly", timings):
+        if EXACT_TOKEN_COUNT:
+            # Exact counting makes blocking count_tokens calls.
+            request = await asyncio.to_thread(
+                _prepare_request, prompt, conversation_history, temperature, max_output_tokens,
+                model, history_summary
+            )
+        else:
+            request = _prepare_request(
+                prompt, conversation_history, temperature, max_output_tokens, model,
+                history_summary
+            )
+    cached = await _cache_lookup_async(request, metadata)
+    if cached is not None:
+        return cached
+
+    started = time.perf_counter()
+    contents, config, cache_record = await _resolve_context_cache_async(
+        request, model, context_cache
+    )
+    try:
+        async with ADMISSION.admit_async(model, request.input_tokens):
+            try:
+                args = _generate_args(request, model, contents, config)
+                response = await call_policy.call_async(
+                    _charge_fallbacks_async(
+                        lambda m: client.aio.models.generate_content(**args(m)),
+                        model, request.input_tokens,
+                    ),
+                    model, metadata=call_info,
+                )
+            except Exception as e:
+                if cache_record is None or call_policy.is_retryable(e):
+                    raise
+                logger.warning("Request with cached context failed, retrying without it: %s", e)
+                cache_record = None
+                args = _generate_args(request, model, request.contents, request.config)
+                response = await call_policy.call_async(
+                    _charge_fallbacks_async(
+                        lambda m: client.aio.models.generate_content(**args(m)),
+                        model, request.input_tokens,
+                    ),
+                    model, metadata=call_info,
+                )
+
+        text = _extract_text(response)
+        if not text:
+            logger.warning("Gemini returned no text field.")
+            raise AssistantError("The assistant didn't return any text. Try again.")
+
+        logger.info("ask_gemini_async succeeded")
+        _record_usage(call_info, model, response)
+        if call_info.get("model", model) == model:
+            await _cache_store_async(request, text)
+        _record_context_cache(metadata, context_cache, cache_record)
+        return text
+
+    except AssistantError:
+        raise
+
+    except AdmissionRejected as e:
+        raise _backend_error(e) from e
+
+    except Exception as e:
+        logger.exception("Unexpected error calling Gemini API: %s", e)
+        raise _backend_error(e) from e
+
+    finally:
+        tracing.record("gemini_call", time.perf_counter() - started, timings)
+
+
+def ask_gemini_stream_async(
+    prompt: str,
+    conversation_history: Optional[List[Dict]] = None,
+    *,
+    model: str = DEFAULT_MODEL,
+    temperature: float = 0.7,
+    max_output_tokens: int = 2048,
+    history_summary: Optional[str] = None,
+    context_cache: Optional[Dict] = None,
+    metadata: Optional[Dict] = None
+) -> AsyncIterator[str]:
+    """
+    Asyncio variant of ask_gemini_stream. The request is validated eagerly; the
+    returned async iterator yields text chunks and raises AssistantError on failure.
+    Unlike ask_gemini_stream it can't open the stream before returning; pass
+    it to start_stream_async() for that.
+    With ASSISTANT_EXACT_TOKEN_COUNT enabled the eager step makes blocking
+    count_tokens calls, so callers on an event loop should run it in a thread.
+    """
+    call_info = metadata if metadata is not None else {}
+    timings = call_info.setdefault("timings", {})
+    with tracing.span("prompt_assembly", timings):
+        request = _prepare_request(
+            prompt, conversation_history, temperature, max_output_tokens, model,
+            history_summary
+        )
+
+    async def _stream() -> AsyncIterator[str]:
+        cached = await _cache_lookup_async(request, metadata)
+        if cached is not None:
+            yield cached
+            return
+
+        started = time.perf_counter()
+        contents, config, cache_record = await _resolve_context_cache_async(
+            request, model, context_cache
+        )
+        parts = []
+        chunk = None
+        try:
+            async with ADMISSION.admit_async(model, request.input_tokens):
+                try:
+                    args = _generate_args(request, model, contents, config)
+                    stream = await call_policy.open_stream_async(
+                        _charge_fallbacks_async(
+                            lambda m: client.aio.models.generate_content_stream(**args(m)),
+                            model, request.input_tokens,
+                        ),
+                        model, metadata=call_info,
+                    )
+                    async for chunk in stream:
+                        text = _extract_text(chunk)
+                        if text:
+                            parts.append(text)
+                            yield text
+                except Exception as e:
+                    if cache_record is None or parts or call_policy.is_retryable(e):
+                        raise
+                    logger.warning("Stream with cached context failed, retrying without it: %s", e)
+                    cache_record = None
+                    args = _generate_args(request, model, request.contents, request.config)
+                    stream = await call_policy.open_stream_async(
+                        _charge_fallbacks_async(
+                            lambda m: client.aio.models.generate_content_stream(**args(m)),
+                            model, request.input_tokens,
+                        ),
+                        model, metadata=call_info,
+                    )
+                    async for chunk in stream:
+                        text = _extract_text(chunk)
+                        if text:
+                            parts.append(text)
+                            yield text
+        except AdmissionRejected as e:
+            raise _backend_error(e) from e
+        except Exception as e:
+            logger.exception("Unexpected error streaming from Gemini API: %s", e)
+            raise _backend_error(e) from e
+        finally:
+            tracing.record("gemini_call", time.perf_counter() - started, timings)
+
+        if not parts:
+            logger.warning("Gemini stream returned no text.")
+            raise AssistantError("The assistant didn't return any text. Try again.")
+
+        logger.info("ask_gemini_stream_async succeeded")
+        _record_usage(call_info, model, chunk)
+        if call_info.get("model", model) == model:
+            await _cache_store_async(request, "".join(parts))
+        _record_context_cache(metadata, context_cache, cache_record)
+
+    return _stream()
+
+
+def _generate_args(
+    request: _PreparedRequest,
+    model: str,
+    contents: List[genai_types.Content],
+    config: genai_types.GenerateContentConfig,
+):
+    """
+    Return attempt_model -> generate_content arguments for call_policy. A
+    context cache belongs to the model it was created for, so attempts on a
+    fallback model send the full uncached request.
+    """
+    def args(attempt_model: str) -> Dict:
+        if attempt_model == model:
+            return {"model": model, "contents": contents, "config": config}
+        return {"model": attempt_model, "contents": request.contents, "config": request.config}
+    return args
+
+
+def _charge_fallbacks(fn: Callable[[str], Any], model: str, tokens: int) -> Callable[[str], Any]:
+    """
+    Wrap a call_policy attempt function so attempts on a fallback model are
+    charged to that model's rate limits. The call was admitted for model,
+    and its concurrency slot covers every attempt.
+    """
+    def attempt(attempt_model: str) -> Any:
+        if attempt_model != model:
+            ADMISSION.charge(attempt_model, tokens)
+        return fn(attempt_model)
+    return attempt
+
+
+def _charge_fallbacks_async(
+    fn: Callable[[str], Awaitable[Any]], model: str, tokens: int
+) -> Callable[[str], Awaitable[Any]]:
+    """Asyncio variant of _charge_fallbacks."""
+    async def attempt(attempt_model: str) -> Any:
+        if attempt_model != model:
+            await ADMISSION.charge_async(attempt_model, tokens)
+        return await fn(attempt_model)
+    return attempt
+
+
+def _backend_error(error: Exception) -> AssistantError:
+    """The user-facing error for a failed Gemini call."""
+    if isinstance(error, AdmissionRejected):
+        return RateLimitedError(
+            "The assistant is handling too many requests right now. "
+            "Please try again in a few seconds.",
+            retry_after=error.retry_after,
+        )
+    if call_policy.is_retryable(error):
+        return BackendUnavailableError(
+            "The AI backend is busy or not responding right now. Please try again shortly.",
+            retry_after=call_policy.retry_after(error),
+        )
+    return AssistantError(
+        "Something went wrong talking to the AI backend. "
+        "Check logs for details and try again."
+    )
+
+
+def _prepare_request(
+    prompt: str,
+    conversation_history: Optional[List[Dict]],
+    temperature: float,
+    max_output_tokens: int,
+    model: str = DEFAULT_MODEL,
+    history_summary: Optional[str] = None,
+) -> _PreparedRequest:
+    """
+    Validate the prompt and build the contents, config and response cache key
+    shared by the blocking and streaming Gemini calls.
+
+    Raises AssistantError if the prompt is empty.
+    """
     logger.info("ask_gemini called with prompt length=%d, history length=%d", 
                 len(prompt), len(conversation_history) if conversation_history else 0)
 
@@ -127,37 +1038,11 @@ def ask_gemini(
 
     # Build system context
     is_sensitive, is_research, is_time_sensitive = _analyze_prompt(prompt)
-    current_date, current_time = _current_datetime_strings()
-    
-    system_instruction = BASE_SYSTEM_PROMPT_TEMPLATE.format(
-        current_date=current_date,
-        current_time=current_time,
+    history_summary = (history_summary or "").strip()
+    preamble = PROMPT_BUILDER.preamble(
+        (is_sensitive, is_research, is_time_sensitive), history_summary
     )
     
-    # Add contextual instructions
-    context_instructions = []
-    if is_sensitive and is_research:
-        context_instructions.append(
-            "Context: The user is examining a sensitive or political subject "
-            "purely for neutral/academic research."
-        )
-    elif is_sensitive:
-        context_instructions.append(
-            "Context: This touches on sensitive civic topics. Provide factual, "
-            "balanced analysis and avoid persuasion."
-        )
-    elif is_research:
-        context_instructions.append(
-            "Context: Treat the request as a scholarly or technical research task."
-        )
-    if is_time_sensitive:
-        context_instructions.append(
-            f"Context: The user stressed timeliness. Use the stated current date "
-            f"{current_date} and time {current_time} when framing your answer."
-        )
-    if EXTRA_ASSISTANT_CONTEXT:
-        context_instructions.append(EXTRA_ASSISTANT_CONTEXT)
-    
     logger.info(
         "Prompt context: sensitive=%s research=%s time_sensitive=%s",
         is_sensitive,
@@ -165,142 +1050,492 @@ def ask_gemini(
         is_time_sensitive,
     )
 
+    # Normalize the history, then keep the newest turns that fit in the token
+    # budget left over after the preamble and the prompt.
+    all_turns = []
+    for msg in conversation_history or []:
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
+        if content:  # Only check for content, accept any valid role
+            # Map "assistant" to "model" for Gemini API
+            if role == "assistant":
+                api_role = "model"
+            elif role in ("user", "model"):
+                api_role = role
+            else:
+                # Skip invalid roles
+                continue
+            all_turns.append((api_role, content))
+
+    fixed_tokens = (
+        preamble.tokens + estimate_tokens(prompt.strip())
+        + 3 * MESSAGE_TOKEN_OVERHEAD + 8
+    )
+    history_turns, history_stats = select_history(
+        all_turns, max(0, token_budget_for(model) - fixed_tokens), model
+    )
+    logger.info(
+        "History window: %d messages, %d tokens (%d dropped)",
+        history_stats["messages"],
+        history_stats["tokens"],
+        history_stats["dropped"],
+    )
+
+    # Build contents array for Gemini API: preamble, acknowledgement and the
+    # history window (all reused across calls), then the prompt.
+    contents = [preamble.system_content, PROMPT_BUILDER.ack_content]
+    contents += [
+        PROMPT_BUILDER.history_content(api_role, content)
+        for api_role, content in history_turns
+    ]
+    
+    # Add current user prompt
+    contents.append(genai_types.Content(
+        role="user",
+        parts=[genai_types.Part(text=prompt.strip())]
+    ))
+    
+    # Validate and clamp parameters
     try:
-        # Build contents array for Gemini API
-        contents = []
-        
-        # Add system instruction as first message
-        system_message = system_instruction
-        if context_instructions:
-            system_message += "\n\n" + "\n".join(context_instructions)
-        contents.append(genai_types.Content(
-            role="user",
-            parts=[genai_types.Part(text=system_message)]
-        ))
-        contents.append(genai_types.Content(
-            role="model",
-            parts=[genai_types.Part(text="Understood. I'll follow these guidelines.")]
-        ))
-        
-        # Add conversation history if provided
-        if conversation_history:
-            for msg in conversation_history:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                if content:  # Only check for content, accept any valid role
-                    # Map "assistant" to "model" for Gemini API
-                    if role == "assistant":
-                        api_role = "model"
-                    elif role in ("user", "model"):
-                        api_role = role
-                    else:
-                        # Skip invalid roles
-                        continue
-                    contents.append(genai_types.Content(
-                        role=api_role,
-                        parts=[genai_types.Part(text=content)]
-                    ))
-        
-        # Add current user prompt
-        contents.append(genai_types.Content(
-            role="user",
-            parts=[genai_types.Part(text=prompt.strip())]
-        ))
-        
-        # Validate and clamp parameters
         temperature = max(0.0, min(2.0, float(temperature)))
         max_output_tokens = max(256, min(8192, int(max_output_tokens)))
-        
-        response = client.models.generate_content(
-            model=model,
-            contents=contents,
-            config=genai_types.GenerateContentConfig(
-                temperature=temperature,
-                max_output_tokens=max_output_tokens,
-                safety_settings=RELAXED_SAFETY_SETTINGS,
-            ),
-        )
+    except (TypeError, ValueError) as e:
+        raise AssistantError("Temperature and max tokens must be numbers.") from e
 
-        # Robustly extract text: prefer response.text, otherwise fall back to
-        # joining candidate parts (covers some safety-blocked or streaming cases).
-        text = getattr(response, "text", None)
-        if not text:
-            candidates = getattr(response, "candidates", []) or []
-            parts = []
-            for cand in candidates:
-                content = getattr(cand, "content", None)
-                if not content:
-                    continue
-                for part in getattr(content, "parts", []) or []:
-                    if hasattr(part, "text") and part.text:
-                        parts.append(part.text)
-            if parts:
-                text = "\n".join(parts).strip()
+    config = genai_types.GenerateContentConfig(
+        temperature=temperature,
+        max_output_tokens=max_output_tokens,
+        safety_settings=RELAXED_SAFETY_SETTINGS,
+    )
 
-        if not text:
-            logger.warning("Gemini returned no text field.")
-            raise AssistantError("The assistant didn't return any text. Try again.")
+    # Only deterministic generations are cacheable. The key covers everything
+    # that shapes the answer except the clock, which the flags stand in for.
+    cache_key = None
+    cache_ttl = RESPONSE_CACHE_TIME_SENSITIVE_TTL if is_time_sensitive else RESPONSE_CACHE_TTL
+    if response_cache is not None and temperature == 0 and cache_ttl > 0:
+        cache_key = _response_cache_key({
+            "model": model,
+            "system": BASE_SYSTEM_PROMPT_TEMPLATE,
+            "flags": [is_sensitive, is_research, is_time_sensitive],
+            "extra": EXTRA_ASSISTANT_CONTEXT,
+            "summary": history_summary,
+            "history": history_turns,
+            "prompt": prompt.strip(),
+            "temperature": temperature,
+            "max_output_tokens": max_output_tokens,
+        })
+    return _PreparedRequest(
+        contents, config, cache_key, cache_ttl, history_stats,
+        preamble.stable_system, preamble.dynamic_context, history_turns,
+        len(all_turns) - len(history_turns), prompt.strip(),
+        fixed_tokens + history_stats["tokens"],
+    )
 
-        logger.info("ask_gemini succeeded")
-        return text
 
-    except AssistantError:
-        raise
+def summarize_history(
+    previous_summary: Optional[str],
+    messages: List[Dict],
+    *,
+    model: str = DEFAULT_MODEL,
+    max_words: int = SUMMARY_MAX_WORDS,
+) -> str:
+    """
+    Fold messages into a running conversation summary and return the new one.
+
+    Only the previous summary and the newly aged-out messages are sent, so the
+    cost of each update does not grow with the length of the conversation.
 
+    The request is admitted through the shared rate limiter like any other
+    Gemini call. Raises RateLimitedError when it is not admitted in time and
+    AssistantError on any other failure.
+    """
+    transcript = "\n\n".join(
+        f"{msg.get('role', 'user')}: {msg.get('content', '')}"
+        for msg in messages if msg.get("content")
+    )
+    prompt = SUMMARY_PROMPT_TEMPLATE.format(
+        max_words=max_words,
+        summary=(previous_summary or "").strip() or "(none yet)",
+        messages=transcript or "(none)",
+    )
+    config = genai_types.GenerateContentConfig(
+        temperature=0.2,
+        max_output_tokens=max(256, max_words * 3),
+        safety_settings=RELAXED_SAFETY_SETTINGS,
+    )
+    try:
+        with ADMISSION.admit(model, estimate_tokens(prompt)):
+            response = call_policy.call(
+                _charge_fallbacks(
+                    lambda m: client.models.generate_content(
+                        model=m, contents=prompt, config=config
+                    ),
+                    model, estimate_tokens(prompt),
+                ),
+                model, operation="summarize",
+            )
+    except AdmissionRejected as e:
+        # Background work yields to user requests; the caller can retry later.
+        raise _backend_error(e) from e
     except Exception as e:
-        logger.exception("Unexpected error calling Gemini API: %s", e)
-        raise AssistantError(
-            "Something went wrong talking to the AI backend. "
-            "Check logs for details and try again."
-        ) from e
+        logger.exception("Unexpected error summarizing history: %s", e)
+        raise AssistantError("Failed to summarize the conversation history.") from e
 
+    _record_usage({}, model, response)
+    text = _extract_text(response)
+    if not text:
+        raise AssistantError("The summary request returned no text.")
+    logger.info("Summarized %d messages into %d characters", len(messages), len(text))
+    return text.strip()
 
-def _analyze_prompt(prompt: str) -> Tuple[bool, bool, bool]:
+
+# Prefix keys whose cache creation failed recently -> time to retry, in the
+# order they failed (so the soonest to expire first); shared by request threads
+_context_cache_failures: Dict[str, float] = {}
+_context_cache_failures_lock = threading.Lock()
+_CONTEXT_CACHE_FAILURES_MAX = 1024
+
+
+class _ContextCachePlan(NamedTuple):
+    key: str
+    # Absolute index of the first cached history message, and how many
+    start: int
+    count: int
+    tokens: int
+
+
+def _plan_context_cache(
+    request: _PreparedRequest, model: str, record: Optional[Dict]
+) -> Optional[_ContextCachePlan]:
     """
-    Returns a (is_sensitive, is_research, is_time_sensitive) tuple for heuristics.
+    Choose the history messages to cache, or None when they are too few or
+    recently failed to cache.
+
+    Positions are absolute indexes into the history, not into the token
+    budget window, whose first message moves on every turn once a chat
+    outgrows the budget. The cached range starts at a CONTEXT_CACHE_STEP
+    boundary inside the window and keeps that start for as long as the
+    window still contains it (messages before it are left out of cached
+    requests). Its end grows in CONTEXT_CACHE_STEP steps, always on a model
+    turn and leaving the newest exchange out, so long chats recreate their
+    cache every few turns rather than on every turn.
     """
-    lowered = prompt.lower()
-    is_sensitive = any(token in lowered for token in SENSITIVE_KEYWORDS)
-    is_research = any(token in lowered for token in RESEARCH_KEYWORDS)
-    is_time_sensitive = any(token in lowered for token in TIME_SENSITIVE_KEYWORDS)
-    return is_sensitive, is_research, is_time_sensitive
+    turns = request.history_turns
+    first = request.history_start
+    end = (max(0, first + len(turns) - 2) // CONTEXT_CACHE_STEP) * CONTEXT_CACHE_STEP
+    while end > first and turns[end - 1 - first][0] != "model":
+        end -= 1
+
+    start = (record or {}).get("start")
+    if not isinstance(start, int) or not first <= start < end:
+        start = -(-first // CONTEXT_CACHE_STEP) * CONTEXT_CACHE_STEP
+        while start < end and turns[start - first][0] == "model":
+            start += 1
+    if end <= start:
+        return None
+
+    prefix = turns[start - first:end - first]
+    tokens = estimate_tokens(request.stable_system) + sum(
+        estimate_tokens(text) + MESSAGE_TOKEN_OVERHEAD for _, text in prefix
+    )
+    if tokens < CONTEXT_CACHE_MIN_TOKENS:
+        return None
+
+    key = _response_cache_key({
+        "model": model,
+        "system": request.stable_system,
+        "history": prefix,
+    })
+    with _context_cache_failures_lock:
+        retry_at = _context_cache_failures.get(key, 0)
+    if retry_at > time.time():
+        return None
+    return _ContextCachePlan(key, start, len(prefix), tokens)
+
+
+def _context_cache_config(
+    request: _PreparedRequest, plan: _ContextCachePlan
+) -> genai_types.CreateCachedContentConfig:
+    offset = plan.start - request.history_start
+    return genai_types.CreateCachedContentConfig(
+        system_instruction=request.stable_system,
+        contents=[
+            PROMPT_BUILDER.history_content(role, text)
+            for role, text in request.history_turns[offset:offset + plan.count]
+        ],
+        ttl=f"{CONTEXT_CACHE_TTL}s",
+        display_name="conversation-prefix",
+    )
+
+
+def _context_cache_is_current(record: Optional[Dict], key: str) -> bool:
+    return bool(
+        record
+        and record.get("key") == key
+        and record.get("name")
+        and float(record.get("expires_at", 0)) > time.time() + CONTEXT_CACHE_REFRESH_MARGIN
+    )
+
+
+def _new_context_cache_record(name: str, plan: _ContextCachePlan) -> Dict:
+    return {
+        "name": name,
+        "key": plan.key,
+        "start": plan.start,
+        "message_count": plan.count,
+        "expires_at": time.time() + CONTEXT_CACHE_TTL,
+    }
+
+
+def _context_cache_failed(key: str, error: Exception) -> None:
+    logger.warning("Context cache creation failed, sending the full request: %s", error)
+    now = time.time()
+    with _context_cache_failures_lock:
+        _context_cache_failures.pop(key, None)
+        _context_cache_failures[key] = now + CONTEXT_CACHE_RETRY_AFTER
+        # Drop expired entries from the front; past the cap, also the ones
+        # closest to expiring.
+        while _context_cache_failures:
+            oldest, retry_at = next(iter(_context_cache_failures.items()))
+            if retry_at > now and len(_context_cache_failures) <= _CONTEXT_CACHE_FAILURES_MAX:
+                break
+            del _context_cache_failures[oldest]
+
+
+def _cached_request(
+    request: _PreparedRequest, name: str, plan: _ContextCachePlan
+) -> Tuple[List[genai_types.Content], genai_types.GenerateContentConfig]:
+    """Contents and config for a call that reuses the cached prefix."""
+    offset = plan.start - request.history_start + plan.count
+    contents = [
+        PROMPT_BUILDER.history_content(role, text)
+        for role, text in request.history_turns[offset:]
+    ]
+    contents.append(genai_types.Content(role="user", parts=[
+        genai_types.Part(text=request.dynamic_context),
+        genai_types.Part(text=request.prompt),
+    ]))
+    config = request.config.model_copy(update={"cached_content": name})
+    return contents, config
 
 
-def _build_contextual_prompt(prompt: str):
+def _resolve_context_cache(
+    request: _PreparedRequest, model: str, record: Optional[Dict]
+) -> Tuple[List[genai_types.Content], genai_types.GenerateContentConfig, Optional[Dict]]:
     """
-    Prepend lightweight context so the model understands user intent.
-    Returns the augmented prompt along with metadata for logging.
+    Return (contents, config, cache record) for the call. Reuses the
+    conversation's cache while its prefix is unchanged, creates a new one
+    when it changed or is about to expire, and falls back to the plain
+    request (record None) when caching is off or unavailable.
     """
-    is_sensitive, is_research, is_time_sensitive = _analyze_prompt(prompt)
-    current_date, current_time = _current_datetime_strings()
-    context_lines = [
-        BASE_SYSTEM_PROMPT_TEMPLATE.format(
-            current_date=current_date,
-            current_time=current_time,
-        )
-    ]
+    plan = None
+    if CONTEXT_CACHE_ENABLED and record is not None:
+        plan = _plan_context_cache(request, model, record)
+    if plan is None:
+        return request.contents, request.config, None
+
+    if not _context_cache_is_current(record, plan.key):
+        try:
+            with ADMISSION.admit(model, plan.tokens):
+                cached = client.caches.create(
+                    model=model, config=_context_cache_config(request, plan)
+                )
+        except AdmissionRejected as e:
+            logger.info("Context cache creation not admitted, sending the full request: %s", e)
+            return request.contents, request.config, None
+        except Exception as e:
+            _context_cache_failed(plan.key, e)
+            return request.contents, request.config, None
+        if record.get("name"):
+            try:
+                client.caches.delete(name=record["name"])
+            except Exception as e:
+                logger.info("Could not delete replaced context cache: %s", e)
+        record = _new_context_cache_record(cached.name, plan)
+        logger.info("Created context cache %s for %d messages", cached.name, plan.count)
+
+    contents, config = _cached_request(request, record["name"], plan)
+    return contents, config, record
+
+
+async def _resolve_context_cache_async(
+    request: _PreparedRequest, model: str, record: Optional[Dict]
+) -> Tuple[List[genai_types.Content], genai_types.GenerateContentConfig, Optional[Dict]]:
+    """Async variant of _resolve_context_cache using client.aio.caches."""
+    plan = None
+    if CONTEXT_CACHE_ENABLED and record is not None:
+        plan = _plan_context_cache(request, model, record)
+    if plan is None:
+        return request.contents, request.config, None
+
+    if not _context_cache_is_current(record, plan.key):
+        try:
+            async with ADMISSION.admit_async(model, plan.tokens):
+                cached = await client.aio.caches.create(
+                    model=model, config=_context_cache_config(request, plan)
+                )
+        except AdmissionRejected as e:
+            logger.info("Context cache creation not admitted, sending the full request: %s", e)
+            return request.contents, request.config, None
+        except Exception as e:
+            _context_cache_failed(plan.key, e)
+            return request.contents, request.config, None
+        if record.get("name"):
+            try:
+                await client.aio.caches.delete(name=record["name"])
+            except Exception as e:
+                logger.info("Could not delete replaced context cache: %s", e)
+        record = _new_context_cache_record(cached.name, plan)
+        logger.info("Created context cache %s for %d messages", cached.name, plan.count)
+
+    contents, config = _cached_request(request, record["name"], plan)
+    return contents, config, record
 
+
+def _record_context_cache(
+    metadata: Optional[Dict], previous: Optional[Dict], record: Optional[Dict]
+) -> None:
+    if metadata is not None and previous is not None:
+        metadata["context_cache"] = record
+
+
+def _response_cache_key(payload: Dict) -> str:
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _cache_lookup(request: _PreparedRequest, metadata: Optional[Dict]) -> Optional[str]:
+    """Return a cached answer for the request (recording the outcome in metadata)."""
+    cached = None
+    if request.cache_key is not None and response_cache is not None:
+        with tracing.span("response_cache"):
+            cached = response_cache.get(request.cache_key)
+        if cached is not None:
+            logger.info("Response cache hit")
+    if metadata is not None:
+        metadata["cached"] = cached is not None
+        metadata["history"] = request.history_stats
+    return cached
+
+
+def _cache_store(request: _PreparedRequest, text: str) -> None:
+    if request.cache_key is not None and response_cache is not None:
+        response_cache.put(request.cache_key, text, request.cache_ttl)
+
+
+async def _cache_lookup_async(
+    request: _PreparedRequest, metadata: Optional[Dict]
+) -> Optional[str]:
+    # The disk tier does file I/O, so keep it off the event loop.
+    if request.cache_key is not None and response_cache is not None and response_cache.directory:
+        return await asyncio.to_thread(_cache_lookup, request, metadata)
+    return _cache_lookup(request, metadata)
+
+
+async def _cache_store_async(request: _PreparedRequest, text: str) -> None:
+    if request.cache_key is not None and response_cache is not None and response_cache.directory:
+        await asyncio.to_thread(_cache_store, request, text)
+    else:
+        _cache_store(request, text)
+
+
+def _record_usage(call_info: Dict, model: str, response) -> None:
+    """
+    Put the token counts from a response's usage metadata in call_info["usage"]
+    and add them to the token metrics, under the model that answered.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    counts = {
+        "prompt": getattr(usage, "prompt_token_count", None) or 0,
+        "output": getattr(usage, "candidates_token_count", None) or 0,
+        "cached": getattr(usage, "cached_content_token_count", None) or 0,
+        "thoughts": getattr(usage, "thoughts_token_count", None) or 0,
+    }
+    call_info["usage"] = counts
+    metrics.record_tokens(call_info.get("model", model), counts)
+
+
+def _extract_text(response) -> Optional[str]:
+    """
+    Robustly extract text: prefer response.text, otherwise fall back to
+    joining candidate parts (covers some safety-blocked or streaming cases).
+    """
+    text = getattr(response, "text", None)
+    if not text:
+        candidates = getattr(response, "candidates", []) or []
+        parts = []
+        for cand in candidates:
+            content = getattr(cand, "content", None)
+            if not content:
+                continue
+            for part in getattr(content, "parts", []) or []:
+                if hasattr(part, "text") and part.text:
+                    parts.append(part.text)
+        if parts:
+            text = "\n".join(parts).strip()
+    return text
+
+
+def classify_many(prompts: List[str], processes: Optional[int] = None) -> List[Classification]:
+    """
+    Classify a batch of prompts (labels and per-category scores) with the
+    configured classifier, e.g. for offline analysis of stored conversations.
+    """
+    return PROMPT_CLASSIFIER.classify_many(prompts, processes=processes)
+
+
+def _analyze_prompt(prompt: str) -> Tuple[bool, bool, bool]:
+    """
+    Returns a (is_sensitive, is_research, is_time_sensitive) tuple for heuristics.
+    """
+    labels = PROMPT_CLASSIFIER.labels(prompt)
+    return "sensitive" in labels, "research" in labels, "time_sensitive" in labels
+
+
+def _flag_instructions(
+    is_sensitive: bool,
+    is_research: bool,
+    is_time_sensitive: bool,
+    current_date: str,
+    current_time: str,
+) -> List[str]:
+    """Context lines for the prompt flags returned by _analyze_prompt."""
+    instructions = []
     if is_sensitive and is_research:
-        context_lines.append(
+        instructions.append(
             "Context: The user is examining a sensitive or political subject "
             "purely for neutral/academic research."
         )
     elif is_sensitive:
-        context_lines.append(
+        instructions.append(
             "Context: This touches on sensitive civic topics. Provide factual, "
             "balanced analysis and avoid persuasion."
         )
     elif is_research:
-        context_lines.append(
+        instructions.append(
             "Context: Treat the request as a scholarly or technical research task."
         )
     if is_time_sensitive:
-        context_lines.append(
+        instructions.append(
             "Context: The user stressed timeliness. Use the stated current date "
             f"{current_date} and time {current_time} when framing your answer."
         )
-    if EXTRA_ASSISTANT_CONTEXT:
-        context_lines.append(EXTRA_ASSISTANT_CONTEXT)
+    return instructions
+
+
+def _build_contextual_prompt(prompt: str, flags: Optional[Tuple[bool, bool, bool]] = None):
+    """
+    Prepend lightweight context so the model understands user intent.
+    Returns the augmented prompt along with metadata for logging.
+
+    Pass flags from an earlier _analyze_prompt call to avoid scanning the
+    prompt again.
+    """
+    is_sensitive, is_research, is_time_sensitive = flags or _analyze_prompt(prompt)
+    preamble = PROMPT_BUILDER.preamble((is_sensitive, is_research, is_time_sensitive))
+    context_lines = list(preamble.lines)
 
     context_lines.append("User prompt:")
     context_lines.append(prompt.strip())
@@ -0,0 +1,398 @@
+"""
+Batch mode: run a JSONL file of prompts through ask_gemini.
+
+Each input line is a JSON object:
+
+    {"id": "q1", "prompt": "...", "model": "...", "temperature": 0.2,
+     "max_output_tokens": 1024, "history": [{"role": "user", "content": "..."}],
+     "history_summary": "..."}
+
+Only "prompt" is required; "id" defaults to the line number. Each result is
+written as one JSON line, either {"id", "response", "model", "cached",
+"latency"} or {"id", "error"}, in completion order or in input order.
+
+Prompts run on a thread pool (ask_gemini) or on an event loop (ask_gemini_async)
+with bounded concurrency, optionally throttled by a token-bucket rate limit.
+Input is read lazily, so arbitrarily large files run in constant memory.
+
+The output file doubles as the checkpoint: with resume=True it is appended
+to, and ids that already have a response there are skipped (failed ones are
+retried).
+"""
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, TextIO
+
+from assistant_core import DEFAULT_MODEL, AssistantError, ask_gemini, ask_gemini_async
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Log a progress line every this many results
+PROGRESS_EVERY = 100
+
+ORDERS = ("completion", "input")
+MODES = ("thread", "asyncio")
+
+
+class BatchItem(NamedTuple):
+    index: int  # position among the items actually run, for input ordering
+    id: str
+    prompt: str
+    options: Dict
+    error: Optional[str] = None  # set for lines that could not be parsed
+
+
+class BatchSummary(NamedTuple):
+    total: int
+    succeeded: int
+    failed: int
+    skipped: int
+    elapsed: float
+    latencies: List[float]
+
+    @property
+    def throughput(self) -> float:
+        """Completed prompts per second."""
+        return self.total / self.elapsed if self.elapsed > 0 else 0.0
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    def format(self) -> str:
+        lines = [
+            f"Processed {self.total} prompts in {self.elapsed:.1f}s "
+            f"({self.throughput:.2f}/s): {self.succeeded} succeeded, "
+            f"{self.failed} failed, {self.skipped} skipped (already done)",
+        ]
+        if self.latencies:
+            lines.append(
+                f"Latency p50={self.latency_quantile(0.5):.2f}s "
+                f"p95={self.latency_quantile(0.95):.2f}s "
+                f"max={max(self.latencies):.2f}s"
+            )
+        return "\n".join(lines)
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing `rate` acquisitions per second on average, with
+    bursts of up to `burst`. Callers reserve a token and then wait for it, so
+    concurrent callers are spaced out evenly rather than released in herds.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take a token (possibly going into debt); return the seconds to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> None:
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class _ResultWriter:
+    """Writes result records as JSON lines, reordering them for input order."""
+
+    def __init__(self, stream: TextIO, order: str):
+        self.stream = stream
+        self.order = order
+        self._buffer: Dict[int, Dict] = {}
+        self._next = 0
+
+    def write(self, index: int, record: Dict) -> None:
+        if self.order == "completion":
+            self._emit(record)
+            return
+        self._buffer[index] = record
+        while self._next in self._buffer:
+            self._emit(self._buffer.pop(self._next))
+            self._next += 1
+
+    def _emit(self, record: Dict) -> None:
+        self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        # Flush per line so a crash loses at most the results in flight
+        self.stream.flush()
+
+
+class _Progress:
+    def __init__(self, skipped: int):
+        self.started = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = skipped
+        self.latencies: List[float] = []
+
+    def add(self, record: Dict) -> None:
+        if "error" in record:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+            self.latencies.append(record["latency"])
+        done = self.succeeded + self.failed
+        if done % PROGRESS_EVERY == 0:
+            elapsed = time.monotonic() - self.started
+            logger.info(
+                "Batch progress: %d done (%d failed), %.2f prompts/s",
+                done, self.failed, done / elapsed if elapsed > 0 else 0.0,
+            )
+
+    def summary(self) -> BatchSummary:
+        return BatchSummary(
+            self.succeeded + self.failed, self.succeeded, self.failed, self.skipped,
+            time.monotonic() - self.started, self.latencies,
+        )
+
+
+def completed_ids(path: str) -> Set[str]:
+    """Ids with a successful response in an existing output file."""
+    done = set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                if isinstance(record, dict) and "response" in record:
+                    done.add(str(record.get("id")))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def read_items(lines: Iterable[str], skip_ids: Optional[Set[str]] = None) -> Iterator[BatchItem]:
+    """
+    Parse input lines into BatchItems, skipping blank lines and ids in
+    skip_ids. Invalid lines become items carrying an error.
+    """
+    skip_ids = skip_ids or set()
+    index = 0
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("line is not a JSON object")
+        except ValueError as e:
+            item = BatchItem(index, str(line_number), "", {}, f"Invalid input line: {e}")
+        else:
+            item_id = str(data.get("id", line_number))
+            if item_id in skip_ids:
+                continue
+            prompt = data.get("prompt")
+            if not isinstance(prompt, str):
+                item = BatchItem(index, item_id, "", {}, "Missing prompt")
+            else:
+                options = {
+                    key: data[key]
+                    for key in ("model", "temperature", "max_output_tokens", "history_summary")
+                    if data.get(key) is not None
+                }
+                if data.get("history"):
+                    options["conversation_history"] = data["history"]
+                item = BatchItem(index, item_id, prompt, options)
+        yield item
+        index += 1
+
+
+def run_batch(
+    input_path: str,
+    output_path: str,
+    *,
+    concurrency: int = 8,
+    rate: Optional[float] = None,
+    burst: Optional[float] = None,
+    order: str = "completion",
+    mode: str = "thread",
+    resume: bool = False,
+    defaults: Optional[Dict] = None,
+) -> BatchSummary:
+    """
+    Run every prompt in input_path ("-" for stdin) and write results to
+    output_path ("-" for stdout). defaults supplies model/temperature/
+    max_output_tokens for lines that don't set them. Returns a BatchSummary.
+    """
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}")
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {MODES}")
+    if resume and output_path == "-":
+        raise ValueError("resume needs an output file")
+    concurrency = max(1, concurrency)
+
+    skip_ids = completed_ids(output_path) if resume else set()
+    if skip_ids:
+        logger.info("Resuming: skipping %d completed ids", len(skip_ids))
+
+    limiter = TokenBucket(rate, burst) if rate else None
+    defaults = dict(defaults or {})
+    defaults.setdefault("model", DEFAULT_MODEL)
+
+    source = sys.stdin if input_path == "-" else open(input_path, "r", encoding="utf-8")
+    if output_path == "-":
+        target = sys.stdout
+    else:
+        if resume:
+            _terminate_last_line(output_path)
+        target = open(output_path, "a" if resume else "w", encoding="utf-8")
+
+    progress = _Progress(len(skip_ids))
+    writer = _ResultWriter(target, order)
+    try:
+        items = read_items(source, skip_ids)
+        if mode == "asyncio":
+            asyncio.run(_run_async(items, writer, progress, concurrency, limiter, defaults))
+        else:
+            _run_threaded(items, writer, progress, concurrency, limiter, defaults)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+    return progress.summary()
+
+
+def _terminate_last_line(path: str) -> None:
+    """Make sure appended results don't join a line torn by a crash."""
+    try:
+        with open(path, "rb+") as f:
+            f.seek(0, 2)
+            if f.tell() == 0:
+                return
+            f.seek(-1, 2)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    except FileNotFoundError:
+        pass
+
+
+def _run_threaded(
+    items: Iterator[BatchItem],
+    writer: _ResultWriter,
+    progress: _Progress,
+    concurrency: int,
+    limiter: Optional[TokenBucket],
+    defaults: Dict,
+) -> None:
+    def finish(futures):
+        for future in futures:
+            index, record = future.result()
+            writer.write(index, record)
+            progress.add(record)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+        pending = set()
+        for item in items:
+            if len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+            pending.add(pool.submit(_process, item, limiter, defaults))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            finish(done)
+
+
+async def _run_async(
+    items: Iterator[BatchItem],
+    writer: _ResultWriter,
+    progress: _Progress,
+    concurrency: int,
+    limiter: Optional[TokenBucket],
+    defaults: Dict,
+) -> None:
+    def finish(tasks):
+        for task in tasks:
+            index, record = task.result()
+            writer.write(index, record)
+            progress.add(record)
+
+    pending = set()
+    for item in items:
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            finish(done)
+        pending.add(asyncio.ensure_future(_process_async(item, limiter, defaults)))
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finish(done)
+
+
+def _process(item: BatchItem, limiter: Optional[TokenBucket], defaults: Dict):
+    if item.error:
+        return item.index, {"id": item.id, "error": item.error}
+    if limiter:
+        limiter.acquire()
+    options = {**defaults, **item.options}
+    metadata: Dict = {}
+    started = time.monotonic()
+    try:
+        text = ask_gemini(item.prompt, metadata=metadata, **options)
+    except AssistantError as e:
+        return item.index, {"id": item.id, "error": str(e)}
+    except Exception as e:
+        logger.exception("Unexpected error for batch item %s: %s", item.id, e)
+        return item.index, {"id": item.id, "error": f"Unexpected error: {e}"}
+    return item.index, _result(item, text, options, metadata, started)
+
+
+async def _process_async(item: BatchItem, limiter: Optional[TokenBucket], defaults: Dict):
+    if item.error:
+        return item.index, {"id": item.id, "error": item.error}
+    if limiter:
+        await limiter.acquire_async()
+    options = {**defaults, **item.options}
+    metadata: Dict = {}
+    started = time.monotonic()
+    try:
+        text = await ask_gemini_async(item.prompt, metadata=metadata, **options)
+    except AssistantError as e:
+        return item.index, {"id": item.id, "error": str(e)}
+    except Exception as e:
+        logger.exception("Unexpected error for batch item %s: %s", item.id, e)
+        return item.index, {"id": item.id, "error": f"Unexpected error: {e}"}
+    return item.index, _result(item, text, options, metadata, started)
+
+
+def _result(item: BatchItem, text: str, options: Dict, metadata: Dict, started: float) -> Dict:
+    return {
+        "id": item.id,
+        "response": text,
+        "model": metadata.get("model", options["model"]),
+        "cached": metadata.get("cached", False),
+        "latency": round(time.monotonic() - started, 3),
+    }
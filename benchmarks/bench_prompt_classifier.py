@@ -0,0 +1,83 @@
+"""
+Micro-benchmark: single-pass PromptClassifier vs. the previous per-keyword
+substring scans, across prompt lengths and keyword counts.
+
+Prompts contain no keywords, the worst case for both approaches (every scan
+reads the whole text and nothing exits early).
+
+Run with:
+    python benchmarks/bench_prompt_classifier.py
+"""
+import os
+import random
+import string
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+import assistant_core  # noqa: E402
+from prompt_classifier import PromptClassifier  # noqa: E402
+
+PROMPT_LENGTHS = [1_000, 10_000, 100_000, 1_000_000]
+SYNTHETIC_KEYWORD_COUNTS = [100, 1_000]
+
+
+def naive_labels(categories, text):
+    lowered = text.lower()
+    return {
+        name for name, keywords in categories.items()
+        if any(kw in lowered for kw in keywords)
+    }
+
+
+def make_prompt(length, rng):
+    # Digits and punctuation only, so no keyword can ever match.
+    alphabet = string.digits + " .,;"
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def make_categories(keyword_count, rng):
+    categories = {f"cat{i}": set() for i in range(3)}
+    for i in range(keyword_count):
+        word = "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+        categories[f"cat{i % 3}"].add(word)
+    return categories
+
+
+def best_of(func, repeat=5):
+    number = 1
+    while timeit.timeit(func, number=number) < 0.05:
+        number *= 2
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+    rng = random.Random(0)
+    prompts = {length: make_prompt(length, rng) for length in PROMPT_LENGTHS}
+    keyword_sets = [("default", {
+        "sensitive": assistant_core.SENSITIVE_KEYWORDS,
+        "research": assistant_core.RESEARCH_KEYWORDS,
+        "time_sensitive": assistant_core.TIME_SENSITIVE_KEYWORDS,
+    })]
+    keyword_sets += [
+        ("synthetic", make_categories(count, rng)) for count in SYNTHETIC_KEYWORD_COUNTS
+    ]
+
+    print(f"{'keywords':>9} {'prompt':>10} {'naive ms':>10} {'classifier ms':>14} {'speedup':>8}")
+    for name, categories in keyword_sets:
+        keyword_count = sum(len(kws) for kws in categories.values())
+        classifier = PromptClassifier(categories)
+        for length, prompt in prompts.items():
+            naive = best_of(lambda: naive_labels(categories, prompt))
+            single = best_of(lambda: classifier.labels(prompt))
+            print(
+                f"{keyword_count:>9} {length:>10} {naive * 1e3:>10.3f} "
+                f"{single * 1e3:>14.3f} {naive / single:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+Storage and prompt-assembly benchmark suite with a JSON baseline.
+
+Builds synthetic conversation stores (1k/10k/100k conversations, plus one
+conversation each of 10-5,000 messages) for both backends and times the
+ConversationManager operations against them, then times _analyze_prompt
+and a full ask_gemini call with the Gemini client stubbed out, so only the
+local work (prompt classification, history selection, contents and config
+construction, call policy) is measured.
+
+Results are written as JSON. Given a baseline written by an earlier run,
+every case whose median got slower by more than the threshold is reported
+and the exit status is 1, so the suite can gate a change:
+
+    python benchmarks/bench_suite.py --output baseline.json
+    # ... make a change ...
+    python benchmarks/bench_suite.py --baseline baseline.json --output current.json
+
+--quick uses small stores for a fast check; --filter runs only the cases
+whose name contains the given text. Set CONVERSATION_FSYNC=false to leave
+disk flush latency out of the store numbers.
+
+Run with:
+    python benchmarks/bench_suite.py [--quick] [--baseline FILE] [--output FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+import assistant_core  # noqa: E402
+import conversation_codec  # noqa: E402
+import conversation_manager  # noqa: E402
+import conversation_store  # noqa: E402
+from conversation_manager import ConversationManager  # noqa: E402
+
+STORE_SIZES = [1_000, 10_000, 100_000]
+MESSAGE_COUNTS = [10, 100, 1_000, 5_000]
+QUICK_STORE_SIZES = [1_000]
+QUICK_MESSAGE_COUNTS = [10, 1_000]
+PROMPT_LENGTHS = [100, 10_000, 100_000]
+BACKENDS = ["json", "sqlite"]
+
+# Messages in each filler conversation of a synthetic store
+FILLER_MESSAGES = 4
+
+# Each case runs for at least MIN_TIME seconds (and MIN_ROUNDS rounds), but
+# never more than MAX_ROUNDS rounds
+MIN_TIME = 0.5
+MIN_ROUNDS = 5
+MAX_ROUNDS = 1_000
+
+DEFAULT_THRESHOLD = 0.25
+
+WORDS = (
+    "the assistant should explain how a request flows through the store and "
+    "what happens when a conversation grows beyond the history window budget"
+).split()
+
+
+def make_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_messages(rng: random.Random, count: int, start: datetime) -> List[Dict]:
+    return [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": make_text(rng, rng.randint(5, 60)),
+            "timestamp": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(count)
+    ]
+
+
+def make_conversation(rng: random.Random, messages: int, start: datetime) -> Dict:
+    history = make_messages(rng, messages, start)
+    return {
+        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "created_at": start.isoformat(),
+        "updated_at": history[-1]["timestamp"] if history else start.isoformat(),
+        "messages": history,
+    }
+
+
+def build_store(backend: str, directory: Path, size: int, message_counts: List[int],
+                rng: random.Random) -> Dict[int, str]:
+    """
+    Fill a fresh store with `size` filler conversations plus one conversation
+    per message count, and return the IDs of the latter by count.
+    """
+    conversation_manager.CONVERSATIONS_DIR = directory
+    conversation_manager.CONVERSATION_STORE = backend
+    conversation_manager.CONVERSATION_DB_PATH = None
+    store = conversation_manager.get_store()
+
+    start = datetime(2025, 1, 1)
+    conversations = [
+        make_conversation(rng, FILLER_MESSAGES, start + timedelta(minutes=i))
+        for i in range(size)
+    ]
+    long_ids = {}
+    for count in message_counts:
+        conversation = make_conversation(rng, count, start)
+        long_ids[count] = conversation["id"]
+        conversations.append(conversation)
+
+    if backend == "json":
+        # Writing the snapshots directly and indexing once is far quicker
+        # than saving 100k conversations one by one.
+        for conversation in conversations:
+            path = directory / f"{conversation['id']}.json"
+            path.write_bytes(conversation_codec.encode(conversation))
+        store.rebuild_index()
+    else:
+        # SQLite transactions nest, so this commits everything once
+        with store.lock(""):
+            for conversation in conversations:
+                store.save(conversation)
+    return long_ids
+
+
+def measure(func: Callable[[], object], setup: Optional[Callable[[], object]] = None,
+            min_time: float = MIN_TIME) -> Dict:
+    """Time func() repeatedly (calling setup() untimed before each run)."""
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < MAX_ROUNDS and (
+        len(samples) < MIN_ROUNDS or time.perf_counter() < deadline
+    ):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "min": samples[0],
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "rounds": len(samples),
+    }
+
+
+class Suite:
+    """Runs the selected cases and collects results by case name."""
+
+    def __init__(self, name_filter: Optional[str], min_time: float):
+        self.name_filter = name_filter
+        self.min_time = min_time
+        self.results: Dict[str, Dict] = {}
+
+    def wanted(self, name: str) -> bool:
+        return not self.name_filter or self.name_filter in name
+
+    def run(self, name: str, func: Callable[[], object],
+            setup: Optional[Callable[[], object]] = None) -> None:
+        if not self.wanted(name):
+            return
+        result = measure(func, setup, self.min_time)
+        self.results[name] = result
+        print(f"{name:<60} {result['median'] * 1e3:>10.3f} ms  ({result['rounds']} rounds)")
+
+
+def bench_store(suite: Suite, backend: str, size: int, message_counts: List[int],
+                workdir: Path, rng: random.Random) -> None:
+    params = f"{backend},n={size}"
+    names = [
+        f"{op}[{params}]" for op in
+        ("create_conversation", "list_conversations", "delete_conversation")
+    ]
+    names.append(f"list_conversations[{params},limit=50]")
+    for count in message_counts:
+        names += [f"load_conversation[{params},messages={count}]",
+                  f"add_message[{params},messages={count}]"]
+    if not any(suite.wanted(name) for name in names):
+        return
+
+    directory = Path(tempfile.mkdtemp(prefix=f"{backend}-{size}-", dir=workdir))
+    try:
+        print(f"Building {backend} store with {size} conversations...")
+        long_ids = build_store(backend, directory, size, message_counts, rng)
+
+        suite.run(f"create_conversation[{params}]", ConversationManager.create_conversation)
+        suite.run(f"list_conversations[{params}]", ConversationManager.list_conversations)
+        suite.run(f"list_conversations[{params},limit=50]",
+                  lambda: ConversationManager.list_conversations(50))
+
+        for count, conversation_id in long_ids.items():
+            suite.run(
+                f"load_conversation[{params},messages={count}]",
+                lambda: ConversationManager.load_conversation(conversation_id),
+                setup=conversation_manager._cache.clear,
+            )
+            suite.run(
+                f"add_message[{params},messages={count}]",
+                lambda: ConversationManager.add_message(conversation_id, "user", "One more question"),
+            )
+
+        doomed: List[str] = []
+        suite.run(
+            f"delete_conversation[{params}]",
+            lambda: ConversationManager.delete_conversation(doomed.pop()),
+            setup=lambda: doomed.append(ConversationManager.create_conversation()),
+        )
+    finally:
+        conversation_manager._cache.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class _StubModels:
+    """Stands in for client.models so ask_gemini never leaves the process."""
+
+    def generate_content(self, **kwargs):
+        return SimpleNamespace(text="Stubbed answer.", usage_metadata=None)
+
+
+def bench_prompt(suite: Suite, message_counts: List[int], rng: random.Random) -> None:
+    for length in PROMPT_LENGTHS:
+        prompt = make_text(rng, length // 6)[:length]
+        suite.run(f"_analyze_prompt[chars={length}]",
+                  lambda: assistant_core._analyze_prompt(prompt))
+
+    original_client = assistant_core.client
+    assistant_core.client = SimpleNamespace(models=_StubModels())
+    try:
+        for count in message_counts:
+            history = make_messages(rng, count, datetime(2025, 1, 1))
+            suite.run(
+                f"ask_gemini[stubbed,messages={count}]",
+                lambda: assistant_core.ask_gemini("What did we decide earlier?", history),
+            )
+    finally:
+        assistant_core.client = original_client
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], threshold: float) -> List[str]:
+    """Return a line for each case whose median is more than threshold slower."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if not before or before.get("median", 0) <= 0:
+            continue
+        change = result["median"] / before["median"] - 1
+        if change > threshold:
+            regressions.append(
+                f"{name}: {before['median'] * 1e3:.3f} ms -> "
+                f"{result['median'] * 1e3:.3f} ms (+{change:.0%})"
+            )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Small stores only")
+    parser.add_argument("--sizes", type=int, nargs="+", help="Conversations per synthetic store")
+    parser.add_argument("--messages", type=int, nargs="+", help="Message counts of the long conversations")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--filter", help="Only run cases whose name contains this text")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME,
+                        help="Minimum seconds spent timing each case")
+    parser.add_argument("--workdir", help="Where to build the synthetic stores (default: temp dir)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against results from an earlier run")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed slowdown of each case's median, as a fraction")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_STORE_SIZES if args.quick else STORE_SIZES)
+    message_counts = args.messages or (QUICK_MESSAGE_COUNTS if args.quick else MESSAGE_COUNTS)
+
+    # Per-operation log lines would dominate the timings
+    for name in ("conversation_manager", "conversation_store", "assistant_core",
+                 "call_policy", "tracing"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    suite = Suite(args.filter, args.min_time)
+    rng = random.Random(0)
+    saved = (conversation_manager.CONVERSATIONS_DIR, conversation_manager.CONVERSATION_STORE,
+             conversation_manager.CONVERSATION_DB_PATH)
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    try:
+        for backend in args.backends:
+            for size in sizes:
+                bench_store(suite, backend, size, message_counts, workdir, rng)
+        bench_prompt(suite, message_counts, rng)
+    finally:
+        (conversation_manager.CONVERSATIONS_DIR, conversation_manager.CONVERSATION_STORE,
+         conversation_manager.CONVERSATION_DB_PATH) = saved
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "fsync": conversation_store.CONVERSATION_FSYNC,
+        "results": suite.results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+        print(f"Wrote {len(suite.results)} results to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(suite.results, baseline.get("results", {}), args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) slower than the baseline by more than {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo case is more than {args.threshold:.0%} slower than the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+"""
+End-to-end load test: drive the web UI against a local fake Gemini server.
+
+For each server configuration this starts fake_gemini.py and the web app
+(in a fresh working directory, so every run begins with an empty store),
+then runs closed-loop virtual users against it. Each user opens its own
+conversation, then picks requests from the mix: ask (POST /ask), get
+(GET /conversations/<id>) and list (GET /conversations). It reports
+throughput and p50/p95/p99 latency per request type.
+
+Configurations:
+    flask          Flask's threaded development server
+    uvicorn:W      uvicorn asgi:app with W worker processes
+    gunicorn:WxT   gunicorn web_ui:app with W workers of T threads (gthread)
+
+Run with:
+    python benchmarks/load_test.py --configs flask uvicorn:1 uvicorn:4 \\
+        --concurrency 32 --duration 30 --latency 0.8 --tokens-per-second 80
+
+--url drives a server that is already running instead (with whatever
+Gemini backend it is configured for), and --output writes the report as
+JSON.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_CONFIGS = ["flask", "uvicorn:1", "uvicorn:4"]
+DEFAULT_MIX = "ask=4,get=4,list=2"
+OPERATIONS = ("ask", "get", "list")
+PERCENTILES = (50, 95, 99)
+
+STARTUP_TIMEOUT = 30.0
+REQUEST_TIMEOUT = 120.0
+
+PROMPTS = [
+    "Summarize what we discussed so far.",
+    "Can you explain that in simpler terms?",
+    "Give me three examples.",
+    "What are the trade-offs of that approach?",
+    "Write a short paragraph about it.",
+]
+
+
+def parse_mix(text: str) -> List[Tuple[str, float]]:
+    """Parse "ask=4,get=4,list=2" into (operation, weight) pairs."""
+    mix = []
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r} in mix; use {', '.join(OPERATIONS)}")
+        mix.append((name, float(weight or 1)))
+    if not any(weight > 0 for _, weight in mix):
+        raise ValueError("The mix needs at least one operation with a positive weight")
+    return mix
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples: List[Tuple[str, float, bool]], elapsed: float) -> Dict:
+    """Throughput, error count and latency percentiles, overall and per operation."""
+    groups: Dict[str, List[Tuple[str, float, bool]]] = {"all": samples}
+    for sample in samples:
+        groups.setdefault(sample[0], []).append(sample)
+    report = {}
+    for name, group in groups.items():
+        latencies = sorted(latency for _, latency, _ in group)
+        report[name] = {
+            "requests": len(group),
+            "errors": sum(1 for _, _, ok in group if not ok),
+            "throughput": len(group) / elapsed if elapsed > 0 else 0.0,
+            **{f"p{pct}_ms": percentile(latencies, pct) * 1000 for pct in PERCENTILES},
+        }
+    return report
+
+
+class _User(threading.Thread):
+    """One closed-loop virtual user with its own cookie session and conversation."""
+
+    def __init__(self, index: int, url: str, mix: List[Tuple[str, float]],
+                 measure_from: float, stop_at: float, think_time: float,
+                 samples: List[Tuple[str, float, bool]]):
+        super().__init__(daemon=True)
+        self.index = index
+        self.client = httpx.Client(base_url=url, timeout=REQUEST_TIMEOUT)
+        self.operations = [name for name, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.measure_from = measure_from
+        self.stop_at = stop_at
+        self.think_time = think_time
+        self.samples = samples
+        self.random = random.Random(index)
+        self.conversation_id: Optional[str] = None
+        self.asked = 0
+
+    def run(self) -> None:
+        try:
+            response = self.client.post("/conversations/new")
+            if response.status_code == 200:
+                self.conversation_id = response.json()["conversation_id"]
+            while time.monotonic() < self.stop_at:
+                operation = self.random.choices(self.operations, self.weights)[0]
+                if operation != "list" and self.conversation_id is None:
+                    operation = "list"
+                started = time.monotonic()
+                ok = self._request(operation)
+                finished = time.monotonic()
+                if started >= self.measure_from and finished <= self.stop_at:
+                    self.samples.append((operation, finished - started, ok))
+                if self.think_time:
+                    time.sleep(self.random.expovariate(1 / self.think_time))
+        finally:
+            self.client.close()
+
+    def _request(self, operation: str) -> bool:
+        try:
+            if operation == "ask":
+                self.asked += 1
+                prompt = f"{self.random.choice(PROMPTS)} (user {self.index}, turn {self.asked})"
+                response = self.client.post(
+                    "/ask", json={"prompt": prompt, "conversation_id": self.conversation_id}
+                )
+            elif operation == "get":
+                response = self.client.get(f"/conversations/{self.conversation_id}")
+            else:
+                response = self.client.get("/conversations")
+            response.read()
+            return response.status_code < 400
+        except httpx.HTTPError:
+            return False
+
+
+def run_load(url: str, concurrency: int, duration: float, mix: List[Tuple[str, float]],
+             warmup: float = 0.0, think_time: float = 0.0) -> Dict:
+    """
+    Run `concurrency` virtual users against url for warmup + duration
+    seconds and summarize the requests made after the warm-up.
+    """
+    samples: List[Tuple[str, float, bool]] = []
+    started = time.monotonic()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+    users = [
+        _User(i, url, mix, measure_from, stop_at, think_time, samples)
+        for i in range(concurrency)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join(stop_at - time.monotonic() + REQUEST_TIMEOUT)
+    return summarize(samples, duration)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(config: str, port: int) -> List[str]:
+    kind, _, size = config.partition(":")
+    if kind == "flask":
+        return [sys.executable, "-m", "flask", "--app", "web_ui", "run",
+                "--port", str(port), "--with-threads"]
+    if kind == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port),
+                "--workers", size or "1", "--log-level", "warning"]
+    if kind == "gunicorn":
+        workers, _, threads = (size or "1x1").partition("x")
+        return [sys.executable, "-m", "gunicorn", "web_ui:app", "--bind", f"127.0.0.1:{port}",
+                "--workers", workers, "--threads", threads or "1", "--worker-class", "gthread"]
+    raise ValueError(f"Unknown server configuration {config!r}")
+
+
+def _wait_until_up(url: str, process: subprocess.Popen, log: Path) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}; see {log}")
+        try:
+            httpx.head(url, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start within {STARTUP_TIMEOUT:.0f}s; see {log}")
+
+
+def _start(command: List[str], url: str, workdir: Path, env: Dict, name: str) -> subprocess.Popen:
+    log = workdir / f"{name}.log"
+    with open(log, "wb") as out:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=out,
+                                   stderr=subprocess.STDOUT)
+    try:
+        _wait_until_up(url, process, log)
+    except RuntimeError:
+        _stop(process)
+        raise
+    return process
+
+
+def _stop(process: subprocess.Popen) -> None:
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_config(config: str, args: argparse.Namespace, mix: List[Tuple[str, float]]) -> Dict:
+    """Start the fake Gemini server and the web app for config, then load it."""
+    workdir = Path(tempfile.mkdtemp(prefix=f"load-{config.replace(':', '-')}-"))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(ROOT), env.get("PYTHONPATH")]))
+    processes = []
+    keep = args.keep_logs
+    try:
+        fake_port = _free_port()
+        fake_url = f"http://127.0.0.1:{fake_port}/"
+        processes.append(_start([
+            sys.executable, str(ROOT / "fake_gemini.py"), "--port", str(fake_port),
+            "--latency", str(args.latency), "--latency-sigma", str(args.latency_sigma),
+            "--tokens-per-second", str(args.tokens_per_second),
+            "--output-tokens", str(args.output_tokens), "--error-rate", str(args.error_rate),
+        ], fake_url, workdir, env, "fake_gemini"))
+
+        env.update({
+            "GEMINI_API_KEY": "fake-key",
+            "GEMINI_BASE_URL": fake_url,
+            "GEMINI_HTTP2": "false",
+            "FLASK_SECRET_KEY": "load-test",
+        })
+        port = _free_port()
+        url = f"http://127.0.0.1:{port}"
+        processes.append(_start(server_command(config, port), url, workdir, env, "server"))
+
+        print(f"Running {config}: {args.concurrency} users for {args.duration:.0f}s...", flush=True)
+        return run_load(url, args.concurrency, args.duration, mix, args.warmup, args.think_time)
+    except RuntimeError:
+        # The error points at a log in workdir
+        keep = True
+        raise
+    finally:
+        for process in reversed(processes):
+            _stop(process)
+        if keep:
+            print(f"Logs for {config} kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(config: str, report: Dict) -> None:
+    print(f"\n{config}")
+    print(f"  {'request':<8} {'count':>8} {'errors':>7} {'req/s':>9} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in ("all",) + OPERATIONS:
+        row = report.get(name)
+        if row is None:
+            continue
+        print(f"  {name:<8} {row['requests']:>8} {row['errors']:>7} {row['throughput']:>9.1f} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--configs", nargs="+", default=DEFAULT_CONFIGS,
+                        help="Server configurations to compare")
+    parser.add_argument("--url", help="Load an already running server instead")
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Unmeasured seconds first")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="Mean seconds a user waits between requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Request weights, e.g. ask=4,get=4,list=2")
+    parser.add_argument("--latency", type=float, default=0.5, help="Fake Gemini median latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--keep-logs", action="store_true", help="Keep server logs and stores")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    args = parser.parse_args(argv)
+    mix = parse_mix(args.mix)
+
+    reports = {}
+    if args.url:
+        reports[args.url] = run_load(
+            args.url, args.concurrency, args.duration, mix, args.warmup, args.think_time
+        )
+    else:
+        for config in args.configs:
+            try:
+                reports[config] = run_config(config, args, mix)
+            except RuntimeError as e:
+                print(f"Skipping {config}: {e}", file=sys.stderr)
+    for config, report in reports.items():
+        print_report(config, report)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": dict(mix),
+            "fake_gemini": None if args.url else {
+                "latency": args.latency, "latency_sigma": args.latency_sigma,
+                "tokens_per_second": args.tokens_per_second,
+                "output_tokens": args.output_tokens, "error_rate": args.error_rate,
+            },
+            "results": reports,
+        }, indent=2) + "\n", encoding="utf-8")
+    return 0 if reports else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,534 @@
+"""
+Retries, hedged requests and model fallback around Gemini calls.
+
+call() / call_async() run fn(model) under a CallPolicy:
+
+- Transient failures (408, 429, 5xx, timeouts, dropped connections) are
+  retried with exponential backoff and full jitter. A server-provided retry
+  delay (Retry-After header or a RetryInfo error detail) is honoured as the
+  minimum wait; if it is longer than max_retry_after the error is raised.
+- With hedging enabled, a second request is started when the first has not
+  answered after hedge_delay (by default the model's recent p95 latency).
+  Whichever answers first wins; the other is cancelled (async) or abandoned.
+  Synchronous calls hedge on a pool of HEDGE_WORKERS threads and go
+  unhedged while all of them are busy.
+- When the deadline is at risk, i.e. less time is left than the model's p95
+  latency or the last attempt timed out, remaining attempts (and hedges) go
+  to the cheaper fallback_model.
+
+Streams are opened with open_stream() / open_stream_async(): retries and
+fallback apply until the first chunk arrives, hedging does not.
+
+Every attempt is passed to listeners registered with add_attempt_listener()
+and, when a metadata dict is given, listed in metadata["attempts"] along with
+the model that answered in metadata["model"].
+"""
+import asyncio
+import contextvars
+import email.utils
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+# Latency samples kept per (operation, model), and needed before p95 is trusted
+LATENCY_WINDOW = int(os.getenv("GEMINI_LATENCY_WINDOW", "200"))
+LATENCY_MIN_SAMPLES = int(os.getenv("GEMINI_LATENCY_MIN_SAMPLES", "20"))
+
+# Threads running hedged synchronous requests, which bounds the requests in
+# flight from them (abandoned ones included). Defaults to two per admitted
+# call (primary and hedge) when GEMINI_MAX_CONCURRENCY is set.
+HEDGE_WORKERS = (
+    int(os.getenv("GEMINI_HEDGE_WORKERS", "0"))
+    or 2 * int(os.getenv("GEMINI_MAX_CONCURRENCY", "0"))
+    or 32
+)
+
+
+def _optional_float(name: str, default: Optional[str] = None) -> Optional[float]:
+    value = os.getenv(name, default)
+    return float(value) if value else None
+
+
+class CallPolicy(NamedTuple):
+    max_attempts: int = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+    base_delay: float = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+    max_delay: float = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8"))
+    # Give up instead of waiting longer than this for a server-requested delay
+    max_retry_after: float = float(os.getenv("GEMINI_MAX_RETRY_AFTER", "30"))
+    hedge: bool = os.getenv("GEMINI_HEDGE", "false").lower() == "true"
+    # Fixed hedge delay in seconds; None uses the model's latency quantile
+    hedge_delay: Optional[float] = _optional_float("GEMINI_HEDGE_DELAY")
+    hedge_quantile: float = float(os.getenv("GEMINI_HEDGE_QUANTILE", "0.95"))
+    fallback_model: Optional[str] = os.getenv("GEMINI_FALLBACK_MODEL", "gemini-2.5-flash-lite") or None
+    # Seconds from the first attempt; None disables deadline handling
+    deadline: Optional[float] = _optional_float("GEMINI_CALL_DEADLINE", "60")
+
+
+class Attempt(NamedTuple):
+    operation: str
+    model: str
+    kind: str  # "primary", "retry" or "hedge"
+    # "ok", "error", "cancelled", or "late" for an abandoned hedge that
+    # finished after the call had returned
+    outcome: str
+    seconds: float
+    status: Optional[int] = None
+    error: Optional[str] = None
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per (operation, model)."""
+
+    def __init__(self, window: int = LATENCY_WINDOW, min_samples: int = LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, model: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get((operation, model))
+            if samples is None:
+                samples = self._samples[(operation, model)] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def quantile(self, operation: str, model: str, q: float) -> Optional[float]:
+        """Return the q-quantile latency, or None until min_samples are recorded."""
+        with self._lock:
+            samples = sorted(self._samples.get((operation, model), ()))
+        if not samples or len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(q * (len(samples) - 1)))))
+        return samples[index]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+
+
+LATENCY = LatencyTracker()
+
+_attempt_listeners: List[Callable[[Attempt], None]] = []
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="gemini-hedge")
+# One per executor thread, so a submitted attempt never waits in its queue
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+def add_attempt_listener(listener: Callable[[Attempt], None]) -> None:
+    """Call listener(attempt) after every attempt, e.g. to export metrics."""
+    _attempt_listeners.append(listener)
+
+
+def remove_attempt_listener(listener: Callable[[Attempt], None]) -> None:
+    if listener in _attempt_listeners:
+        _attempt_listeners.remove(listener)
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """HTTP status carried by an SDK or httpx error, if any."""
+    if isinstance(error, genai_errors.APIError):
+        return error.code
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """True for errors worth retrying: throttling, server errors, timeouts, dropped connections."""
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (
+        httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError,
+        TimeoutError, ConnectionError,
+    ))
+
+
+def is_timeout(error: BaseException) -> bool:
+    return status_code(error) in (408, 504) or isinstance(
+        error, (httpx.TimeoutException, TimeoutError)
+    )
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    Server-requested delay in seconds, from a Retry-After header (seconds or
+    HTTP date) or a google.rpc.RetryInfo detail ("retryDelay": "13s").
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                when = None
+            if when is not None:
+                return max(0.0, when.timestamp() - time.time())
+
+    details = getattr(error, "details", None)
+    if isinstance(details, dict):
+        details = details.get("error", details)
+        details = details.get("details") if isinstance(details, dict) else None
+    for detail in details if isinstance(details, list) else ():
+        if not isinstance(detail, dict) or not str(detail.get("@type", "")).endswith("RetryInfo"):
+            continue
+        delay = str(detail.get("retryDelay", "")).rstrip("s")
+        try:
+            return max(0.0, float(delay))
+        except ValueError:
+            return None
+    return None
+
+
+def call(
+    fn: Callable[[str], Any],
+    model: str,
+    policy: Optional[CallPolicy] = None,
+    *,
+    operation: str = "generate",
+    metadata: Optional[Dict] = None,
+) -> Any:
+    """
+    Return fn(model) under the policy, retrying, hedging and falling back as
+    configured. The last error is raised once the policy gives up.
+    """
+    policy = policy or CallPolicy()
+    state = _CallState(operation, policy, metadata)
+    error: Optional[BaseException] = None
+    for number in range(1, policy.max_attempts + 1):
+        attempt_model = state.choose_model(model, error)
+        kind = "primary" if number == 1 else "retry"
+        try:
+            if policy.hedge:
+                result, attempt_model = _call_hedged(fn, attempt_model, kind, state)
+            else:
+                result = state.run(fn, attempt_model, kind)
+            state.finish(attempt_model)
+            return result
+        except Exception as e:
+            error = e
+            delay = state.retry_delay(e, number)
+            if delay is None:
+                raise
+            time.sleep(delay)
+    raise error
+
+
+async def call_async(
+    fn: Callable[[str], Awaitable[Any]],
+    model: str,
+    policy: Optional[CallPolicy] = None,
+    *,
+    operation: str = "generate",
+    metadata: Optional[Dict] = None,
+) -> Any:
+    """Asyncio variant of call(); losing hedged requests are cancelled."""
+    policy = policy or CallPolicy()
+    state = _CallState(operation, policy, metadata)
+    error: Optional[BaseException] = None
+    for number in range(1, policy.max_attempts + 1):
+        attempt_model = state.choose_model(model, error)
+        kind = "primary" if number == 1 else "retry"
+        try:
+            if policy.hedge:
+                result, attempt_model = await _call_hedged_async(fn, attempt_model, kind, state)
+            else:
+                result = await state.run_async(fn, attempt_model, kind)
+            state.finish(attempt_model)
+            return result
+        except Exception as e:
+            error = e
+            delay = state.retry_delay(e, number)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+    raise error
+
+
+def open_stream(
+    fn: Callable[[str], Any],
+    model: str,
+    policy: Optional[CallPolicy] = None,
+    *,
+    metadata: Optional[Dict] = None,
+):
+    """
+    Open fn(model)'s stream under the policy (without hedging) and return an
+    iterator over all of its chunks. Only failures before the first chunk are
+    retried; later ones propagate from the iterator.
+    """
+    def first_chunk(attempt_model: str):
+        chunks = iter(fn(attempt_model))
+        for chunk in chunks:
+            return itertools.chain([chunk], chunks)
+        return iter(())
+
+    policy = (policy or CallPolicy())._replace(hedge=False)
+    return call(first_chunk, model, policy, operation="stream", metadata=metadata)
+
+
+async def open_stream_async(
+    fn: Callable[[str], Awaitable[Any]],
+    model: str,
+    policy: Optional[CallPolicy] = None,
+    *,
+    metadata: Optional[Dict] = None,
+):
+    """Asyncio variant of open_stream(); fn(model) resolves to an async iterator."""
+    async def first_chunk(attempt_model: str):
+        chunks = (await fn(attempt_model)).__aiter__()
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            return _chain_async((), chunks)
+        return _chain_async((chunk,), chunks)
+
+    policy = (policy or CallPolicy())._replace(hedge=False)
+    return await call_async(first_chunk, model, policy, operation="stream", metadata=metadata)
+
+
+async def _chain_async(head, chunks):
+    for chunk in head:
+        yield chunk
+    async for chunk in chunks:
+        yield chunk
+
+
+class _CallState:
+    """Bookkeeping shared by the attempts of one call."""
+
+    def __init__(self, operation: str, policy: CallPolicy, metadata: Optional[Dict]):
+        self.operation = operation
+        self.policy = policy
+        self.metadata = metadata
+        self.started = time.monotonic()
+        self.fell_back = False
+        self.finished = False
+        self._lock = threading.Lock()
+        if metadata is not None:
+            metadata.setdefault("attempts", [])
+
+    def remaining(self) -> Optional[float]:
+        if self.policy.deadline is None:
+            return None
+        return self.policy.deadline - (time.monotonic() - self.started)
+
+    def choose_model(self, model: str, error: Optional[BaseException] = None) -> str:
+        """The requested model, or the fallback once the deadline is at risk."""
+        fallback = self.policy.fallback_model
+        if self.fell_back:
+            return fallback
+        if not fallback or fallback == model:
+            return model
+        remaining = self.remaining()
+        if remaining is None:
+            return model
+        expected = LATENCY.quantile(self.operation, model, 0.95)
+        at_risk = (
+            (expected is not None and remaining < expected)
+            or (error is not None and is_timeout(error))
+        )
+        if at_risk:
+            logger.warning(
+                "Deadline at risk for %s (%.1fs left), falling back to %s",
+                model, remaining, fallback,
+            )
+            self.fell_back = True
+            return fallback
+        return model
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        if self.policy.hedge_delay is not None:
+            return self.policy.hedge_delay
+        return LATENCY.quantile(self.operation, model, self.policy.hedge_quantile)
+
+    def retry_delay(self, error: BaseException, number: int) -> Optional[float]:
+        """Seconds to wait before the next attempt, or None to give up."""
+        if number >= self.policy.max_attempts or not is_retryable(error):
+            return None
+        requested = retry_after(error)
+        if requested is not None and requested > self.policy.max_retry_after:
+            logger.warning("Not retrying: server asked to wait %.1fs", requested)
+            return None
+        backoff = min(self.policy.max_delay, self.policy.base_delay * 2 ** (number - 1))
+        delay = max(random.uniform(0, backoff), requested or 0.0)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            logger.warning("Not retrying: %.1fs backoff exceeds the deadline", delay)
+            return None
+        logger.info(
+            "Retrying %s after %s (attempt %d/%d) in %.2fs",
+            self.operation, error, number + 1, self.policy.max_attempts, delay,
+        )
+        return delay
+
+    def run(self, fn: Callable[[str], Any], model: str, kind: str) -> Any:
+        started = time.monotonic()
+        try:
+            result = fn(model)
+        except Exception as e:
+            self.record(model, kind, "error", started, e)
+            raise
+        self.record(model, kind, "ok", started)
+        return result
+
+    async def run_async(self, fn: Callable[[str], Awaitable[Any]], model: str, kind: str) -> Any:
+        started = time.monotonic()
+        try:
+            result = await fn(model)
+        except asyncio.CancelledError:
+            self.record(model, kind, "cancelled", started)
+            raise
+        except Exception as e:
+            self.record(model, kind, "error", started, e)
+            raise
+        self.record(model, kind, "ok", started)
+        return result
+
+    def finish(self, model: str) -> None:
+        """Mark the call as answered by model; later attempts are recorded as late."""
+        with self._lock:
+            self.finished = True
+            if self.metadata is not None:
+                self.metadata["model"] = model
+
+    def record(
+        self, model: str, kind: str, outcome: str, started: float,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        seconds = time.monotonic() - started
+        if outcome == "ok":
+            # Abandoned hedges still count: they are the slow tail.
+            LATENCY.record(self.operation, model, seconds)
+        with self._lock:
+            late = self.finished
+            if late:
+                outcome = "late"
+            attempt = Attempt(
+                self.operation, model, kind, outcome, seconds,
+                status_code(error) if error is not None else None,
+                f"{type(error).__name__}: {error}" if error is not None else None,
+            )
+            if self.metadata is not None and not late:
+                self.metadata["attempts"].append(attempt._asdict())
+        for listener in list(_attempt_listeners):
+            try:
+                listener(attempt)
+            except Exception as e:
+                logger.warning("Attempt listener failed: %s", e)
+
+
+def _submit_hedged(fn: Callable[..., Any], *args) -> Optional[Future]:
+    """
+    Run fn(*args) on a hedge thread, in a copy of the caller's context, or
+    return None when every hedge thread is busy.
+    """
+    slots = _hedge_slots
+    if not slots.acquire(blocking=False):
+        return None
+    try:
+        future = _hedge_executor.submit(contextvars.copy_context().run, fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def _call_hedged(
+    fn: Callable[[str], Any], model: str, kind: str, state: _CallState
+) -> Tuple[Any, str]:
+    """Run fn with a hedge; return the first result and the model that produced it."""
+    delay = state.hedge_delay(model)
+    primary = _submit_hedged(state.run, fn, model, kind) if delay is not None else None
+    if primary is None:
+        return state.run(fn, model, kind), model
+
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result(), model
+
+    hedge_model = state.choose_model(model)
+    hedge = _submit_hedged(state.run, fn, hedge_model, "hedge")
+    if hedge is None:
+        logger.info("No answer from %s after %.2fs, but all hedge workers are busy", model, delay)
+        return primary.result(), model
+    logger.info("No answer from %s after %.2fs, hedging with %s", model, delay, hedge_model)
+    models = {primary: model, hedge: hedge_model}
+    pending = {primary, hedge}
+    errors = []
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            for loser in pending:
+                # A running request can't be interrupted; its result is ignored.
+                loser.cancel()
+            return result, models[future]
+    raise errors[0]
+
+
+async def _call_hedged_async(
+    fn: Callable[[str], Awaitable[Any]], model: str, kind: str, state: _CallState
+) -> Tuple[Any, str]:
+    delay = state.hedge_delay(model)
+    if delay is None:
+        return await state.run_async(fn, model, kind), model
+
+    primary = asyncio.ensure_future(state.run_async(fn, model, kind))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+    except asyncio.CancelledError:
+        primary.cancel()
+        raise
+    if done:
+        return primary.result(), model
+
+    hedge_model = state.choose_model(model)
+    logger.info("No answer from %s after %.2fs, hedging with %s", model, delay, hedge_model)
+    hedge = asyncio.ensure_future(state.run_async(fn, hedge_model, "hedge"))
+    models = {primary: model, hedge: hedge_model}
+    pending = {primary, hedge}
+    errors = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+                return task.result(), models[task]
+        raise errors[0]
+    finally:
+        for loser in pending:
+            loser.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
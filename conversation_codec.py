@@ -0,0 +1,115 @@
+"""
+Serialization of stored conversations.
+
+JSON is encoded with orjson when it is installed, several times faster than
+the standard library on long conversations, and with the json module
+otherwise. Both write compact output (no indentation or spaces).
+
+Snapshots of at least CONVERSATION_COMPRESS_MIN_BYTES can also be compressed
+by setting CONVERSATION_COMPRESSION to "gzip" or "zstd" (the latter needs the
+zstandard package). Compressed snapshots keep their .json name: decode()
+recognizes the format from the data's magic bytes, so compressed, compact and
+older indented files can sit side by side and nothing has to be renamed or
+converted when the settings change. Run
+`python conversation_manager.py repack` to rewrite every conversation in the
+current format.
+"""
+import gzip
+import json
+import logging
+import os
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # optional: the standard library encoder is used instead
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # optional: needed only for CONVERSATION_COMPRESSION=zstd
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Compression for conversation snapshots: "none", "gzip" or "zstd"
+CONVERSATION_COMPRESSION = os.getenv("CONVERSATION_COMPRESSION", "none").strip().lower()
+# Snapshots smaller than this are stored as plain JSON even when compression is on
+CONVERSATION_COMPRESS_MIN_BYTES = int(os.getenv("CONVERSATION_COMPRESS_MIN_BYTES", str(64 * 1024)))
+
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_warned_zstd_missing = False
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact UTF-8 JSON."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # orjson rejects a few things json accepts (e.g. integers beyond
+            # 64 bits, non-string keys); let the standard library have a go.
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """Parse JSON text; raises ValueError if it is invalid."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def compression() -> str:
+    """The compression applied to large snapshots: "none", "gzip" or "zstd"."""
+    global _warned_zstd_missing
+    if CONVERSATION_COMPRESSION == "zstd" and zstandard is None:
+        if not _warned_zstd_missing:
+            logger.warning("CONVERSATION_COMPRESSION=zstd needs the zstandard package; using gzip")
+            _warned_zstd_missing = True
+        return "gzip"
+    if CONVERSATION_COMPRESSION in ("gzip", "zstd"):
+        return CONVERSATION_COMPRESSION
+    return "none"
+
+
+def encode(obj: Any) -> bytes:
+    """Serialize a record for storage, compressed if configured and large enough."""
+    data = dumps(obj)
+    if len(data) < CONVERSATION_COMPRESS_MIN_BYTES:
+        return data
+    method = compression()
+    if method == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if method == "gzip":
+        # mtime=0 keeps the output a pure function of the record
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return data
+
+
+def decode(data: bytes) -> Any:
+    """Parse a record written by encode(), or by any earlier JSON writer."""
+    return loads(decompress(data))
+
+
+def decompress(data: bytes) -> bytes:
+    """The JSON text inside data, whichever format it was stored in."""
+    if data.startswith(GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Reading zstd-compressed conversations needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
@@ -1,11 +1,30 @@
+import argparse
+import asyncio
+import base64
+import binascii
 import json
 import logging
 import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Hashable, List, Optional, Tuple
 from uuid import uuid4
 
+import metrics
+import tracing
+from conversation_search import SearchHit, SearchIndex
+from conversation_store import (
+    ConversationConflictError,
+    ConversationStore,
+    JsonFileStore,
+    SQLiteStore,
+    message_page,
+    migrate,
+)
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -19,51 +38,286 @@ logger.addHandler(_console)
 CONVERSATIONS_DIR = Path("conversations")
 CONVERSATIONS_DIR.mkdir(exist_ok=True)
 
+# Storage backend: "json" (files in CONVERSATIONS_DIR) or "sqlite"
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "json").strip().lower()
+# SQLite database path; defaults to conversations.db inside CONVERSATIONS_DIR
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH")
+
+# Full-text search index; defaults to search.db inside CONVERSATIONS_DIR
+CONVERSATION_SEARCH = os.getenv("CONVERSATION_SEARCH", "true").lower() == "true"
+CONVERSATION_SEARCH_DB_PATH = os.getenv("CONVERSATION_SEARCH_DB_PATH")
+
+# Bounds for the in-process cache of loaded conversations
+CONVERSATION_CACHE_MAX_ENTRIES = int(os.getenv("CONVERSATION_CACHE_MAX_ENTRIES", "256"))
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv("CONVERSATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_stores: Dict[Tuple[str, Path], ConversationStore] = {}
+_search_indexes: Dict[Path, SearchIndex] = {}
+_stores_lock = threading.Lock()
+
+
+def _db_path() -> Path:
+    return Path(CONVERSATION_DB_PATH) if CONVERSATION_DB_PATH else CONVERSATIONS_DIR / "conversations.db"
+
+
+def _make_store(backend: str) -> Tuple[Tuple[str, Path], ConversationStore]:
+    if backend == "sqlite":
+        key = ("sqlite", _db_path())
+        return key, _stores.get(key) or SQLiteStore(key[1])
+    if backend == "json":
+        key = ("json", CONVERSATIONS_DIR)
+        return key, _stores.get(key) or JsonFileStore(key[1])
+    raise ValueError(f"Unknown conversation store backend: {backend!r}")
+
+
+def get_store(backend: Optional[str] = None) -> ConversationStore:
+    """
+    Return the process-wide store for the configured backend. Stores are keyed
+    by backend and location, so changing CONVERSATIONS_DIR yields a new one.
+    """
+    with _stores_lock:
+        key, store = _make_store(backend or CONVERSATION_STORE)
+        _stores[key] = store
+        return store
+
+
+@contextmanager
+def _timed(store, operation: str):
+    """
+    Time a store (or search index) operation into the store latency
+    histogram and the request trace.
+    """
+    with tracing.span(f"store.{operation}"), \
+            metrics.STORE_OPERATION_SECONDS.time(store=type(store).__name__, operation=operation):
+        yield
+
+
+def get_search_index() -> Optional[SearchIndex]:
+    """The process-wide search index, or None when CONVERSATION_SEARCH is off."""
+    if not CONVERSATION_SEARCH:
+        return None
+    path = (
+        Path(CONVERSATION_SEARCH_DB_PATH) if CONVERSATION_SEARCH_DB_PATH
+        else CONVERSATIONS_DIR / "search.db"
+    )
+    with _stores_lock:
+        index = _search_indexes.get(path)
+        if index is None:
+            index = _search_indexes[path] = SearchIndex(path)
+        return index
+
+
+def _update_search_index(operation: str, conversation_id: str, *args) -> None:
+    """
+    Apply a write to the search index. The index is derived data, so a
+    failure is logged rather than failing the write; rebuild-search-index
+    brings it back in line.
+    """
+    try:
+        index = get_search_index()
+        if index is None:
+            return
+        with _timed(index, f"search_{operation}"):
+            getattr(index, operation)(*args)
+    except Exception as e:
+        logger.error(f"Failed to update search index for conversation {conversation_id}: {e}")
+
+
+def _encode_cursor(entry: Dict) -> str:
+    """Opaque listing cursor for the page that follows entry."""
+    key = json.dumps([entry.get("updated_at") or "", entry["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    """The (updated_at, id) key in a cursor; ValueError if it is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    if not (isinstance(key, list) and len(key) == 2 and all(isinstance(k, str) for k in key)):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return key[0], key[1]
+
+
+def _copy_conversation(conversation: Dict) -> Dict:
+    """Copy deep enough that callers can append to or edit messages freely."""
+    copied = dict(conversation)
+    copied["messages"] = [dict(m) for m in conversation.get("messages", [])]
+    return copied
+
+
+def _approximate_size(conversation: Dict) -> int:
+    """Rough in-memory footprint: message text plus a fixed per-message overhead."""
+    return 512 + sum(
+        len(m.get("content", "")) + 128 for m in conversation.get("messages", [])
+    )
+
+
+class ConversationCache:
+    """
+    Bounded LRU cache of loaded conversations.
+
+    Entries are keyed by (store, conversation id) and remember the store's
+    version stamp at load time. Every lookup re-checks the stamp (a stat() or
+    a single-row query), so writes from other processes invalidate the entry
+    and multi-worker deployments never serve stale conversations.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[Hashable, Dict, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, store: ConversationStore, conversation_id: str) -> Optional[Dict]:
+        """Return a copy of the cached conversation if it is still current."""
+        key = (id(store), conversation_id)
+        with self._lock:
+            cached = self._entries.get(key)
+        if cached is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        stamp = store.version(conversation_id)
+        with self._lock:
+            if self._entries.get(key) is not cached:
+                self.misses += 1
+                return None
+            if stamp != cached[0]:
+                self._drop(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return _copy_conversation(cached[1])
+
+    def put(self, store: ConversationStore, conversation_id: str,
+            stamp: Optional[Hashable], conversation: Dict) -> None:
+        if stamp is None:
+            return
+        key = (id(store), conversation_id)
+        size = _approximate_size(conversation)
+        with self._lock:
+            self._drop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (stamp, _copy_conversation(conversation), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, store: ConversationStore, conversation_id: str) -> None:
+        with self._lock:
+            self._drop((id(store), conversation_id))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+    def _drop(self, key: Tuple[int, str]) -> None:
+        cached = self._entries.pop(key, None)
+        if cached is not None:
+            self._bytes -= cached[2]
+
+
+_cache = ConversationCache(CONVERSATION_CACHE_MAX_ENTRIES, CONVERSATION_CACHE_MAX_BYTES)
+
 
 class ConversationManager:
-    """Manages conversation storage and retrieval."""
+    """Manages conversation storage and retrieval through the configured store."""
 
     @staticmethod
-    def create_conversation() -> str:
-        """Create a new conversation and return its ID."""
-        conversation_id = str(uuid4())
+    def create_conversation(conversation_id: Optional[str] = None) -> str:
+        """
+        Create a new conversation and return its ID. When conversation_id is
+        given and that conversation already exists it is left untouched, so
+        callers deriving the ID from a request can create it on every retry.
+        """
         conversation = {
-            "id": conversation_id,
+            "id": conversation_id or str(uuid4()),
             "created_at": datetime.now().isoformat(),
             "updated_at": datetime.now().isoformat(),
             "messages": []
         }
-        ConversationManager.save_conversation(conversation)
-        logger.info(f"Created new conversation: {conversation_id}")
-        return conversation_id
+        if conversation_id is None:
+            ConversationManager.save_conversation(conversation)
+        else:
+            store = get_store()
+            with store.lock(conversation_id):
+                if store.exists(conversation_id):
+                    return conversation_id
+                ConversationManager.save_conversation(conversation)
+        logger.info(f"Created new conversation: {conversation['id']}")
+        return conversation["id"]
 
     @staticmethod
-    def save_conversation(conversation: Dict) -> None:
-        """Save a conversation to disk."""
+    def save_conversation(conversation: Dict, expected_version: Optional[Hashable] = None) -> None:
+        """
+        Save a full conversation, replacing any stored messages.
+
+        Pass the conversation_version() read before loading it as
+        expected_version to save only if nobody has written it since;
+        ConversationConflictError is raised otherwise.
+        """
         conversation_id = conversation["id"]
         conversation["updated_at"] = datetime.now().isoformat()
-        file_path = CONVERSATIONS_DIR / f"{conversation_id}.json"
         
+        store = get_store()
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(conversation, f, indent=2, ensure_ascii=False)
+            _cache.invalidate(store, conversation_id)
+            with _timed(store, "save"):
+                store.save(conversation, expected_version)
             logger.debug(f"Saved conversation {conversation_id}")
+            _update_search_index("replace", conversation_id, conversation)
+        except ConversationConflictError as e:
+            logger.warning(str(e))
+            raise
         except Exception as e:
             logger.error(f"Failed to save conversation {conversation_id}: {e}")
             raise
 
     @staticmethod
     def load_conversation(conversation_id: str) -> Optional[Dict]:
-        """Load a conversation by ID."""
-        file_path = CONVERSATIONS_DIR / f"{conversation_id}.json"
-        
-        if not file_path.exists():
-            logger.warning(f"Conversation {conversation_id} not found")
-            return None
-        
+        """Load a conversation by ID, served from the cache while it is current."""
+        store = get_store()
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                conversation = json.load(f)
+            with tracing.span("store.cache_lookup"):
+                conversation = _cache.get(store, conversation_id)
+            if conversation is not None:
+                return conversation
+
+            # Stamp before reading: a concurrent write then makes the entry
+            # look stale (and get reloaded) rather than look current.
+            stamp = store.version(conversation_id)
+            with _timed(store, "load"):
+                conversation = store.load(conversation_id)
+            if conversation is None:
+                logger.warning(f"Conversation {conversation_id} not found")
+                return None
+            _cache.put(store, conversation_id, stamp, conversation)
             logger.debug(f"Loaded conversation {conversation_id}")
             return conversation
         except Exception as e:
@@ -71,43 +325,98 @@ class ConversationManager:
             return None
 
     @staticmethod
-    def list_conversations() -> List[Dict]:
-        """List all conversations with metadata."""
-        conversations = []
-        
-        if not CONVERSATIONS_DIR.exists():
-            return conversations
-        
-        for file_path in CONVERSATIONS_DIR.glob("*.json"):
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    conversation = json.load(f)
-                    # Return only metadata, not full messages
-                    conversations.append({
-                        "id": conversation["id"],
-                        "created_at": conversation.get("created_at"),
-                        "updated_at": conversation.get("updated_at"),
-                        "message_count": len(conversation.get("messages", []))
-                    })
-            except Exception as e:
-                logger.warning(f"Failed to read conversation file {file_path}: {e}")
-        
-        # Sort by updated_at, most recent first
-        conversations.sort(key=lambda x: x.get("updated_at", ""), reverse=True)
-        return conversations
+    def load_messages(
+        conversation_id: str, before: Optional[int] = None, limit: Optional[int] = None
+    ) -> Optional[Dict]:
+        """
+        Load a conversation with only one page of its messages: the `limit`
+        messages before index `before` (default: the newest). The record
+        also carries "message_count" and "messages_start"; pass the latter as
+        `before` to get the next older page. Returns None if it doesn't exist.
+
+        Served from the cache when possible. Stores that can read a range of
+        messages (SQLite) are asked for just the page; for the others the full
+        conversation is loaded (and cached) and the page is cut from it.
+        """
+        store = get_store()
+        try:
+            if not store.partial_loads:
+                conversation = ConversationManager.load_conversation(conversation_id)
+                return None if conversation is None else message_page(conversation, before, limit)
+
+            with tracing.span("store.cache_lookup"):
+                conversation = _cache.get(store, conversation_id)
+            if conversation is not None:
+                return message_page(conversation, before, limit)
+            with _timed(store, "load_page"):
+                page = store.load_page(conversation_id, before, limit)
+            if page is None:
+                logger.warning(f"Conversation {conversation_id} not found")
+            return page
+        except Exception as e:
+            logger.error(f"Failed to load conversation {conversation_id}: {e}")
+            return None
+
+    @staticmethod
+    def conversation_version(conversation_id: str) -> Optional[Hashable]:
+        """
+        Return the conversation's current version stamp (None if it doesn't
+        exist), for use as expected_version in a later conditional write.
+        """
+        return get_store().version(conversation_id)
+
+    @staticmethod
+    def list_conversations(limit: Optional[int] = None) -> List[Dict]:
+        """
+        List conversations with metadata, most recently updated first.
+
+        Served from the store's metadata index, so no message data is read.
+        When limit is given only the newest `limit` entries are returned.
+        """
+        store = get_store()
+        with _timed(store, "list"):
+            return store.list_conversations(limit)
+
+    @staticmethod
+    def list_conversations_page(
+        limit: int, cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Return up to `limit` index entries following `cursor` (from the start
+        when None) and the cursor for the next page, or None on the last page.
+
+        Pages are keyed on (updated_at, id) rather than offsets, so every page
+        costs an index seek, and new or updated conversations (which move to
+        the top) don't shift the pages still to come. Raises ValueError for a
+        malformed cursor.
+        """
+        after = _decode_cursor(cursor) if cursor else None
+        store = get_store()
+        with _timed(store, "list"):
+            entries = store.list_conversations(limit + 1, after)
+        if len(entries) <= limit:
+            return entries, None
+        entries = entries[:limit]
+        return entries, _encode_cursor(entries[-1])
+
+    @staticmethod
+    def rebuild_index() -> int:
+        """Rebuild the store's metadata index from the stored conversations."""
+        return get_store().rebuild_index()
 
     @staticmethod
     def delete_conversation(conversation_id: str) -> bool:
         """Delete a conversation by ID."""
-        file_path = CONVERSATIONS_DIR / f"{conversation_id}.json"
-        
-        if not file_path.exists():
-            logger.warning(f"Conversation {conversation_id} not found for deletion")
-            return False
-        
+        store = get_store()
+        _cache.invalidate(store, conversation_id)
         try:
-            file_path.unlink()
+            with _timed(store, "delete"):
+                deleted = store.delete(conversation_id)
+            if not deleted:
+                logger.warning(f"Conversation {conversation_id} not found for deletion")
+                return False
             logger.info(f"Deleted conversation {conversation_id}")
+            _update_search_index("remove", conversation_id, conversation_id)
             return True
         except Exception as e:
             logger.error(f"Failed to delete conversation {conversation_id}: {e}")
@@ -116,16 +425,224 @@ class ConversationManager:
     @staticmethod
     def add_message(conversation_id: str, role: str, content: str) -> Optional[Dict]:
         """Add a message to a conversation."""
-        conversation = ConversationManager.load_conversation(conversation_id)
-        if not conversation:
+        return ConversationManager.add_messages(
+            conversation_id, [{"role": role, "content": content}]
+        )
+
+    @staticmethod
+    def add_messages(conversation_id: str, messages: List[Dict]) -> Optional[Dict]:
+        """
+        Append several messages to a conversation in a single atomic write.
+
+        Each message needs "role" and "content"; a timestamp is added when
+        missing and any other keys are stored as-is. Returns the updated
+        conversation, or None if it doesn't exist.
+        """
+        now = datetime.now().isoformat()
+        stamped = []
+        for message in messages:
+            message = dict(message)
+            message.setdefault("timestamp", now)
+            stamped.append(message)
+
+        store = get_store()
+        try:
+            # Under the lock nobody else can write between validating the cached
+            # copy, appending to it and stamping the result.
+            with _timed(store, "add_messages"), store.lock(conversation_id):
+                current = _cache.get(store, conversation_id)
+                _cache.invalidate(store, conversation_id)
+                conversation = store.add_messages(conversation_id, stamped, current=current)
+                if conversation is not None:
+                    _cache.put(store, conversation_id, store.version(conversation_id), conversation)
+        except Exception as e:
+            logger.error(f"Failed to add messages to conversation {conversation_id}: {e}")
+            raise
+        if conversation is None:
+            logger.warning(f"Conversation {conversation_id} not found")
             return None
-        
-        conversation["messages"].append({
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
-        
-        ConversationManager.save_conversation(conversation)
+        _update_search_index(
+            "add_messages", conversation_id, conversation_id,
+            len(conversation["messages"]) - len(stamped), stamped, conversation.get("updated_at"),
+        )
         return conversation
 
+    @staticmethod
+    def update_fields(
+        conversation_id: str, fields: Dict, expected_version: Optional[Hashable] = None
+    ) -> bool:
+        """
+        Set top-level conversation fields (e.g. "summary") without rewriting
+        messages or changing updated_at. Returns False if it doesn't exist.
+        expected_version works as in save_conversation().
+        """
+        reserved = {"id", "messages", "created_at", "updated_at"} & fields.keys()
+        if reserved:
+            raise ValueError(f"Cannot update reserved fields: {sorted(reserved)}")
+        store = get_store()
+        try:
+            _cache.invalidate(store, conversation_id)
+            with _timed(store, "update_fields"):
+                return store.update_fields(conversation_id, fields, expected_version)
+        except ConversationConflictError as e:
+            logger.warning(str(e))
+            raise
+        except Exception as e:
+            logger.error(f"Failed to update conversation {conversation_id}: {e}")
+            raise
+
+    @staticmethod
+    def search_conversations(
+        query: str, limit: int = 20, role: Optional[str] = None
+    ) -> List[SearchHit]:
+        """
+        Full-text search over every message: up to `limit` conversations whose
+        messages contain all of the query's words and "phrases", best match
+        first. `role` ("user" or "assistant") restricts which messages count.
+        Returns [] when search is disabled.
+        """
+        index = get_search_index()
+        if index is None:
+            return []
+        with _timed(index, "search"):
+            return index.search(query, limit, role)
+
+    @staticmethod
+    def rebuild_search_index() -> int:
+        """Rebuild the search index from every stored conversation."""
+        index = get_search_index()
+        if index is None:
+            raise RuntimeError("Search is disabled (CONVERSATION_SEARCH=false)")
+        store = get_store()
+        conversations = (
+            store.load(entry["id"]) for entry in store.list_conversations()
+        )
+        return index.rebuild(c for c in conversations if c is not None)
+
+    @staticmethod
+    def cache_stats() -> Dict:
+        """Hit/miss/eviction counters and current size of the conversation cache."""
+        return _cache.stats()
+
+    @staticmethod
+    def compact_conversation(conversation_id: str) -> bool:
+        """Fold a conversation's incremental writes into its base record."""
+        store = get_store()
+        _cache.invalidate(store, conversation_id)
+        return store.compact(conversation_id)
+
+    @staticmethod
+    def repack_conversation(conversation_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Rewrite a conversation in the current serialization format (compact
+        JSON, compressed when configured). Returns its size in bytes before
+        and after, or None when there is nothing to rewrite.
+        """
+        store = get_store()
+        _cache.invalidate(store, conversation_id)
+        with _timed(store, "repack"):
+            return store.repack(conversation_id)
+
+    @staticmethod
+    def migrate_store(source_backend: str, target_backend: str) -> int:
+        """Copy every conversation from one backend to another."""
+        return migrate(get_store(source_backend), get_store(target_backend))
+
+    # Async variants for the ASGI app. File I/O is offloaded to the default
+    # thread pool so the event loop never blocks on disk.
+
+    @staticmethod
+    async def create_conversation_async(conversation_id: Optional[str] = None) -> str:
+        """Async variant of create_conversation."""
+        if conversation_id is None:
+            return await asyncio.to_thread(ConversationManager.create_conversation)
+        return await asyncio.to_thread(ConversationManager.create_conversation, conversation_id)
+
+    @staticmethod
+    async def save_conversation_async(
+        conversation: Dict, expected_version: Optional[Hashable] = None
+    ) -> None:
+        """Async variant of save_conversation."""
+        await asyncio.to_thread(ConversationManager.save_conversation, conversation, expected_version)
+
+    @staticmethod
+    async def load_conversation_async(conversation_id: str) -> Optional[Dict]:
+        """Async variant of load_conversation."""
+        return await asyncio.to_thread(ConversationManager.load_conversation, conversation_id)
+
+    @staticmethod
+    async def list_conversations_async() -> List[Dict]:
+        """Async variant of list_conversations."""
+        return await asyncio.to_thread(ConversationManager.list_conversations)
+
+    @staticmethod
+    async def delete_conversation_async(conversation_id: str) -> bool:
+        """Async variant of delete_conversation."""
+        return await asyncio.to_thread(ConversationManager.delete_conversation, conversation_id)
+
+    @staticmethod
+    async def add_message_async(conversation_id: str, role: str, content: str) -> Optional[Dict]:
+        """Async variant of add_message."""
+        return await asyncio.to_thread(
+            ConversationManager.add_message, conversation_id, role, content
+        )
+
+    @staticmethod
+    async def add_messages_async(conversation_id: str, messages: List[Dict]) -> Optional[Dict]:
+        """Async variant of add_messages."""
+        return await asyncio.to_thread(
+            ConversationManager.add_messages, conversation_id, messages
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Maintenance commands for the conversation store."""
+    parser = argparse.ArgumentParser(description="Conversation store maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild-index", help="Rebuild the metadata index from disk")
+    commands.add_parser("compact", help="Fold every message log into its snapshot")
+    commands.add_parser("rebuild-search-index", help="Rebuild the full-text search index")
+    commands.add_parser(
+        "repack", help="Rewrite every conversation in the current (compact/compressed) format"
+    )
+    migrate_parser = commands.add_parser(
+        "migrate", help="Copy all conversations from one backend to another"
+    )
+    migrate_parser.add_argument("--from", dest="source", default="json", choices=["json", "sqlite"])
+    migrate_parser.add_argument("--to", dest="target", default="sqlite", choices=["json", "sqlite"])
+    args = parser.parse_args(argv)
+
+    if args.command == "rebuild-index":
+        count = ConversationManager.rebuild_index()
+        print(f"Indexed {count} conversations")
+    elif args.command == "rebuild-search-index":
+        count = ConversationManager.rebuild_search_index()
+        print(f"Indexed {count} conversations for search")
+    elif args.command == "compact":
+        compacted = sum(
+            ConversationManager.compact_conversation(entry["id"])
+            for entry in ConversationManager.list_conversations()
+        )
+        print(f"Compacted {compacted} conversations")
+    elif args.command == "repack":
+        repacked = before_total = after_total = 0
+        for entry in ConversationManager.list_conversations():
+            sizes = ConversationManager.repack_conversation(entry["id"])
+            if sizes is None:
+                continue
+            repacked += 1
+            before_total += sizes[0]
+            after_total += sizes[1]
+        if repacked:
+            print(f"Repacked {repacked} conversations: {before_total} -> {after_total} bytes")
+        else:
+            print("Nothing to repack")
+    elif args.command == "migrate":
+        if args.source == args.target:
+            parser.error("--from and --to must differ")
+        count = ConversationManager.migrate_store(args.source, args.target)
+        print(f"Migrated {count} conversations from {args.source} to {args.target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Full-text search over conversation history.
+
+SearchIndex keeps an SQLite FTS5 inverted index of every message, in its own
+database next to the conversations (whichever store backend holds them).
+ConversationManager updates it incrementally as messages are added and
+conversations are saved or deleted, so a search never reads conversation
+files. `python conversation_manager.py rebuild-search-index` builds it from
+scratch, e.g. for conversations stored before search existed.
+
+A query is a list of words and "quoted phrases" that must all match; a word
+ending in * matches any word with that prefix. Results are ranked by BM25,
+one per conversation (its best-matching message), with a snippet around the
+matched terms. Queries matching very many messages rank only the most recent
+SEARCH_RANK_CANDIDATES of them.
+"""
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from conversation_store import TITLE_MAX_CHARS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Words of context around the matched terms in a result snippet
+SNIPPET_TOKENS = int(os.getenv("SEARCH_SNIPPET_TOKENS", "16"))
+# Most matching messages ranked per query. BM25 must score every match, so
+# for queries matching more than this only the most recent ones are ranked,
+# which keeps common words and short prefixes fast on large histories.
+SEARCH_RANK_CANDIDATES = int(os.getenv("SEARCH_RANK_CANDIDATES", "5000"))
+
+# Private-use markers for matched terms; replaced with <mark> after escaping
+_MATCH_START = "\ue000"
+_MATCH_END = "\ue001"
+
+# A "quoted phrase" or a run of non-space characters
+_QUERY_TOKEN = re.compile(r'"([^"]*)"?|(\S+)')
+
+_SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_conversations (
+    id TEXT PRIMARY KEY,
+    updated_at TEXT,
+    title TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS search_messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    UNIQUE (conversation_id, seq)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    content,
+    content = 'search_messages',
+    content_rowid = 'id',
+    prefix = '2 3',
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS search_messages_insert AFTER INSERT ON search_messages BEGIN
+    INSERT INTO search_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS search_messages_delete AFTER DELETE ON search_messages BEGIN
+    INSERT INTO search_fts (search_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+
+class SearchHit(NamedTuple):
+    conversation_id: str
+    title: str
+    updated_at: Optional[str]
+    message_index: int
+    role: str
+    snippet: str  # HTML-escaped, matched terms wrapped in <mark>
+    score: float  # BM25; lower is better
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    Translate a user query into an FTS5 MATCH expression, or None if it has
+    no searchable terms. Every term is quoted, so FTS5 operators and
+    punctuation in the input are searched for rather than interpreted.
+    """
+    terms = []
+    for match in _QUERY_TOKEN.finditer(query):
+        phrase, word = match.groups()
+        text = phrase if phrase is not None else word
+        prefix = word is not None and word.endswith("*")
+        text = text.rstrip("*") if prefix else text
+        if not re.search(r"\w", text):
+            continue
+        quoted = '"' + text.replace('"', '""') + '"'
+        terms.append(quoted + "*" if prefix else quoted)
+    return " ".join(terms) if terms else None
+
+
+def _title(messages: Iterable[Dict]) -> str:
+    """The conversation title as listed in the sidebar: its first user message."""
+    text = next((m.get("content", "") for m in messages if m.get("role") == "user"), "")
+    text = " ".join(text.split())
+    return text if len(text) <= TITLE_MAX_CHARS else text[:TITLE_MAX_CHARS - 1].rstrip() + "…"
+
+
+def _render_snippet(snippet: str) -> str:
+    return html.escape(snippet).replace(_MATCH_START, "<mark>").replace(_MATCH_END, "</mark>")
+
+
+class SearchIndex:
+    """
+    FTS5 index of conversation messages in an SQLite database (WAL mode, so
+    searches don't block updates from other workers). Each thread (and each
+    forked process) gets its own connection.
+    """
+
+    def __init__(self, path: Path, timeout: float = 30.0):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connect().executescript(_SEARCH_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def add_messages(self, conversation_id: str, start: int, messages: List[Dict],
+                     updated_at: Optional[str] = None) -> None:
+        """
+        Index messages appended to a conversation, the first of them at index
+        start. Messages already indexed at those indexes are replaced, so
+        re-indexing the same append is harmless, and appends from several
+        workers can be indexed in any order.
+        """
+        with self._transaction() as conn:
+            self._upsert_conversation(conn, conversation_id, updated_at, _title(messages))
+            conn.execute(
+                "DELETE FROM search_messages WHERE conversation_id = ? AND seq >= ? AND seq < ?",
+                (conversation_id, start, start + len(messages)),
+            )
+            self._insert_messages(conn, conversation_id, start, messages)
+
+    def replace(self, conversation: Dict) -> None:
+        """Index a full conversation record, replacing what was indexed for it."""
+        with self._transaction() as conn:
+            self._replace(conn, conversation)
+
+    def remove(self, conversation_id: str) -> None:
+        """Drop a conversation from the index."""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM search_messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM search_conversations WHERE id = ?", (conversation_id,))
+
+    def rebuild(self, conversations: Iterable[Dict]) -> int:
+        """Replace the whole index with the given conversations; return how many."""
+        count = 0
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM search_messages")
+            conn.execute("DELETE FROM search_conversations")
+            for conversation in conversations:
+                self._replace(conn, conversation)
+                count += 1
+            # Merge the index segments written above into one
+            conn.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+        logger.info("Rebuilt search index with %d conversations", count)
+        return count
+
+    def search(self, query: str, limit: int = 20, role: Optional[str] = None) -> List[SearchHit]:
+        """
+        Return up to limit conversations matching query, best first, each
+        with its best-matching message. role restricts matches to messages
+        from "user" or "assistant".
+        """
+        match = build_match_query(query)
+        if match is None or limit <= 0:
+            return []
+        sql = (
+            "SELECT m.conversation_id, m.seq, m.role, c.title, c.updated_at, "
+            "snippet(search_fts, 0, ?, ?, '…', ?) AS snippet, search_fts.rank AS score "
+            "FROM search_fts "
+            "JOIN search_messages m ON m.id = search_fts.rowid "
+            "LEFT JOIN search_conversations c ON c.id = m.conversation_id "
+            "WHERE search_fts MATCH ?"
+        )
+        params = [_MATCH_START, _MATCH_END, SNIPPET_TOKENS, match]
+        conn = self._connect()
+        # Rowids grow with insertion, so the newest candidates are those at or
+        # above the Nth-newest match (of the requested role); finding it needs
+        # no ranking.
+        floor_sql = "SELECT search_fts.rowid FROM search_fts"
+        floor_params: List = [match]
+        role_filter = ""
+        if role:
+            floor_sql += " JOIN search_messages m ON m.id = search_fts.rowid"
+            role_filter = " AND m.role = ?"
+            floor_params.append(role)
+        floor = conn.execute(
+            floor_sql + " WHERE search_fts MATCH ?" + role_filter
+            + " ORDER BY search_fts.rowid DESC LIMIT 1 OFFSET ?",
+            floor_params + [max(0, SEARCH_RANK_CANDIDATES - 1)],
+        ).fetchone()
+        if floor is not None:
+            sql += " AND search_fts.rowid >= ?"
+            params.append(floor[0])
+        if role:
+            sql += role_filter
+            params.append(role)
+        sql += " ORDER BY search_fts.rank LIMIT ? OFFSET ?"
+
+        # Rank messages and keep the first (best) one per conversation. A
+        # conversation usually matches in a few messages, so fetch a few
+        # times the limit per round until enough conversations are found.
+        batch = limit * 4
+        hits: Dict[str, SearchHit] = {}
+        offset = 0
+        while len(hits) < limit:
+            rows = conn.execute(sql, params + [batch, offset]).fetchall()
+            for row in rows:
+                if row["conversation_id"] in hits:
+                    continue
+                hits[row["conversation_id"]] = SearchHit(
+                    conversation_id=row["conversation_id"],
+                    title=row["title"] or "",
+                    updated_at=row["updated_at"],
+                    message_index=row["seq"],
+                    role=row["role"],
+                    snippet=_render_snippet(row["snippet"]),
+                    score=row["score"],
+                )
+                if len(hits) == limit:
+                    break
+            if len(rows) < batch:
+                break
+            offset += batch
+        return list(hits.values())
+
+    def _replace(self, conn: sqlite3.Connection, conversation: Dict) -> None:
+        conversation_id = conversation["id"]
+        messages = conversation.get("messages", [])
+        conn.execute("DELETE FROM search_messages WHERE conversation_id = ?", (conversation_id,))
+        conn.execute("DELETE FROM search_conversations WHERE id = ?", (conversation_id,))
+        self._upsert_conversation(conn, conversation_id, conversation.get("updated_at"), _title(messages))
+        self._insert_messages(conn, conversation_id, 0, messages)
+
+    @staticmethod
+    def _upsert_conversation(conn: sqlite3.Connection, conversation_id: str,
+                             updated_at: Optional[str], title: str) -> None:
+        # The title is the first user message, so an append only sets it when
+        # the conversation didn't have one yet.
+        conn.execute(
+            "INSERT INTO search_conversations (id, updated_at, title) VALUES (?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "updated_at = coalesce(excluded.updated_at, updated_at), "
+            "title = CASE WHEN title = '' THEN excluded.title ELSE title END",
+            (conversation_id, updated_at, title),
+        )
+
+    @staticmethod
+    def _insert_messages(conn: sqlite3.Connection, conversation_id: str, start: int,
+                         messages: List[Dict]) -> None:
+        conn.executemany(
+            "INSERT INTO search_messages (conversation_id, seq, role, content) VALUES (?, ?, ?, ?)",
+            [
+                (conversation_id, start + i, message.get("role", ""), message.get("content") or "")
+                for i, message in enumerate(messages)
+            ],
+        )
@@ -0,0 +1,993 @@
+"""
+Storage backends for ConversationManager.
+
+ConversationStore defines the operations ConversationManager needs. Two
+implementations are provided:
+
+* JsonFileStore - one JSON snapshot plus an append-only message log per
+  conversation, with an append-only metadata index for listing.
+* SQLiteStore - a single SQLite database in WAL mode (conversations and
+  messages tables), giving concurrent readers, atomic appends and indexed
+  listing when several worker processes share the store.
+
+Both are safe to share between threads and worker processes: JsonFileStore
+serializes writes to a conversation with a lock that spans processes and
+replaces files atomically; SQLiteStore relies on database transactions.
+"""
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import IO, Callable, ContextManager, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import conversation_codec
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are only serialized within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Append-only metadata index kept alongside the conversation files
+INDEX_FILENAME = "_index.jsonl"
+# Compact the index once it holds this many superseded lines beyond 2x live entries
+INDEX_COMPACT_SLACK = 256
+
+# New messages are appended to <id>.jsonl and folded back into the <id>.json
+# snapshot once the log holds this many messages.
+LOG_COMPACT_THRESHOLD = int(os.getenv("CONVERSATION_LOG_COMPACT_THRESHOLD", "100"))
+# Lock-free reads of a conversation before JsonFileStore.load() takes its lock
+LOAD_ATTEMPTS = 3
+
+# Lock file whose byte ranges act as per-conversation write locks
+LOCK_FILENAME = "_write.lock"
+# Conversations hash onto this many lock stripes; stripe 0 guards the index
+LOCK_STRIPES = 1024
+INDEX_STRIPE = 0
+
+# fsync files before renaming them into place and after each append, so a
+# crash or power loss can't leave a truncated snapshot behind
+CONVERSATION_FSYNC = os.getenv("CONVERSATION_FSYNC", "true").lower() == "true"
+
+TITLE_MAX_CHARS = 60
+PREVIEW_MAX_CHARS = 80
+
+
+class ConversationConflictError(Exception):
+    """A conditional write found the conversation changed since it was read."""
+
+    def __init__(self, conversation_id: str, expected: Hashable, actual: Optional[Hashable]):
+        super().__init__(
+            f"Conversation {conversation_id} changed since it was read "
+            f"(expected version {expected!r}, found {actual!r})"
+        )
+        self.conversation_id = conversation_id
+        self.expected = expected
+        self.actual = actual
+
+
+def _snippet(text: str, limit: int) -> str:
+    """Collapse whitespace and truncate text for sidebar display."""
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+def _index_entry(conversation: Dict) -> Dict:
+    """Build the metadata index entry for a full conversation record."""
+    messages = conversation.get("messages", [])
+    title = next(
+        (msg.get("content", "") for msg in messages if msg.get("role") == "user"),
+        "",
+    )
+    preview = messages[-1].get("content", "") if messages else ""
+    return {
+        "id": conversation["id"],
+        "created_at": conversation.get("created_at"),
+        "updated_at": conversation.get("updated_at"),
+        "message_count": len(messages),
+        "title": _snippet(title, TITLE_MAX_CHARS),
+        "preview": _snippet(preview, PREVIEW_MAX_CHARS),
+    }
+
+
+def _updated_at_key(entry: Dict) -> Tuple[str, str]:
+    """Listing order (newest first, ties broken by id), as SQLiteStore sorts."""
+    return entry.get("updated_at") or "", entry.get("id") or ""
+
+
+def message_page(conversation: Dict, before: Optional[int] = None,
+                 limit: Optional[int] = None) -> Dict:
+    """
+    Copy of a conversation record holding only the `limit` messages that come
+    before index `before` (default: the newest messages), plus
+    "message_count" (all messages) and "messages_start" (the index of the
+    first message returned, i.e. the `before` for the next older page).
+    """
+    messages = conversation.get("messages", [])
+    end = len(messages) if before is None else max(0, min(before, len(messages)))
+    start = 0 if limit is None else max(0, end - limit)
+    page = {key: value for key, value in conversation.items() if key != "messages"}
+    page["messages"] = messages[start:end]
+    page["message_count"] = len(messages)
+    page["messages_start"] = start
+    return page
+
+
+def _append_jsonl(path: Path, records: Iterable[Dict]) -> None:
+    """
+    Append records to a JSONL file in a single write. If a previous writer
+    crashed mid-line, a newline is inserted first so the torn line stays
+    isolated and is skipped by readers.
+    """
+    payload = b"".join(conversation_codec.dumps(record) + b"\n" for record in records)
+    with open(path, "a+b") as f:
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                payload = b"\n" + payload
+        f.write(payload)
+        if CONVERSATION_FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _replace_file(path: Path, write: Callable[[IO[bytes]], None]) -> None:
+    """
+    Atomically replace path with the bytes write() produces: write a temp file
+    in the same directory, fsync it and rename it over path, so readers see
+    either the old or the new file and never a partial one.
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+            if CONVERSATION_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if CONVERSATION_FSYNC and hasattr(os, "O_DIRECTORY"):
+        # Persist the rename itself
+        fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class _WriteLocks:
+    """
+    Write locks for one directory, shared by threads and worker processes.
+
+    Keys hash onto LOCK_STRIPES one-byte ranges of a lock file. A stripe is
+    held with an fcntl record lock, which excludes other processes, plus an
+    entry in an in-process table of RLocks, because record locks belong to
+    the whole process and don't exclude its other threads. Holding a stripe
+    is reentrant within a thread. The lock file is never deleted, so nobody
+    can end up locking an unlinked inode.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: Optional[int] = None
+        self._pid = os.getpid()
+        self._table: Dict[int, List] = {}
+        self._table_lock = threading.Lock()
+
+    @staticmethod
+    def stripe(key: str) -> int:
+        return 1 + zlib.crc32(key.encode("utf-8")) % (LOCK_STRIPES - 1)
+
+    @contextmanager
+    def hold(self, stripe: int):
+        state = self._state(stripe)
+        state[0].acquire()
+        try:
+            if state[1] == 0 and fcntl is not None:
+                fcntl.lockf(self._file(), fcntl.LOCK_EX, 1, stripe)
+            state[1] += 1
+            try:
+                yield
+            finally:
+                state[1] -= 1
+                if state[1] == 0 and fcntl is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+        finally:
+            state[0].release()
+
+    def _state(self, stripe: int) -> List:
+        """[RLock, hold depth] for a stripe; the table is bounded by LOCK_STRIPES."""
+        with self._table_lock:
+            if self._pid != os.getpid():
+                # Forked: locks held by the parent's threads don't apply here
+                self._table = {}
+                self._pid = os.getpid()
+            state = self._table.get(stripe)
+            if state is None:
+                state = self._table[stripe] = [threading.RLock(), 0]
+            return state
+
+    def _file(self) -> int:
+        with self._table_lock:
+            if self._fd is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            return self._fd
+
+
+def _read_jsonl(path: Path, offset: int = 0) -> Tuple[List[Dict], int]:
+    """
+    Read complete JSONL records from byte offset onwards.
+
+    Returns the parsed records and the offset just past the last complete line.
+    A trailing line without a newline (an in-progress or torn write) is left
+    unread; undecodable lines are logged and skipped.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    records = []
+    for line in data[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(conversation_codec.loads(line))
+        except ValueError:
+            logger.warning(f"Skipping corrupt line in {path}")
+    return records, offset + end
+
+
+def _snapshot_path(directory: Path, conversation_id: str) -> Path:
+    return directory / f"{conversation_id}.json"
+
+
+def _log_path(directory: Path, conversation_id: str) -> Path:
+    return directory / f"{conversation_id}.jsonl"
+
+
+def _write_snapshot(directory: Path, conversation: Dict) -> None:
+    """
+    Atomically write a conversation's full snapshot, then start a fresh message
+    log whose header records how many messages the snapshot already holds.
+    """
+    conversation_id = conversation["id"]
+    data = conversation_codec.encode(conversation)
+    _replace_file(_snapshot_path(directory, conversation_id), lambda f: f.write(data))
+    _start_log(directory, conversation_id, len(conversation.get("messages", [])))
+
+
+def _read_snapshot(directory: Path, conversation_id: str) -> Dict:
+    """Parse a snapshot in whatever format (compact, indented, compressed) it was written."""
+    with open(_snapshot_path(directory, conversation_id), "rb") as f:
+        return conversation_codec.decode(f.read())
+
+
+def _start_log(directory: Path, conversation_id: str, base: int) -> None:
+    _replace_file(
+        _log_path(directory, conversation_id),
+        lambda f: f.write(conversation_codec.dumps({"op": "header", "base": base}) + b"\n"),
+    )
+
+
+def _read_conversation(directory: Path, conversation_id: str) -> Tuple[Dict, int]:
+    """
+    Read a conversation snapshot and replay its message log on top.
+
+    Returns the conversation and the number of records (messages and field
+    updates) that live only in the log. If a compaction crashed after
+    replacing the snapshot but before the log was reset, the header's base
+    count shows which logged messages the snapshot already contains, and
+    those are skipped.
+    """
+    conversation = _read_snapshot(directory, conversation_id)
+    messages = conversation.setdefault("messages", [])
+
+    log_path = _log_path(directory, conversation_id)
+    if not log_path.exists():
+        return conversation, 0
+
+    records, _ = _read_jsonl(log_path)
+    skip = 0
+    pending = 0
+    for record in records:
+        op = record.get("op")
+        if op == "header":
+            skip = max(0, len(messages) - int(record.get("base", 0)))
+        elif op == "message":
+            if skip:
+                skip -= 1
+                continue
+            message = record["message"]
+            messages.append(message)
+            conversation["updated_at"] = message.get("timestamp", conversation.get("updated_at"))
+            pending += 1
+        elif op == "fields":
+            conversation.update(record["fields"])
+            pending += 1
+    return conversation, pending
+
+
+class _ConversationIndex:
+    """
+    In-process view of the append-only metadata index for one directory.
+
+    Each line of the index file is either {"op": "upsert", "entry": {...}} or
+    {"op": "delete", "id": ...}. Readers replay only the bytes appended since
+    their last refresh, so keeping the view current costs O(new lines), and the
+    file is compacted once superseded lines dominate it. Writers (and
+    compactions) hold the index stripe of the directory's write locks.
+    """
+
+    def __init__(self, directory: Path, locks: _WriteLocks):
+        self.directory = directory
+        self.path = directory / INDEX_FILENAME
+        self.locks = locks
+        self._entries: Dict[str, Dict] = {}
+        self._offset = 0
+        self._inode = None
+        self._lines = 0
+        self._lock = threading.Lock()
+
+    def entries(self) -> List[Dict]:
+        with self._lock:
+            self._refresh()
+            return list(self._entries.values())
+
+    def upsert(self, entry: Dict) -> None:
+        self._write({"op": "upsert", "entry": entry})
+
+    def remove(self, conversation_id: str) -> None:
+        self._write({"op": "delete", "id": conversation_id})
+
+    def rebuild(self) -> int:
+        """Rebuild the index by scanning every conversation file on disk."""
+        with self._lock, self.locks.hold(INDEX_STRIPE):
+            return self._rebuild()
+
+    def _write(self, op: Dict) -> None:
+        with self._lock, self.locks.hold(INDEX_STRIPE):
+            self._refresh()
+            _append_jsonl(self.path, [op])
+            # Pick up our own line (and anything appended concurrently)
+            self._refresh()
+            if self._lines > 2 * len(self._entries) + INDEX_COMPACT_SLACK:
+                self._compact()
+
+    def _refresh(self) -> None:
+        if not self.path.exists():
+            # First use, or the index was lost: recover it from the files.
+            with self.locks.hold(INDEX_STRIPE):
+                if not self.path.exists():
+                    self._rebuild()
+                    return
+
+        stat = self.path.stat()
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # Replaced by a compaction/rebuild (possibly in another process)
+            self._reset()
+            self._inode = stat.st_ino
+        if stat.st_size == self._offset:
+            return
+
+        records, self._offset = _read_jsonl(self.path, self._offset)
+        for record in records:
+            self._apply(record)
+        self._lines += len(records)
+
+    def _apply(self, record: Dict) -> None:
+        op = record.get("op")
+        if op == "upsert" and "entry" in record:
+            self._entries[record["entry"]["id"]] = record["entry"]
+        elif op == "delete":
+            self._entries.pop(record.get("id"), None)
+
+    def _reset(self) -> None:
+        self._entries = {}
+        self._offset = 0
+        self._inode = None
+        self._lines = 0
+
+    def _rebuild(self) -> int:
+        self._reset()
+        if not self.directory.exists():
+            return 0
+        for file_path in self.directory.glob("*.json"):
+            try:
+                conversation, _ = _read_conversation(self.directory, file_path.stem)
+                self._entries[conversation["id"]] = _index_entry(conversation)
+            except Exception as e:
+                logger.warning(f"Failed to read conversation file {file_path}: {e}")
+        self._compact()
+        logger.info(f"Rebuilt conversation index with {len(self._entries)} entries")
+        return len(self._entries)
+
+    def _compact(self) -> None:
+        """Rewrite the index with one upsert per live entry, atomically."""
+        def write(f: IO[bytes]) -> None:
+            for entry in self._entries.values():
+                f.write(conversation_codec.dumps({"op": "upsert", "entry": entry}) + b"\n")
+
+        _replace_file(self.path, write)
+        stat = self.path.stat()
+        self._inode = stat.st_ino
+        self._offset = stat.st_size
+        self._lines = len(self._entries)
+
+
+class ConversationStore(ABC):
+    """
+    Persistence interface behind ConversationManager.
+
+    Stores write records exactly as given (ConversationManager owns timestamps)
+    and raise on I/O errors; "not found" is reported through return values.
+    """
+
+    @abstractmethod
+    def save(self, conversation: Dict, expected_version: Optional[Hashable] = None) -> None:
+        """
+        Create or fully replace a conversation record, messages included.
+
+        When expected_version is given the write only happens if version()
+        still returns it; otherwise ConversationConflictError is raised.
+        """
+
+    @abstractmethod
+    def load(self, conversation_id: str) -> Optional[Dict]:
+        """Return the full conversation record, or None if it doesn't exist."""
+
+    # True when load_page() reads only the requested messages; otherwise
+    # ConversationManager cuts pages from a full (cached) load instead.
+    partial_loads = False
+
+    @abstractmethod
+    def list_conversations(
+        self, limit: Optional[int] = None, after: Optional[Tuple[str, str]] = None
+    ) -> List[Dict]:
+        """
+        Return index entries (no messages), most recently updated first, ties
+        broken by id (descending). after, an (updated_at, id) pair taken from
+        the last entry of the previous page, skips everything up to and
+        including that entry.
+        """
+
+    @abstractmethod
+    def delete(self, conversation_id: str) -> bool:
+        """Delete a conversation; return False if it didn't exist."""
+
+    @abstractmethod
+    def add_messages(
+        self, conversation_id: str, messages: List[Dict], current: Optional[Dict] = None
+    ) -> Optional[Dict]:
+        """
+        Append timestamped messages atomically; return the updated record or None.
+
+        current, when given, is an up-to-date copy of the record that the store
+        may extend instead of reading the conversation back. Callers checking
+        that it is up to date hold lock() across the check and this call.
+        """
+
+    @abstractmethod
+    def update_fields(
+        self, conversation_id: str, fields: Dict, expected_version: Optional[Hashable] = None
+    ) -> bool:
+        """
+        Set top-level fields (not id/messages) without touching the messages or
+        updated_at; return False if the conversation doesn't exist.
+        expected_version works as in save().
+        """
+
+    @abstractmethod
+    def version(self, conversation_id: str) -> Optional[Hashable]:
+        """
+        Return a cheap stamp that changes whenever the conversation is written
+        (by any process), or None if it doesn't exist.
+        """
+
+    def exists(self, conversation_id: str) -> bool:
+        return self.version(conversation_id) is not None
+
+    def load_page(self, conversation_id: str, before: Optional[int] = None,
+                  limit: Optional[int] = None) -> Optional[Dict]:
+        """Return message_page() of the conversation, or None if it doesn't exist."""
+        conversation = self.load(conversation_id)
+        return None if conversation is None else message_page(conversation, before, limit)
+
+    def lock(self, conversation_id: str) -> ContextManager:
+        """
+        Hold the conversation's write lock, across threads and processes, so
+        that a sequence of calls (e.g. version() then add_messages()) sees no
+        interleaved writes. Reentrant; the store's own writes take it too.
+        """
+        return nullcontext()
+
+    def _check_version(self, conversation_id: str, expected_version: Optional[Hashable]) -> None:
+        if expected_version is None:
+            return
+        actual = self.version(conversation_id)
+        if actual != expected_version:
+            raise ConversationConflictError(conversation_id, expected_version, actual)
+
+    def compact(self, conversation_id: str) -> bool:
+        """Reclaim space held by a conversation's incremental writes, if any."""
+        return self.exists(conversation_id)
+
+    def rebuild_index(self) -> int:
+        """Rebuild any derived listing index; return the number of conversations."""
+        return len(self.list_conversations())
+
+    def repack(self, conversation_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Rewrite a conversation in the current serialization format. Returns
+        its size on disk before and after, or None if it doesn't exist or
+        the store has no format to convert.
+        """
+        return None
+
+
+class JsonFileStore(ConversationStore):
+    """
+    One <id>.json snapshot and one <id>.jsonl message log per conversation,
+    plus the _index.jsonl metadata index, all inside a single directory.
+    Every write to a conversation holds its lock(), so appends, compactions
+    and saves from different threads or processes never lose each other's
+    messages.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.locks = _WriteLocks(self.directory / LOCK_FILENAME)
+        self.index = _ConversationIndex(self.directory, self.locks)
+
+    def lock(self, conversation_id: str) -> ContextManager:
+        return self.locks.hold(self.locks.stripe(conversation_id))
+
+    def save(self, conversation: Dict, expected_version: Optional[Hashable] = None) -> None:
+        with self.lock(conversation["id"]):
+            self._check_version(conversation["id"], expected_version)
+            _write_snapshot(self.directory, conversation)
+            self.index.upsert(_index_entry(conversation))
+
+    def load(self, conversation_id: str) -> Optional[Dict]:
+        # Reads take no lock. A compaction landing between the snapshot and
+        # log reads would pair the old snapshot with the new, empty log, so
+        # the read is retried when the version moved, and finally done
+        # under the lock.
+        for _ in range(LOAD_ATTEMPTS):
+            version = self.version(conversation_id)
+            if version is None:
+                return None
+            try:
+                conversation, _ = _read_conversation(self.directory, conversation_id)
+            except FileNotFoundError:
+                continue
+            if self.version(conversation_id) == version:
+                return conversation
+        with self.lock(conversation_id):
+            if not self.exists(conversation_id):
+                return None
+            conversation, _ = _read_conversation(self.directory, conversation_id)
+            return conversation
+
+    def version(self, conversation_id: str) -> Optional[Hashable]:
+        # Appends change the log's size/mtime; compactions and saves replace the
+        # snapshot (new inode), so stat() of both files detects any writer.
+        try:
+            snapshot = os.stat(_snapshot_path(self.directory, conversation_id))
+        except FileNotFoundError:
+            return None
+        try:
+            log = os.stat(_log_path(self.directory, conversation_id))
+            log_stamp = (log.st_ino, log.st_size, log.st_mtime_ns)
+        except FileNotFoundError:
+            log_stamp = None
+        return (snapshot.st_ino, snapshot.st_size, snapshot.st_mtime_ns, log_stamp)
+
+    def list_conversations(
+        self, limit: Optional[int] = None, after: Optional[Tuple[str, str]] = None
+    ) -> List[Dict]:
+        if not self.directory.exists():
+            return []
+        entries = self.index.entries()
+        if after is not None:
+            cursor = (after[0] or "", after[1] or "")
+            entries = [entry for entry in entries if _updated_at_key(entry) < cursor]
+        if limit is not None:
+            return heapq.nlargest(limit, entries, key=_updated_at_key)
+        entries.sort(key=_updated_at_key, reverse=True)
+        return entries
+
+    def delete(self, conversation_id: str) -> bool:
+        with self.lock(conversation_id):
+            file_path = _snapshot_path(self.directory, conversation_id)
+            if not file_path.exists():
+                return False
+            file_path.unlink()
+            _log_path(self.directory, conversation_id).unlink(missing_ok=True)
+            self.index.remove(conversation_id)
+            return True
+
+    def add_messages(
+        self, conversation_id: str, messages: List[Dict], current: Optional[Dict] = None
+    ) -> Optional[Dict]:
+        with self.lock(conversation_id):
+            log_path = self._open_log(conversation_id)
+            if log_path is None:
+                return None
+            _append_jsonl(log_path, [{"op": "message", "message": m} for m in messages])
+
+            if current is not None:
+                # Extend the caller's copy; only the (bounded) log is inspected to
+                # decide on compaction, never the full snapshot.
+                conversation = current
+                conversation.setdefault("messages", []).extend(messages)
+                if messages:
+                    conversation["updated_at"] = messages[-1].get("timestamp")
+                with open(log_path, "rb") as f:
+                    pending = f.read().count(b"\n") - 1
+            else:
+                conversation, pending = _read_conversation(self.directory, conversation_id)
+            if pending >= LOG_COMPACT_THRESHOLD:
+                _write_snapshot(self.directory, conversation)
+                logger.debug(f"Compacted message log for {conversation_id}")
+            self.index.upsert(_index_entry(conversation))
+            return conversation
+
+    def update_fields(
+        self, conversation_id: str, fields: Dict, expected_version: Optional[Hashable] = None
+    ) -> bool:
+        with self.lock(conversation_id):
+            if expected_version is not None and not self.exists(conversation_id):
+                return False
+            self._check_version(conversation_id, expected_version)
+            log_path = self._open_log(conversation_id)
+            if log_path is None:
+                return False
+            _append_jsonl(log_path, [{"op": "fields", "fields": fields}])
+            return True
+
+    def compact(self, conversation_id: str) -> bool:
+        with self.lock(conversation_id):
+            if not self.exists(conversation_id):
+                return False
+            conversation, pending = _read_conversation(self.directory, conversation_id)
+            if pending:
+                _write_snapshot(self.directory, conversation)
+            return True
+
+    def repack(self, conversation_id: str) -> Optional[Tuple[int, int]]:
+        # Folds the log in as well: a fresh snapshot always starts a fresh log.
+        with self.lock(conversation_id):
+            if not self.exists(conversation_id):
+                return None
+            paths = (
+                _snapshot_path(self.directory, conversation_id),
+                _log_path(self.directory, conversation_id),
+            )
+            before = sum(path.stat().st_size for path in paths if path.exists())
+            conversation, _ = _read_conversation(self.directory, conversation_id)
+            _write_snapshot(self.directory, conversation)
+            return before, sum(path.stat().st_size for path in paths)
+
+    def _open_log(self, conversation_id: str) -> Optional[Path]:
+        """The conversation's message log (started if missing), or None if it doesn't exist."""
+        snapshot_path = _snapshot_path(self.directory, conversation_id)
+        if not snapshot_path.exists():
+            return None
+        log_path = _log_path(self.directory, conversation_id)
+        if not log_path.exists():
+            # Conversation written before message logs existed
+            base = len(_read_snapshot(self.directory, conversation_id).get("messages", []))
+            _start_log(self.directory, conversation_id, base)
+        return log_path
+
+    def rebuild_index(self) -> int:
+        return self.index.rebuild()
+
+
+# Top-level conversation keys with dedicated SQLite columns; anything else is
+# kept in the JSON "extra" column so records round-trip unchanged.
+_CONVERSATION_COLUMNS = ("id", "created_at", "updated_at", "messages")
+_MESSAGE_COLUMNS = ("role", "content", "timestamp")
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    created_at TEXT,
+    updated_at TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    title TEXT NOT NULL DEFAULT '',
+    preview TEXT NOT NULL DEFAULT '',
+    extra TEXT NOT NULL DEFAULT '{}',
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_updated_at
+    ON conversations (updated_at DESC, id DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (conversation_id, seq)
+);
+"""
+
+
+class SQLiteStore(ConversationStore):
+    """
+    Conversations in a single SQLite database using WAL journaling, so readers
+    never block the writer and appends from several processes are atomic.
+    Each thread (and each forked process) gets its own connection.
+    """
+
+    partial_loads = True
+
+    def __init__(self, path: Path, timeout: float = 30.0):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(_SQLITE_SCHEMA)
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(conversations)")}
+        if "version" not in columns:
+            # Databases created before the version counter existed
+            conn.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _SQLiteTransaction(self._connect())
+
+    def lock(self, conversation_id: str) -> ContextManager:
+        # A write transaction: it locks the whole database, which is how
+        # SQLite serializes writers anyway.
+        return self._transaction()
+
+    def save(self, conversation: Dict, expected_version: Optional[Hashable] = None) -> None:
+        messages = conversation.get("messages", [])
+        entry = _index_entry(conversation)
+        with self._transaction() as conn:
+            self._check_version(conversation["id"], expected_version)
+            conn.execute(
+                "INSERT INTO conversations "
+                "(id, created_at, updated_at, message_count, title, preview, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET created_at = excluded.created_at, "
+                "updated_at = excluded.updated_at, message_count = excluded.message_count, "
+                "title = excluded.title, preview = excluded.preview, "
+                "extra = excluded.extra, version = version + 1",
+                (
+                    conversation["id"],
+                    conversation.get("created_at"),
+                    conversation.get("updated_at"),
+                    len(messages),
+                    entry["title"],
+                    entry["preview"],
+                    _extra_json(conversation, _CONVERSATION_COLUMNS),
+                ),
+            )
+            conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation["id"],))
+            self._insert_messages(conn, conversation["id"], 0, messages)
+
+    def load(self, conversation_id: str) -> Optional[Dict]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT id, created_at, updated_at, extra FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        rows = conn.execute(
+            "SELECT role, content, timestamp, extra FROM messages "
+            "WHERE conversation_id = ? ORDER BY seq",
+            (conversation_id,),
+        ).fetchall()
+        conversation = json.loads(row["extra"])
+        conversation.update({
+            "id": row["id"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "messages": [_message_from_row(r) for r in rows],
+        })
+        return conversation
+
+    def version(self, conversation_id: str) -> Optional[Hashable]:
+        row = self._connect().execute(
+            "SELECT version FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return None if row is None else row["version"]
+
+    def load_page(self, conversation_id: str, before: Optional[int] = None,
+                  limit: Optional[int] = None) -> Optional[Dict]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT id, created_at, updated_at, message_count, extra "
+            "FROM conversations WHERE id = ?",
+            (conversation_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        # Messages below message_count were committed with it, and appends
+        # only add higher seqs, so the range stays valid without a transaction.
+        count = row["message_count"]
+        end = count if before is None else max(0, min(before, count))
+        start = 0 if limit is None else max(0, end - limit)
+        rows = conn.execute(
+            "SELECT role, content, timestamp, extra FROM messages "
+            "WHERE conversation_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+            (conversation_id, start, end),
+        ).fetchall()
+        conversation = json.loads(row["extra"])
+        conversation.update({
+            "id": row["id"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "messages": [_message_from_row(r) for r in rows],
+            "message_count": count,
+            "messages_start": start,
+        })
+        return conversation
+
+    def list_conversations(
+        self, limit: Optional[int] = None, after: Optional[Tuple[str, str]] = None
+    ) -> List[Dict]:
+        sql = "SELECT id, created_at, updated_at, message_count, title, preview FROM conversations"
+        params: Tuple = ()
+        if after is not None:
+            # A row-value comparison, so the (updated_at, id) index serves the seek
+            sql += " WHERE (updated_at, id) < (?, ?)"
+            params = (after[0], after[1])
+        sql += " ORDER BY updated_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params += (limit,)
+        return [dict(row) for row in self._connect().execute(sql, params)]
+
+    def delete(self, conversation_id: str) -> bool:
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+        return cursor.rowcount > 0
+
+    def add_messages(
+        self, conversation_id: str, messages: List[Dict], current: Optional[Dict] = None
+    ) -> Optional[Dict]:
+        if not messages:
+            return current if current is not None else self.load(conversation_id)
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT message_count, title FROM conversations WHERE id = ?",
+                (conversation_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._insert_messages(conn, conversation_id, row["message_count"], messages)
+            title = row["title"] or next(
+                (_snippet(m.get("content", ""), TITLE_MAX_CHARS)
+                 for m in messages if m.get("role") == "user"),
+                "",
+            )
+            conn.execute(
+                "UPDATE conversations SET message_count = ?, updated_at = ?, "
+                "title = ?, preview = ?, version = version + 1 WHERE id = ?",
+                (
+                    row["message_count"] + len(messages),
+                    messages[-1].get("timestamp"),
+                    title,
+                    _snippet(messages[-1].get("content", ""), PREVIEW_MAX_CHARS),
+                    conversation_id,
+                ),
+            )
+        if current is not None:
+            current.setdefault("messages", []).extend(messages)
+            current["updated_at"] = messages[-1].get("timestamp")
+            return current
+        return self.load(conversation_id)
+
+    def update_fields(
+        self, conversation_id: str, fields: Dict, expected_version: Optional[Hashable] = None
+    ) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT extra FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None:
+                return False
+            self._check_version(conversation_id, expected_version)
+            extra = json.loads(row["extra"])
+            extra.update(fields)
+            conn.execute(
+                "UPDATE conversations SET extra = ?, version = version + 1 WHERE id = ?",
+                (_extra_json(extra, _CONVERSATION_COLUMNS), conversation_id),
+            )
+        return True
+
+    @staticmethod
+    def _insert_messages(conn, conversation_id: str, start: int, messages: List[Dict]) -> None:
+        conn.executemany(
+            "INSERT INTO messages (conversation_id, seq, role, content, timestamp, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    conversation_id,
+                    start + offset,
+                    message.get("role", "user"),
+                    message.get("content", ""),
+                    message.get("timestamp"),
+                    _extra_json(message, _MESSAGE_COLUMNS),
+                )
+                for offset, message in enumerate(messages)
+            ],
+        )
+
+
+class _SQLiteTransaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT/ROLLBACK around an autocommit connection. Inside
+    a transaction already open on the connection it just joins that one.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.outer = False
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.outer = not self.conn.in_transaction
+        if self.outer:
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.outer:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def _extra_json(record: Dict, columns: Tuple[str, ...]) -> str:
+    extra = {k: v for k, v in record.items() if k not in columns}
+    return json.dumps(extra, ensure_ascii=False)
+
+
+def _message_from_row(row: sqlite3.Row) -> Dict:
+    message = {"role": row["role"], "content": row["content"], "timestamp": row["timestamp"]}
+    if row["extra"] != "{}":
+        message.update(json.loads(row["extra"]))
+    return message
+
+
+def migrate(source: ConversationStore, target: ConversationStore) -> int:
+    """Copy every conversation from source to target; return the number copied."""
+    count = 0
+    for entry in source.list_conversations():
+        conversation = source.load(entry["id"])
+        if conversation is None:
+            continue
+        target.save(conversation)
+        count += 1
+    return count
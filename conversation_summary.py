@@ -0,0 +1,148 @@
+"""
+Rolling summarization of long conversations.
+
+Once a conversation has more than SUMMARY_TRIGGER_MESSAGES messages that are
+not yet covered by its summary, everything except the newest
+SUMMARY_KEEP_RECENT messages is folded into the stored summary:
+
+    conversation["summary"] = {"text": "...", "message_count": <messages covered>}
+
+Each update only sends the previous summary plus the newly aged-out messages,
+and runs on a background thread after the response has been returned. Prompts
+then carry the summary plus the uncovered tail, so their size stays roughly
+constant however long the conversation grows.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from assistant_core import AssistantError, RateLimitedError, summarize_history
+from conversation_manager import ConversationManager
+from conversation_store import ConversationConflictError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Summarize once this many messages are not covered by the summary ...
+SUMMARY_TRIGGER_MESSAGES = int(os.getenv("CONVERSATION_SUMMARY_TRIGGER", "40"))
+# ... keeping this many of the newest messages verbatim.
+SUMMARY_KEEP_RECENT = int(os.getenv("CONVERSATION_SUMMARY_KEEP_RECENT", "20"))
+# Conditional writes of a finished summary before giving up on it
+SUMMARY_WRITE_ATTEMPTS = 3
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+_in_flight = set()
+_in_flight_lock = threading.Lock()
+
+
+def split_history(conversation: Dict) -> Tuple[Optional[str], List[Dict]]:
+    """Return the summary text (or None) and the messages it doesn't cover yet."""
+    messages = conversation.get("messages", [])
+    summary = conversation.get("summary") or {}
+    covered = min(int(summary.get("message_count", 0)), len(messages))
+    return summary.get("text") or None, messages[covered:]
+
+
+def needs_summary(conversation: Dict) -> bool:
+    _, uncovered = split_history(conversation)
+    return len(uncovered) > SUMMARY_TRIGGER_MESSAGES
+
+
+def update_summary(conversation_id: str) -> bool:
+    """
+    Fold aged-out messages into the conversation's summary.
+
+    Returns True when a new summary was stored, False when nothing needed
+    summarizing, the conversation no longer exists, or it changed in a way
+    that makes the new summary stale (another worker stored a newer one, or
+    the summarized messages were rewritten).
+    """
+    conversation = ConversationManager.load_conversation(conversation_id)
+    if not conversation or not needs_summary(conversation):
+        return False
+
+    messages = conversation["messages"]
+    summary = conversation.get("summary") or {}
+    covered = min(int(summary.get("message_count", 0)), len(messages))
+    new_covered = len(messages) - SUMMARY_KEEP_RECENT
+    folded = messages[covered:new_covered]
+    text = summarize_history(summary.get("text"), folded)
+
+    # Summarizing takes seconds, and new messages are usually appended
+    # meanwhile. Those don't affect the summary, so write it conditionally on
+    # what was summarized still being on disk and retry when only the
+    # version moved on.
+    for _ in range(SUMMARY_WRITE_ATTEMPTS):
+        version = ConversationManager.conversation_version(conversation_id)
+        current = ConversationManager.load_conversation(conversation_id)
+        if version is None or not current:
+            return False
+        if (current.get("summary") or {}) != summary or \
+                current["messages"][covered:new_covered] != folded:
+            logger.info("Discarding stale summary of conversation %s", conversation_id)
+            return False
+        try:
+            updated = ConversationManager.update_fields(
+                conversation_id,
+                {"summary": {"text": text, "message_count": new_covered}},
+                expected_version=version,
+            )
+        except ConversationConflictError:
+            continue
+        if updated:
+            logger.info(
+                "Summarized conversation %s up to message %d", conversation_id, new_covered
+            )
+        return updated
+    logger.info("Gave up storing summary of busy conversation %s", conversation_id)
+    return False
+
+
+def schedule_summary(conversation: Optional[Dict]) -> Optional[Future]:
+    """
+    Queue a background summary update if the conversation needs one.
+
+    At most one update per conversation runs at a time in this process.
+    Returns the future, or None when nothing was scheduled.
+    """
+    if not conversation or not needs_summary(conversation):
+        return None
+    conversation_id = conversation["id"]
+    with _in_flight_lock:
+        if conversation_id in _in_flight:
+            return None
+        _in_flight.add(conversation_id)
+    try:
+        return _executor.submit(_run_update, conversation_id)
+    except RuntimeError:
+        # Executor already shut down (interpreter exiting)
+        with _in_flight_lock:
+            _in_flight.discard(conversation_id)
+        return None
+
+
+def _run_update(conversation_id: str) -> bool:
+    try:
+        return update_summary(conversation_id)
+    except RateLimitedError as e:
+        # Dropped rather than queued: the next exchange schedules it again,
+        # by which time the backend may have capacity to spare.
+        logger.info("Summary update for %s deferred: %s", conversation_id, e)
+        return False
+    except AssistantError as e:
+        logger.warning("Summary update for %s failed: %s", conversation_id, e)
+        return False
+    except Exception as e:
+        logger.exception("Unexpected error updating summary for %s: %s", conversation_id, e)
+        return False
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(conversation_id)
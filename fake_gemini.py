@@ -0,0 +1,282 @@
+"""
+Local stand-in for the Gemini REST API, for load tests and offline runs.
+
+Serves generateContent, streamGenerateContent (Server-Sent Events) and
+countTokens for any model name, with a configurable latency distribution,
+output token rate and error rate. Point the assistant at it with
+GEMINI_BASE_URL:
+
+    python fake_gemini.py --port 8089 --latency 0.8 --tokens-per-second 80
+    GEMINI_BASE_URL=http://127.0.0.1:8089/ GEMINI_API_KEY=fake python web_ui.py
+
+Latency is the time to the first token. It is drawn from a log-normal
+distribution with the given median; --latency-sigma 0 makes it constant.
+The answer's --output-tokens words are then produced at --tokens-per-second,
+streamed in chunks of --chunk-tokens words, or sent all at once when
+generation finishes for non-streaming calls.
+
+Tests can also script individual responses with FakeGemini.push().
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+ERROR_STATUSES = {
+    400: "INVALID_ARGUMENT",
+    429: "RESOURCE_EXHAUSTED",
+    500: "INTERNAL",
+    503: "UNAVAILABLE",
+    504: "DEADLINE_EXCEEDED",
+}
+
+FILLER_WORDS = (
+    "this is a simulated answer from the local fake gemini server used to "
+    "measure how the assistant behaves under load without spending any quota"
+).split()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 refuses connections under any real load
+    request_queue_size = 1024
+
+
+class FakeGemini:
+    """
+    A fake Gemini API server running on a background thread.
+
+    Each request consumes the next scripted behaviour pushed with push(), a
+    dict with any of "status", "delay", "retry_after" and "text". Unscripted
+    requests follow the configured latency and error rate and answer
+    "answer from <model>", padded with filler words to output_tokens.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        *,
+        latency: float = 0.0,
+        latency_sigma: float = 0.0,
+        tokens_per_second: float = 0.0,
+        output_tokens: int = 0,
+        chunk_tokens: int = 8,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.script = deque()
+        self.models: List[str] = []
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+        self.server = _Server((host, port), self._handler())
+        self.url = f"http://{host}:{self.server.server_address[1]}/"
+        self._thread: Optional[threading.Thread] = None
+
+    def push(self, *behaviours: Dict) -> None:
+        self.script.extend(behaviours)
+
+    def start(self) -> "FakeGemini":
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "FakeGemini":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _behaviour(self) -> Dict:
+        try:
+            return self.script.popleft()
+        except IndexError:
+            pass
+        with self._random_lock:
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+            delay = self.latency
+            if delay > 0 and self.latency_sigma > 0:
+                delay *= math.exp(self._random.gauss(0, self.latency_sigma))
+        behaviour = {"delay": delay}
+        if failed:
+            behaviour["status"] = self.error_status
+            if self.error_status == 429:
+                behaviour["retry_after"] = 1
+        return behaviour
+
+    def _answer(self, model: str) -> str:
+        words = ["answer", "from", model]
+        padding = max(0, self.output_tokens - len(words))
+        words += [FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(padding)]
+        return " ".join(words)
+
+    def _generation_time(self, tokens: int) -> float:
+        return tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("content-length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                path = self.path.split("?")[0]
+                if "models/" not in path or ":" not in path:
+                    self._send_json(404, _error(404, f"Unknown method {path}"))
+                    return
+                model, method = path.split("models/")[1].split(":", 1)
+                prompt_tokens = max(1, len(body) // 4)
+
+                if method == "countTokens":
+                    self._send_json(200, {"totalTokens": prompt_tokens})
+                    return
+                if method not in ("generateContent", "streamGenerateContent"):
+                    self._send_json(404, _error(404, f"Unknown method {method}"))
+                    return
+
+                fake.models.append(model)
+                behaviour = fake._behaviour()
+                time.sleep(behaviour.get("delay", 0))
+                status = behaviour.get("status", 200)
+                try:
+                    if status != 200:
+                        self._send_json(status, _error(status, "simulated failure"),
+                                        behaviour.get("retry_after"))
+                    elif method == "streamGenerateContent":
+                        self._stream(model, behaviour, prompt_tokens)
+                    else:
+                        text = behaviour.get("text") or fake._answer(model)
+                        tokens = len(text.split())
+                        time.sleep(fake._generation_time(tokens))
+                        self._send_json(200, _response(text, prompt_tokens, tokens, final=True))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _stream(self, model: str, behaviour: Dict, prompt_tokens: int) -> None:
+                words = (behaviour.get("text") or fake._answer(model)).split()
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                self.send_header("transfer-encoding", "chunked")
+                self.end_headers()
+                for start in range(0, len(words), fake.chunk_tokens):
+                    chunk = words[start:start + fake.chunk_tokens]
+                    time.sleep(fake._generation_time(len(chunk)))
+                    text = " ".join(chunk) + (" " if start + len(chunk) < len(words) else "")
+                    final = start + len(chunk) >= len(words)
+                    event = _response(text, prompt_tokens, len(words), final)
+                    self._write_chunk(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+                self._write_chunk(b"")
+
+            def _write_chunk(self, data: bytes) -> None:
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, status: int, payload: Dict,
+                           retry_after: Optional[float] = None) -> None:
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                if retry_after is not None:
+                    self.send_header("retry-after", str(retry_after))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+def _response(text: str, prompt_tokens: int, output_tokens: int, final: bool) -> Dict:
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}}
+    payload = {"candidates": [candidate]}
+    if final:
+        candidate["finishReason"] = "STOP"
+        payload["usageMetadata"] = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        }
+    return payload
+
+
+def _error(status: int, message: str) -> Dict:
+    return {"error": {
+        "code": status, "message": message, "status": ERROR_STATUSES.get(status, "UNKNOWN"),
+    }}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Local fake Gemini API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="Median seconds before the first token")
+    parser.add_argument("--latency-sigma", type=float, default=0.3,
+                        help="Log-normal spread of the latency (0 = constant)")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0,
+                        help="Output token rate (0 = instant)")
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--chunk-tokens", type=int, default=8,
+                        help="Tokens per streamed chunk")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of calls that fail with --error-status")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    fake = FakeGemini(
+        args.host, args.port,
+        latency=args.latency, latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second, output_tokens=args.output_tokens,
+        chunk_tokens=args.chunk_tokens, error_rate=args.error_rate,
+        error_status=args.error_status, seed=args.seed,
+    )
+    logger.info("Fake Gemini listening on %s", fake.url)
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Process-wide Gemini clients with a tuned HTTP transport.
+
+get_client() returns one shared genai.Client per (api key, options) for the
+current process. Each client owns an httpx connection pool with configurable
+size, keep-alive and connect/read timeouts, and uses HTTP/2 when the optional
+`h2` package is installed.
+
+Clients are fork-safe: the registry is dropped in forked children (e.g.
+gunicorn workers with --preload), which then build their own pools instead of
+sharing the parent's sockets. Inherited clients are abandoned rather than
+closed, since closing would shut down TLS sessions the parent still uses.
+
+warm_up() / warm_up_async() open a pooled connection ahead of the first user
+request so it doesn't pay for the DNS lookup and TLS handshake.
+"""
+import logging
+import os
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import httpx
+from google import genai
+from google.genai import types as genai_types
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+DEFAULT_BASE_URL = "https://generativelanguage.googleapis.com/"
+
+# Open a connection at startup (and in every forked worker)
+GEMINI_WARMUP = os.getenv("GEMINI_WARMUP", "false").lower() == "true"
+
+
+class ClientOptions(NamedTuple):
+    connect_timeout: float = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "10"))
+    read_timeout: float = float(os.getenv("GEMINI_READ_TIMEOUT", "120"))
+    max_connections: int = int(os.getenv("GEMINI_MAX_CONNECTIONS", "100"))
+    max_keepalive_connections: int = int(os.getenv("GEMINI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+    keepalive_expiry: float = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "60"))
+    # HTTP/2 is used only when the h2 package is installed
+    http2: bool = os.getenv("GEMINI_HTTP2", "true").lower() == "true"
+    base_url: Optional[str] = os.getenv("GEMINI_BASE_URL") or None
+
+
+class _SyncHttpClient(httpx.Client):
+    """httpx client that keeps its own timeouts when the SDK passes none."""
+
+    def build_request(self, *args, timeout=httpx.USE_CLIENT_DEFAULT, **kwargs):
+        if timeout is None:
+            timeout = httpx.USE_CLIENT_DEFAULT
+        return super().build_request(*args, timeout=timeout, **kwargs)
+
+
+class _AsyncHttpClient(httpx.AsyncClient):
+    """Async counterpart of _SyncHttpClient."""
+
+    def build_request(self, *args, timeout=httpx.USE_CLIENT_DEFAULT, **kwargs):
+        if timeout is None:
+            timeout = httpx.USE_CLIENT_DEFAULT
+        return super().build_request(*args, timeout=timeout, **kwargs)
+
+
+class _ClientEntry(NamedTuple):
+    client: genai.Client
+    http: httpx.Client
+    async_http: httpx.AsyncClient
+
+
+_clients: Dict[Tuple[str, ClientOptions], _ClientEntry] = {}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+_warm_up_requested = False
+
+
+def get_client(
+    api_key: Optional[str] = None, options: Optional[ClientOptions] = None
+) -> genai.Client:
+    """Return this process's shared client for the api key and options."""
+    return _get_entry(api_key, options).client
+
+
+def _get_entry(api_key: Optional[str], options: Optional[ClientOptions]) -> _ClientEntry:
+    global _clients_pid
+    api_key = api_key or os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY environment variable is required.")
+    options = options or ClientOptions()
+    key = (api_key, options)
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Forked without the at-fork hook (e.g. os.fork from C code)
+            _clients.clear()
+            _clients_pid = os.getpid()
+        entry = _clients.get(key)
+        if entry is None:
+            entry = _build_client(api_key, options)
+            _clients[key] = entry
+        return entry
+
+
+def _build_client(api_key: str, options: ClientOptions) -> _ClientEntry:
+    http2 = options.http2 and _h2_available()
+    transport_args = dict(
+        limits=httpx.Limits(
+            max_connections=options.max_connections,
+            max_keepalive_connections=options.max_keepalive_connections,
+            keepalive_expiry=options.keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(options.read_timeout, connect=options.connect_timeout),
+        http2=http2,
+        follow_redirects=True,
+    )
+    logger.info(
+        "Creating Gemini client (pool=%d, keep-alive=%d, http2=%s)",
+        options.max_connections, options.max_keepalive_connections, http2,
+    )
+    http = _SyncHttpClient(**transport_args)
+    async_http = _AsyncHttpClient(**transport_args)
+    client = genai.Client(
+        api_key=api_key,
+        http_options=genai_types.HttpOptions(
+            base_url=options.base_url,
+            httpx_client=http,
+            httpx_async_client=async_http,
+        ),
+    )
+    return _ClientEntry(client, http, async_http)
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ClientProxy:
+    """
+    Stand-in for a module-level client that resolves get_client() on every
+    attribute access, so module globals stay valid across forks.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, options: Optional[ClientOptions] = None):
+        self._api_key = api_key
+        self._options = options
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._api_key, self._options), name)
+
+
+def warm_up(api_key: Optional[str] = None, options: Optional[ClientOptions] = None) -> bool:
+    """
+    Open a keep-alive connection in the client's sync pool. Any HTTP status
+    counts as success; returns False if the connection could not be made.
+    """
+    global _warm_up_requested
+    _warm_up_requested = True
+    options = options or ClientOptions()
+    entry = _get_entry(api_key, options)
+    try:
+        entry.http.head(options.base_url or DEFAULT_BASE_URL)
+    except httpx.HTTPError as e:
+        logger.warning("Gemini warm-up failed: %s", e)
+        return False
+    logger.info("Gemini connection warmed up")
+    return True
+
+
+async def warm_up_async(
+    api_key: Optional[str] = None, options: Optional[ClientOptions] = None
+) -> bool:
+    """warm_up for the client's async pool, for ASGI startup."""
+    global _warm_up_requested
+    _warm_up_requested = True
+    options = options or ClientOptions()
+    entry = _get_entry(api_key, options)
+    try:
+        await entry.async_http.head(options.base_url or DEFAULT_BASE_URL)
+    except httpx.HTTPError as e:
+        logger.warning("Gemini async warm-up failed: %s", e)
+        return False
+    logger.info("Gemini async connection warmed up")
+    return True
+
+
+def warm_up_in_background() -> threading.Thread:
+    """Run warm_up() on a daemon thread so startup isn't delayed."""
+    thread = threading.Thread(target=warm_up, name="gemini-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def _reset_after_fork() -> None:
+    global _clients_lock, _clients_pid
+    # The parent's lock may have been held at fork time; replace it.
+    _clients_lock = threading.Lock()
+    _clients.clear()
+    _clients_pid = os.getpid()
+    if _warm_up_requested:
+        warm_up_in_background()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
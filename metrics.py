@@ -0,0 +1,405 @@
+"""
+Counters and latency histograms in the Prometheus text exposition format.
+
+The metrics are declared once below and updated from the request path:
+web_ui times every route and the stages of /ask, assistant_core reports token
+usage, ConversationManager times store operations, and record_attempt() is
+registered with call_policy to count Gemini attempts and errors. render()
+produces the text served at /metrics; no client library or external service
+is involved.
+
+With several worker processes there are two modes:
+
+* Per worker (default): each process keeps its own numbers and labels every
+  sample with worker="<pid>", so series from different workers never clash
+  and can be summed by the scraper.
+* Shared directory (METRICS_DIR set): each process writes a snapshot of its
+  numbers to METRICS_DIR/worker-<pid>-<start>.json every
+  METRICS_FLUSH_INTERVAL seconds and at exit, and /metrics in any worker
+  serves the sum over all snapshots. Snapshots of exited workers are kept so
+  counters never go backwards, and the start time in the name keeps a new
+  process that reuses a PID from overwriting them; empty the directory when
+  the whole service is restarted.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Shared snapshot directory; unset means per-worker mode
+METRICS_DIR = os.getenv("METRICS_DIR") or None
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; spans fast store reads up to slow generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+        self._registry = registry if registry is not None else REGISTRY
+        self._registry.register(self)
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if len(labels) != len(self.labelnames) or set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self) -> List[List]:
+        """[[label values, value], ...] in a JSON-friendly form."""
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._values.items()]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    @abstractmethod
+    def merge(total, value):
+        """Add value to total (None for the first value) and return the result."""
+
+    @abstractmethod
+    def samples(self, key: LabelValues, value) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        """The exposition samples (name, labels, value) for one series."""
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, exposed as <name>_total."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+        self._registry.touched()
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0.0) + value
+
+    def samples(self, key, value):
+        yield self.name + "_total", dict(zip(self.labelnames, key)), value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values in fixed buckets. Each series is stored as
+    per-bucket counts (the last one being +Inf) followed by the sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional["Registry"] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+        self._registry.touched()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block, even when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return state[-1] if state else 0
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, key, value):
+        labels = dict(zip(self.labelnames, key))
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), value):
+            cumulative += count
+            yield self.name + "_bucket", dict(labels, le=_format_value(bound)), cumulative
+        yield self.name + "_sum", labels, value[-2]
+        yield self.name + "_count", labels, value[-1]
+
+
+class Registry:
+    """The set of declared metrics, plus the shared-directory snapshots when enabled."""
+
+    def __init__(self, directory: Optional[str] = None, flush_interval: float = METRICS_FLUSH_INTERVAL):
+        self.directory = Path(directory) if directory else None
+        self.flush_interval = flush_interval
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flusher: Optional[threading.Thread] = None
+        self._flusher_pid: Optional[int] = None
+        self._snapshot_name: Optional[str] = None
+        self._snapshot_pid: Optional[int] = None
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+
+    def reset(self) -> None:
+        """Drop every recorded value."""
+        for metric in list(self._metrics.values()):
+            metric.reset()
+        self._dirty = False
+
+    def _reset_after_fork(self) -> None:
+        # Numbers belong to the process that recorded them. Locks held by the
+        # parent's other threads would never be released here, so replace them.
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+            metric._values = {}
+        self._dirty = False
+
+    def touched(self) -> None:
+        """Note a change; in shared mode make sure this process' flusher is running."""
+        self._dirty = True
+        if self.directory is not None and self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def snapshot(self) -> Dict[str, List[List]]:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def flush(self) -> None:
+        """Write this process' snapshot into the shared directory, atomically."""
+        if self.directory is None:
+            return
+        self._dirty = False
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / self._own_snapshot()
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def collect(self) -> Dict[str, Dict[LabelValues, object]]:
+        """Merged values per metric: this process only, or every snapshot in shared mode."""
+        snapshots = [self.snapshot()]
+        if self.directory is not None and self.directory.exists():
+            own = self._own_snapshot()
+            for path in sorted(self.directory.glob("worker-*.json")):
+                if path.name == own:
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    logger.warning("Skipping unreadable metrics snapshot %s: %s", path, e)
+
+        merged: Dict[str, Dict[LabelValues, object]] = {}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                values = merged.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(key)
+                    values[key] = metric.merge(values.get(key), value)
+        return merged
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        merged = self.collect()
+        worker = None if self.directory is not None else str(os.getpid())
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {_escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(merged.get(name, {}).items()):
+                for sample, labels, sample_value in metric.samples(key, value):
+                    if worker is not None:
+                        labels = dict(labels, worker=worker)
+                    lines.append(f"{sample}{_format_labels(labels)} {_format_value(sample_value)}")
+        return "\n".join(lines) + "\n"
+
+    def _own_snapshot(self) -> str:
+        """This process' snapshot file name, unique even when PIDs are reused."""
+        pid = os.getpid()
+        if self._snapshot_pid != pid:
+            self._snapshot_name = f"worker-{pid}-{time.time_ns()}.json"
+            self._snapshot_pid = pid
+        return self._snapshot_name
+
+    def _start_flusher(self) -> None:
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, name="metrics-flush", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    logger.warning("Failed to write metrics snapshot: %s", e)
+
+    def _flush_at_exit(self) -> None:
+        if self.directory is not None and self._dirty:
+            try:
+                self.flush()
+            except OSError as e:
+                logger.warning("Failed to write metrics snapshot: %s", e)
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        f'{name}="{_escape_label(value)}"' for name, value in labels.items()
+    ) + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry(METRICS_DIR)
+atexit.register(REGISTRY._flush_at_exit)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=REGISTRY._reset_after_fork)
+
+
+HTTP_REQUESTS = Counter(
+    "assistant_http_requests", "HTTP requests handled, by route and status.",
+    ("route", "method", "status"),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "assistant_http_request_duration_seconds", "Time to handle an HTTP request, by route.",
+    ("route", "method"),
+)
+ASK_STAGE_SECONDS = Histogram(
+    "assistant_ask_stage_duration_seconds",
+    "Time spent in each stage of an /ask request: history_load, prompt_assembly, "
+    "gemini_call and persistence.",
+    ("route", "stage"),
+)
+GEMINI_ATTEMPTS = Counter(
+    "assistant_gemini_attempts", "Gemini API attempts, by outcome.",
+    ("operation", "model", "kind", "outcome"),
+)
+GEMINI_ATTEMPT_SECONDS = Histogram(
+    "assistant_gemini_attempt_duration_seconds", "Duration of individual Gemini API attempts.",
+    ("operation", "model"),
+)
+GEMINI_ERRORS = Counter(
+    "assistant_gemini_errors", "Failed Gemini API attempts, by error class and HTTP status.",
+    ("operation", "error", "status"),
+)
+GEMINI_TOKENS = Counter(
+    "assistant_gemini_tokens", "Tokens reported in Gemini usage metadata, by type.",
+    ("model", "type"),
+)
+STORE_OPERATION_SECONDS = Histogram(
+    "assistant_store_operation_duration_seconds", "Conversation store operation latency.",
+    ("store", "operation"),
+)
+
+
+def observe_stages(route: str, timings: Dict[str, float]) -> None:
+    """Record per-stage durations (as collected by tracing.span(name, timings))."""
+    for stage, seconds in timings.items():
+        ASK_STAGE_SECONDS.observe(seconds, route=route, stage=stage)
+
+
+def record_tokens(model: str, usage: Dict[str, int]) -> None:
+    for kind, count in usage.items():
+        if count:
+            GEMINI_TOKENS.inc(count, model=model, type=kind)
+
+
+def record_attempt(attempt) -> None:
+    """call_policy attempt listener: count attempts, their latency and errors by class."""
+    GEMINI_ATTEMPTS.inc(
+        operation=attempt.operation, model=attempt.model, kind=attempt.kind, outcome=attempt.outcome,
+    )
+    GEMINI_ATTEMPT_SECONDS.observe(attempt.seconds, operation=attempt.operation, model=attempt.model)
+    if attempt.outcome == "error":
+        GEMINI_ERRORS.inc(
+            operation=attempt.operation,
+            error=(attempt.error or "").split(":", 1)[0] or "unknown",
+            status=str(attempt.status or ""),
+        )
+
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,204 @@
+"""
+Single-pass keyword classifier for prompts.
+
+All keywords of all categories are compiled into one trie-shaped regular
+expression, so a single left-to-right scan of the lowercased prompt finds the
+longest keyword at each match position; the scan resumes one character after
+each match start, so overlapping keywords are found too. Each keyword carries
+the labels of every keyword contained in it ("current event" also implies
+"current"), which makes the longest-match scan equivalent to testing every
+keyword with a separate substring search.
+
+Categories map keywords to weights; a category applies when the summed
+weight of its distinct matched keywords reaches its threshold (by default
+1.0, i.e. any keyword of weight 1). Extra categories and weights can be
+loaded from a JSON file:
+
+    {"categories": {"medical": {"keywords": {"diagnosis": 1, "symptom": 0.5},
+                                "threshold": 1}}}
+"""
+import json
+import logging
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import (
+    Dict, FrozenSet, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+DEFAULT_THRESHOLD = 1.0
+
+# Keywords given as a plain collection all weigh 1.0
+KeywordSpec = Union[Iterable[str], Mapping[str, float]]
+
+
+class Classification(NamedTuple):
+    labels: FrozenSet[str]
+    scores: Dict[str, float]
+
+
+class PromptClassifier:
+    """Labels text with every category whose keywords it contains, in one pass."""
+
+    def __init__(
+        self,
+        categories: Mapping[str, KeywordSpec],
+        thresholds: Optional[Mapping[str, float]] = None,
+    ):
+        self.categories: Dict[str, Dict[str, float]] = {
+            name: _normalize_keywords(keywords) for name, keywords in categories.items()
+        }
+        thresholds = thresholds or {}
+        self.thresholds = {
+            name: float(thresholds.get(name, DEFAULT_THRESHOLD)) for name in self.categories
+        }
+
+        keywords = {kw for weights in self.categories.values() for kw in weights}
+        # keyword -> (category, keyword, weight) for every keyword it contains
+        self._implied: Dict[str, Tuple[Tuple[str, str, float], ...]] = {
+            kw: tuple(
+                (name, other, weight)
+                for name, weights in self.categories.items()
+                for other, weight in weights.items()
+                if other in kw
+            )
+            for kw in keywords
+        }
+        self._pattern = re.compile(_trie_pattern(keywords)) if keywords else None
+
+    @classmethod
+    def from_config(
+        cls,
+        categories: Mapping[str, KeywordSpec],
+        config_path: Optional[Union[str, Path]] = None,
+    ) -> "PromptClassifier":
+        """
+        Build a classifier from default categories merged with a JSON config
+        file: new categories are added, listed keywords are added to (or
+        re-weighted in) existing ones, and thresholds override the defaults.
+        """
+        merged = {name: _normalize_keywords(kws) for name, kws in categories.items()}
+        thresholds: Dict[str, float] = {}
+        if config_path:
+            with open(config_path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+            for name, spec in config.get("categories", {}).items():
+                merged.setdefault(name, {}).update(_normalize_keywords(spec.get("keywords", {})))
+                if "threshold" in spec:
+                    thresholds[name] = float(spec["threshold"])
+            logger.info("Loaded classifier config from %s", config_path)
+        return cls(merged, thresholds)
+
+    def classify(self, text: str) -> Classification:
+        """Return the matching labels and each category's score."""
+        matched = set()
+        for keyword in set(self._keywords_in(text.lower())):
+            matched.update(self._implied[keyword])
+        scores = dict.fromkeys(self.categories, 0.0)
+        for name, _, weight in matched:
+            scores[name] += weight
+        labels = frozenset(
+            name for name, score in scores.items() if score >= self.thresholds[name]
+        )
+        return Classification(labels, scores)
+
+    def labels(self, text: str) -> FrozenSet[str]:
+        """
+        Return only the labels. The scan stops as soon as every category has
+        reached its threshold, so long prompts are rarely read to the end.
+        """
+        if self._pattern is None:
+            return frozenset()
+        scores = dict.fromkeys(self.categories, 0.0)
+        labels = set()
+        seen_keywords = set()
+        counted = set()
+        for keyword in self._keywords_in(text.lower()):
+            if keyword in seen_keywords:
+                continue
+            seen_keywords.add(keyword)
+            for implied in self._implied[keyword]:
+                name = implied[0]
+                if name in labels or implied in counted:
+                    continue
+                counted.add(implied)
+                scores[name] += implied[2]
+                if scores[name] >= self.thresholds[name]:
+                    labels.add(name)
+            if len(labels) == len(self.categories):
+                break
+        return frozenset(labels)
+
+    def _keywords_in(self, lowered: str) -> Iterator[str]:
+        """Yield the longest keyword starting at each position that has one."""
+        if self._pattern is None:
+            return
+        search = self._pattern.search
+        match = search(lowered)
+        while match is not None:
+            yield match.group()
+            match = search(lowered, match.start() + 1)
+
+    def classify_many(
+        self, texts: Iterable[str], processes: Optional[int] = None
+    ) -> List[Classification]:
+        """
+        Classify a batch of texts. Duplicate texts are classified once; with
+        processes > 1 the work is spread over a process pool.
+        """
+        texts = list(texts)
+        unique = list(dict.fromkeys(texts))
+        if processes and processes > 1 and len(unique) > 1:
+            chunksize = max(1, len(unique) // (processes * 4))
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                results = list(pool.map(self.classify, unique, chunksize=chunksize))
+        else:
+            results = [self.classify(text) for text in unique]
+        by_text = dict(zip(unique, results))
+        return [by_text[text] for text in texts]
+
+
+def _normalize_keywords(keywords: KeywordSpec) -> Dict[str, float]:
+    if isinstance(keywords, Mapping):
+        items = keywords.items()
+    else:
+        items = ((kw, 1.0) for kw in keywords)
+    return {kw.lower(): float(weight) for kw, weight in items if kw}
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Build a regex matching any of words, factored as a trie so the engine
+    follows at most one branch per character and prefers the longest word.
+    """
+    trie: Dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    return _trie_node_pattern(trie)
+
+
+def _trie_node_pattern(node: Dict) -> str:
+    branches = [
+        re.escape(char) + _trie_node_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    word_ends_here = "" in node
+    if len(branches) == 1 and not word_ends_here:
+        return branches[0]
+    pattern = "(?:" + "|".join(branches) + ")"
+    return pattern + "?" if word_ends_here else pattern
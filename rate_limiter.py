@@ -0,0 +1,474 @@
+"""
+Client-side admission control for Gemini calls.
+
+Before a call goes out it must pass two checks:
+
+1. Token buckets on requests per minute and estimated input tokens per
+   minute, per model. A request reserves its share up front and learns how
+   long it has to wait for it; if that is longer than the maximum queue time
+   it is rejected at once (with the wait as Retry-After) instead of piling
+   onto the quota and failing with a 429 later. Bucket state is kept in
+   memory, or in a SQLite file shared by all worker processes when
+   GEMINI_LIMITER_DB is set.
+2. A per-process concurrency limit. Callers queue FIFO for a free slot; the
+   call is rejected when the queue is full or no slot frees up within the
+   remaining queue time, and its bucket reservation is then refunded. The
+   slots are not shared between worker processes, so W workers allow up to
+   W x GEMINI_MAX_CONCURRENCY calls in flight: divide the intended total by
+   the worker count. Only the rate limits are enforced across processes.
+
+A call that falls back to another model charges that model's buckets too,
+under the slot it already holds. When the shared SQLite store is locked for
+longer than its busy timeout, the call is rejected rather than failed.
+
+Limits default to 0 (unlimited), so nothing is throttled until configured:
+
+    GEMINI_RPM=300 GEMINI_TPM=1000000
+    GEMINI_MODEL_RPM="gemini-2.5-pro=150"  GEMINI_MODEL_TPM="gemini-2.5-pro=500000"
+    GEMINI_MAX_CONCURRENCY=16 GEMINI_MAX_QUEUE=64 GEMINI_MAX_QUEUE_TIME=10
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+
+def _model_limits(name: str) -> Dict[str, float]:
+    """Parse "model=limit,..." from the environment variable `name`."""
+    return {
+        model.strip(): float(limit)
+        for model, _, limit in (
+            item.partition("=") for item in (os.getenv(name) or "").split(",") if item.strip()
+        )
+    }
+
+
+REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_RPM", "0"))
+TOKENS_PER_MINUTE = float(os.getenv("GEMINI_TPM", "0"))
+MODEL_REQUESTS_PER_MINUTE = _model_limits("GEMINI_MODEL_RPM")
+MODEL_TOKENS_PER_MINUTE = _model_limits("GEMINI_MODEL_TPM")
+# In-flight Gemini calls per process (0 = unlimited) and callers allowed to queue
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "0"))
+MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "64"))
+# Longest a call may wait for the rate limit and a free slot together
+MAX_QUEUE_TIME = float(os.getenv("GEMINI_MAX_QUEUE_TIME", "10"))
+# SQLite file holding bucket state shared across worker processes
+LIMITER_DB = os.getenv("GEMINI_LIMITER_DB")
+
+
+class Limits(NamedTuple):
+    requests_per_minute: float = 0.0
+    tokens_per_minute: float = 0.0
+
+
+class AdmissionRejected(Exception):
+    """The call can't be admitted within the maximum queue time."""
+
+    def __init__(self, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason  # "rate", "queue" or "store"
+
+
+# (bucket key, limit per minute, amount requested)
+BucketRequest = Tuple[str, float, float]
+
+
+def _refill(tokens: float, updated: float, now: float, per_minute: float) -> float:
+    return min(per_minute, tokens + (now - updated) * per_minute / 60.0)
+
+
+def _refund(tokens: float, updated: float, now: float, per_minute: float, amount: float) -> float:
+    return min(per_minute, _refill(tokens, updated, now, per_minute) + min(amount, per_minute))
+
+
+def _wait_for(tokens: float, amount: float, per_minute: float) -> float:
+    # A single request larger than the bucket only waits for a full bucket
+    return max(0.0, (min(amount, per_minute) - tokens) * 60.0 / per_minute)
+
+
+class MemoryBucketStore:
+    """Token buckets for a single process."""
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, requests: List[BucketRequest], max_wait: float) -> Tuple[bool, float]:
+        """
+        Reserve amounts from several buckets at once. Returns (True, wait) with
+        the seconds to wait before using the reservation, or (False, wait)
+        without reserving when wait would exceed max_wait.
+        """
+        now = time.time()
+        with self._lock:
+            levels = {}
+            wait = 0.0
+            for key, per_minute, amount in requests:
+                tokens, updated = self._buckets.get(key, (per_minute, now))
+                tokens = _refill(tokens, updated, now, per_minute)
+                levels[key] = tokens
+                wait = max(wait, _wait_for(tokens, amount, per_minute))
+            if wait > max_wait:
+                return False, wait
+            for key, per_minute, amount in requests:
+                self._buckets[key] = (levels[key] - min(amount, per_minute), now)
+            return True, wait
+
+    def refund(self, requests: List[BucketRequest]) -> None:
+        """Give back a reservation that went unused."""
+        now = time.time()
+        with self._lock:
+            for key, per_minute, amount in requests:
+                if key in self._buckets:
+                    tokens, updated = self._buckets[key]
+                    self._buckets[key] = (_refund(tokens, updated, now, per_minute, amount), now)
+
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file, shared by every process that opens it."""
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        # Seconds to wait for another process's lock before rejecting the call
+        self.timeout = timeout
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread and process; connections must not cross a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def reserve(self, requests: List[BucketRequest], max_wait: float) -> Tuple[bool, float]:
+        """
+        Same contract as MemoryBucketStore.reserve, atomic across processes.
+        Raises AdmissionRejected when the file stays locked or can't be used.
+        """
+        try:
+            return self._reserve(requests, max_wait)
+        except sqlite3.Error as e:
+            logger.warning("Rate limiter store %s unavailable: %s", self.path, e)
+            raise AdmissionRejected("Gemini rate limiter is busy", 1.0, "store") from e
+
+    def _reserve(self, requests: List[BucketRequest], max_wait: float) -> Tuple[bool, float]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            levels = {}
+            wait = 0.0
+            for key, per_minute, amount in requests:
+                row = conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                tokens, updated = row if row else (per_minute, now)
+                tokens = _refill(tokens, updated, now, per_minute)
+                levels[key] = tokens
+                wait = max(wait, _wait_for(tokens, amount, per_minute))
+            if wait > max_wait:
+                conn.execute("ROLLBACK")
+                return False, wait
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                [
+                    (key, levels[key] - min(amount, per_minute), now)
+                    for key, per_minute, amount in requests
+                ],
+            )
+            conn.execute("COMMIT")
+            return True, wait
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def refund(self, requests: List[BucketRequest]) -> None:
+        """Give back a reservation that went unused. Best effort: failures are logged."""
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                for key, per_minute, amount in requests:
+                    row = conn.execute(
+                        "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row:
+                        conn.execute(
+                            "UPDATE buckets SET tokens = ?, updated = ? WHERE key = ?",
+                            (_refund(row[0], row[1], now, per_minute, amount), now, key),
+                        )
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning("Could not refund rate limiter reservation: %s", e)
+
+
+class _Waiter:
+    __slots__ = ("granted", "wake")
+
+    def __init__(self, wake):
+        self.granted = False
+        self.wake = wake
+
+
+class ConcurrencyGate:
+    """
+    Counting semaphore with a bounded FIFO wait queue, usable from threads
+    and event loops alike. A released slot is handed directly to the oldest
+    waiter, so late arrivals can't overtake the queue.
+    """
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _try_enter(self, wake) -> Tuple[bool, Optional[_Waiter]]:
+        """Take a free slot, or enqueue a waiter. Raises AdmissionRejected when the queue is full."""
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return True, None
+            if len(self._waiters) >= self.max_queue:
+                raise AdmissionRejected("Too many requests are queued", 1.0, "queue")
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+            return False, waiter
+
+    def _give_up(self, waiter: _Waiter) -> bool:
+        """After a timeout: True if the slot was granted meanwhile, else leave the queue."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def acquire(self, timeout: float) -> bool:
+        event = threading.Event()
+        entered, waiter = self._try_enter(event.set)
+        if entered:
+            return True
+        event.wait(max(0.0, timeout))
+        return waiter.granted or self._give_up(waiter)
+
+    async def acquire_async(self, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        entered, waiter = self._try_enter(wake)
+        if entered:
+            return True
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._give_up(waiter):
+                self.release()
+            raise
+        return waiter.granted or self._give_up(waiter)
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                # Hand the slot over without freeing it
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self.active -= 1
+
+
+class AdmissionController:
+    """Rate limits plus concurrency limit, applied with admit() / admit_async()."""
+
+    def __init__(
+        self,
+        default_limits: Limits = Limits(),
+        model_limits: Optional[Dict[str, Limits]] = None,
+        max_concurrency: int = 0,
+        max_queue: int = 64,
+        max_queue_time: float = 10.0,
+        store=None,
+    ):
+        self.default_limits = default_limits
+        self.model_limits = model_limits or {}
+        self.max_queue_time = max_queue_time
+        self.store = store or MemoryBucketStore()
+        self.gate = ConcurrencyGate(max_concurrency, max_queue) if max_concurrency > 0 else None
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        models = set(MODEL_REQUESTS_PER_MINUTE) | set(MODEL_TOKENS_PER_MINUTE)
+        model_limits = {
+            model: Limits(
+                MODEL_REQUESTS_PER_MINUTE.get(model, REQUESTS_PER_MINUTE),
+                MODEL_TOKENS_PER_MINUTE.get(model, TOKENS_PER_MINUTE),
+            )
+            for model in models
+        }
+        store = SQLiteBucketStore(LIMITER_DB) if LIMITER_DB else MemoryBucketStore()
+        return cls(
+            Limits(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE), model_limits,
+            MAX_CONCURRENCY, MAX_QUEUE, MAX_QUEUE_TIME, store,
+        )
+
+    def limits_for(self, model: str) -> Limits:
+        return self.model_limits.get(model, self.default_limits)
+
+    def _bucket_requests(self, model: str, tokens: int) -> List[BucketRequest]:
+        limits = self.limits_for(model)
+        requests = []
+        if limits.requests_per_minute > 0:
+            requests.append((f"rpm:{model}", limits.requests_per_minute, 1))
+        if limits.tokens_per_minute > 0:
+            requests.append((f"tpm:{model}", limits.tokens_per_minute, max(1, tokens)))
+        return requests
+
+    def _check_reservation(self, model: str, granted: bool, wait: float) -> None:
+        if not granted:
+            logger.warning("Rate limit for %s: rejecting call that would wait %.1fs", model, wait)
+            raise AdmissionRejected("Gemini rate limit reached", wait, "rate")
+
+    def _reserve(self, model: str, tokens: int) -> Tuple[List[BucketRequest], float]:
+        """Reserve the model's buckets; return the requests and the seconds to wait."""
+        requests = self._bucket_requests(model, tokens)
+        if not requests:
+            return requests, 0.0
+        granted, wait = self.store.reserve(requests, self.max_queue_time)
+        self._check_reservation(model, granted, wait)
+        return requests, wait
+
+    async def _reserve_async(self, model: str, tokens: int) -> Tuple[List[BucketRequest], float]:
+        requests = self._bucket_requests(model, tokens)
+        if not requests:
+            return requests, 0.0
+        if isinstance(self.store, MemoryBucketStore):
+            granted, wait = self.store.reserve(requests, self.max_queue_time)
+        else:
+            granted, wait = await asyncio.to_thread(
+                self.store.reserve, requests, self.max_queue_time
+            )
+        self._check_reservation(model, granted, wait)
+        return requests, wait
+
+    def _refund(self, requests: List[BucketRequest]) -> None:
+        # The call never went out, so its reservation goes back to the buckets
+        if requests:
+            self.store.refund(requests)
+
+    async def _refund_async(self, requests: List[BucketRequest]) -> None:
+        if not requests:
+            return
+        if isinstance(self.store, MemoryBucketStore):
+            self.store.refund(requests)
+        else:
+            await asyncio.to_thread(self.store.refund, requests)
+
+    @contextlib.contextmanager
+    def admit(self, model: str, tokens: int = 0) -> Iterator[None]:
+        """
+        Wait for the model's rate limits and a concurrency slot, then run the
+        block. Raises AdmissionRejected if that would take too long.
+        """
+        started = time.monotonic()
+        requests, wait = self._reserve(model, tokens)
+        if wait:
+            time.sleep(wait)
+        if self.gate is None:
+            yield
+            return
+        remaining = self.max_queue_time - (time.monotonic() - started)
+        try:
+            acquired = self.gate.acquire(remaining)
+        except BaseException:
+            self._refund(requests)
+            raise
+        if not acquired:
+            self._refund(requests)
+            raise AdmissionRejected("Timed out waiting for a free slot", 1.0, "queue")
+        try:
+            yield
+        finally:
+            self.gate.release()
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, model: str, tokens: int = 0) -> AsyncIterator[None]:
+        """Asyncio variant of admit()."""
+        started = time.monotonic()
+        requests, wait = await self._reserve_async(model, tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        if self.gate is None:
+            yield
+            return
+        remaining = self.max_queue_time - (time.monotonic() - started)
+        try:
+            acquired = await self.gate.acquire_async(remaining)
+        except BaseException:
+            await self._refund_async(requests)
+            raise
+        if not acquired:
+            await self._refund_async(requests)
+            raise AdmissionRejected("Timed out waiting for a free slot", 1.0, "queue")
+        try:
+            yield
+        finally:
+            self.gate.release()
+
+    def charge(self, model: str, tokens: int = 0) -> None:
+        """
+        Wait for the model's rate limits without taking a concurrency slot,
+        for another attempt within an admitted call (a fallback model).
+        Raises AdmissionRejected if that would take too long.
+        """
+        _, wait = self._reserve(model, tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def charge_async(self, model: str, tokens: int = 0) -> None:
+        """Asyncio variant of charge()."""
+        _, wait = await self._reserve_async(model, tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+
+ADMISSION = AdmissionController.from_env()
@@ -0,0 +1,98 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+SingleFlight.do(key, fn) runs fn() once for any number of callers that ask
+for the same key while it is in flight: the first caller runs it, the others
+wait and receive the same result (or exception). Nothing is cached once the
+call completes; the next caller for the key starts a new call.
+
+do_async(key, fn) is the event-loop counterpart. The shared call runs as its
+own task, so a caller that gets cancelled (e.g. its client disconnected)
+doesn't cancel the work for the others.
+"""
+import asyncio
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Group of calls deduplicated by key, within one process."""
+
+    def __init__(self, name: str = "calls"):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Hashable, "asyncio.Task"] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls) + len(self._tasks)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Return (fn()'s result, shared), where shared is True when the result
+        came from a call started by another caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            logger.info("Coalesced duplicate %s onto in-flight call", self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Asyncio variant of do(); fn() returns an awaitable."""
+        with self._lock:
+            task = self._tasks.get(key)
+            leader = task is None
+            if leader:
+                task = self._tasks[key] = asyncio.ensure_future(fn())
+                task.add_done_callback(lambda _: self._forget_task(key, task))
+
+        if not leader:
+            logger.info("Coalesced duplicate %s onto in-flight call", self.name)
+        return await asyncio.shield(task), not leader
+
+    def _forget_task(self, key: Hashable, task: "asyncio.Task") -> None:
+        with self._lock:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+        if not task.cancelled():
+            # Mark the exception retrieved when every caller has gone away
+            task.exception()
@@ -0,0 +1,249 @@
+import asyncio
+import contextvars
+import json
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret-key")
+
+import asgi
+import assistant_core
+
+
+def _call(path, payload, method="POST", disconnect=None):
+    """Drive the ASGI app once and return (status, headers, body)."""
+    sent = []
+    incoming = [{
+        "type": "http.request",
+        "body": json.dumps(payload).encode("utf-8"),
+        "more_body": False,
+    }]
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        if disconnect is not None:
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+        await asyncio.sleep(3600)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "http_version": "1.1",
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+    }
+    asyncio.run(asgi.app(scope, receive, send))
+
+    start = sent[0]
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], dict(start["headers"]), body
+
+
+def _patch_store(monkeypatch, saved):
+    monkeypatch.setattr(asgi.ConversationManager, "create_conversation", lambda: "test-id")
+    monkeypatch.setattr(asgi.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+    monkeypatch.setattr(asgi.ConversationManager, "add_messages", lambda *args: saved.append(args))
+
+
+def test_asgi_ask_route_success(monkeypatch):
+    saved = []
+    _patch_store(monkeypatch, saved)
+
+    async def mock_ask(prompt, conversation_history=None, **kwargs):
+        return "Hi there"
+
+    monkeypatch.setattr(asgi, "ask_gemini_async", mock_ask)
+
+    status, headers, body = _call("/ask", {"prompt": "Hello"})
+
+    assert status == 200
+    assert json.loads(body) == {
+        "response": "Hi there", "conversation_id": "test-id", "cached": False
+    }
+    assert b"set-cookie" in headers
+    assert saved == [("test-id", [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Hi there"},
+    ])]
+
+
+def test_asgi_ask_route_handles_assistant_error(monkeypatch):
+    _patch_store(monkeypatch, [])
+
+    async def _raise(prompt, conversation_history=None, **kwargs):
+        raise asgi.AssistantError("Nope")
+
+    monkeypatch.setattr(asgi, "ask_gemini_async", _raise)
+
+    status, _, body = _call("/ask", {"prompt": "Hello", "conversation_id": "test-id"})
+
+    assert status == 400
+    assert json.loads(body)["error"] == "Nope"
+
+
+def test_asgi_native_routes_are_counted_in_metrics(monkeypatch):
+    _patch_store(monkeypatch, [])
+
+    async def _raise(prompt, conversation_history=None, **kwargs):
+        raise asgi.AssistantError("Nope")
+
+    monkeypatch.setattr(asgi, "ask_gemini_async", _raise)
+    counted = asgi.metrics.HTTP_REQUESTS.value(route="/ask", method="POST", status="400")
+    loads = asgi.metrics.ASK_STAGE_SECONDS.count(route="/ask", stage="history_load")
+
+    _call("/ask", {"prompt": "Hello", "conversation_id": "test-id"})
+
+    assert asgi.metrics.HTTP_REQUESTS.value(route="/ask", method="POST", status="400") == counted + 1
+    assert asgi.metrics.ASK_STAGE_SECONDS.count(route="/ask", stage="history_load") == loads + 1
+
+
+def test_asgi_ask_stream_route_emits_chunks(monkeypatch):
+    saved = []
+    _patch_store(monkeypatch, saved)
+
+    async def mock_stream(prompt, conversation_history=None, **kwargs):
+        for chunk in ("Hel", "lo"):
+            yield chunk
+
+    monkeypatch.setattr(asgi, "ask_gemini_stream_async", mock_stream)
+
+    status, headers, body = _call("/ask/stream", {"prompt": "Hi", "conversation_id": "test-id"})
+    text = body.decode("utf-8")
+
+    assert status == 200
+    assert headers[b"content-type"] == b"text/event-stream"
+    assert text.index("event: start") < text.index('"Hel"') < text.index("event: done")
+    assert saved == [("test-id", [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+    ])]
+
+
+def test_asgi_ask_stream_rejection_gets_status_and_retry_after(monkeypatch):
+    saved = []
+    _patch_store(monkeypatch, saved)
+
+    async def mock_stream(prompt, conversation_history=None, **kwargs):
+        raise assistant_core.RateLimitedError("slow down", retry_after=0.2)
+        yield
+
+    monkeypatch.setattr(asgi, "ask_gemini_stream_async", mock_stream)
+
+    status, headers, body = _call("/ask/stream", {"prompt": "Hi", "conversation_id": "test-id"})
+
+    assert status == 429
+    assert headers[b"retry-after"] == b"1"
+    assert json.loads(body) == {"error": "slow down"}
+    assert saved == []
+
+
+def test_asgi_ask_stream_persists_partial_answer_on_disconnect(monkeypatch):
+    saved = []
+    _patch_store(monkeypatch, saved)
+    state = {}
+
+    async def mock_stream(prompt, conversation_history=None, **kwargs):
+        yield "first "
+        state.setdefault("disconnect", asyncio.Event()).set()
+        await asyncio.sleep(3600)
+        yield "never"
+
+    monkeypatch.setattr(asgi, "ask_gemini_stream_async", mock_stream)
+
+    class LazyEvent:
+        async def wait(self):
+            await state.setdefault("disconnect", asyncio.Event()).wait()
+
+    status, _, _ = _call("/ask/stream", {"prompt": "Hi", "conversation_id": "test-id"},
+                         disconnect=LazyEvent())
+
+    assert status == 200
+    assert saved == [("test-id", [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "first "},
+    ])]
+
+
+def test_asgi_delegates_other_routes_to_flask():
+    status, _, body = _call("/", {}, method="GET")
+
+    assert status == 200
+    assert b"My AI Assistant" in body
+
+
+def test_asgi_ask_replays_answer_for_idempotency_key(monkeypatch):
+    conversation = {"id": "test-id", "messages": [
+        {"role": "user", "content": "Hello", "idempotency_key": "abc"},
+        {"role": "assistant", "content": "Stored answer"},
+    ]}
+    monkeypatch.setattr(asgi.ConversationManager, "load_conversation", lambda _: conversation)
+
+    async def mock_ask(prompt, conversation_history=None, **kwargs):
+        raise AssertionError("should not regenerate")
+
+    monkeypatch.setattr(asgi, "ask_gemini_async", mock_ask)
+
+    status, _, body = _call(
+        "/ask", {"prompt": "Hello", "conversation_id": "test-id", "idempotency_key": "abc"}
+    )
+
+    assert status == 200
+    assert json.loads(body)["response"] == "Stored answer"
+
+
+def test_asgi_ask_stream_replays_answer_for_idempotency_key(monkeypatch):
+    conversation = {"id": "test-id", "messages": [
+        {"role": "user", "content": "Hello", "idempotency_key": "abc"},
+        {"role": "assistant", "content": "Stored answer"},
+    ]}
+    monkeypatch.setattr(asgi.ConversationManager, "load_conversation", lambda _: conversation)
+
+    def mock_stream(prompt, **kwargs):
+        raise AssertionError("should not regenerate")
+
+    monkeypatch.setattr(asgi, "ask_gemini_stream_async", mock_stream)
+
+    status, headers, body = _call(
+        "/ask/stream", {"prompt": "Hello", "conversation_id": "test-id", "idempotency_key": "abc"}
+    )
+
+    assert status == 200
+    assert headers[b"content-type"] == b"text/event-stream"
+    assert b'{"text": "Stored answer"}' in body and b"event: done" in body
+
+
+def test_flask_routes_survive_keep_alive_requests(monkeypatch):
+    # On a keep-alive connection the next request's task can inherit the
+    # context that the previous response's send() ran in
+    monkeypatch.setattr(asgi.ConversationManager, "list_conversations", lambda: [])
+    statuses = []
+    contexts = []
+
+    scope = {
+        "type": "http", "method": "GET", "path": "/conversations", "http_version": "1.1",
+        "query_string": b"", "headers": [], "server": ("127.0.0.1", 5000),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+        contexts.append(contextvars.copy_context())
+
+    async def run():
+        await asgi.app(dict(scope), receive, send)
+        for _ in range(3):
+            await asyncio.get_running_loop().create_task(
+                asgi.app(dict(scope), receive, send), context=contexts[-1]
+            )
+
+    asyncio.run(run())
+    assert statuses == [200, 200, 200, 200]
@@ -22,15 +22,15 @@ class DummyClient:
 
 
 def test_fetch_gemini_data_returns_text(monkeypatch):
-    monkeypatch.setattr(assistant.genai, "Client", lambda api_key: DummyClient("ok"))
+    monkeypatch.setattr(assistant, "get_client", lambda api_key: DummyClient("ok"))
 
     assert assistant.fetch_gemini_data("Hi") == "ok"
 
 
 def test_fetch_gemini_data_handles_exception(monkeypatch):
     monkeypatch.setattr(
-        assistant.genai,
-        "Client",
+        assistant,
+        "get_client",
         lambda api_key: DummyClient(error=ValueError("boom")),
     )
 
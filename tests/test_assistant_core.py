@@ -1,10 +1,13 @@
+import asyncio
 import os
+import threading
 from types import SimpleNamespace
 
 os.environ.setdefault("GEMINI_API_KEY", "test-key")
 
 import assistant_core
 import pytest
+from rate_limiter import AdmissionController, Limits
 
 
 def _set_fake_client(monkeypatch, response):
@@ -12,8 +15,22 @@ def _set_fake_client(monkeypatch, response):
         def generate_content(self, *args, **kwargs):
             return response
 
+        def generate_content_stream(self, *args, **kwargs):
+            return iter(response)
+
+    class FakeAsyncModels:
+        async def generate_content(self, *args, **kwargs):
+            return response
+
+        async def generate_content_stream(self, *args, **kwargs):
+            async def _iterate():
+                for chunk in response:
+                    yield chunk
+            return _iterate()
+
     class FakeClient:
         models = FakeModels()
+        aio = SimpleNamespace(models=FakeAsyncModels())
 
     monkeypatch.setattr(assistant_core, "client", FakeClient())
 
@@ -76,6 +93,7 @@ def test_contextual_prompt_includes_time_and_flags(monkeypatch):
         "EXTRA_ASSISTANT_CONTEXT",
         "Organization policy reminder.",
     )
+    assistant_core.PROMPT_BUILDER.clear()
 
     prompt = "Please research the current government policy timeline this week."
     contextual_prompt, meta = assistant_core._build_contextual_prompt(prompt)
@@ -97,3 +115,539 @@ def test_analyze_prompt_detects_flags():
     assert is_sensitive is True
     assert is_research is True
     assert is_time_sensitive is True
+
+
+def test_ask_gemini_stream_yields_chunks(monkeypatch):
+    chunks = [
+        SimpleNamespace(text="Hello"),
+        SimpleNamespace(text=None, candidates=[]),
+        SimpleNamespace(text=" world"),
+    ]
+    _set_fake_client(monkeypatch, chunks)
+
+    result = list(assistant_core.ask_gemini_stream("Say hi."))
+
+    assert result == ["Hello", " world"]
+
+
+def test_ask_gemini_stream_empty_prompt_raises_eagerly():
+    with pytest.raises(assistant_core.AssistantError):
+        assistant_core.ask_gemini_stream("   ")
+
+
+def test_ask_gemini_stream_raises_if_no_text(monkeypatch):
+    _set_fake_client(monkeypatch, [SimpleNamespace(text=None, candidates=[])])
+
+    with pytest.raises(assistant_core.AssistantError):
+        list(assistant_core.ask_gemini_stream("Need details."))
+
+
+def test_ask_gemini_async_returns_response_text(monkeypatch):
+    _set_fake_client(monkeypatch, SimpleNamespace(text="Hello async"))
+
+    result = asyncio.run(assistant_core.ask_gemini_async("Tell me something fun."))
+
+    assert result == "Hello async"
+
+
+def test_ask_gemini_stream_async_yields_chunks(monkeypatch):
+    _set_fake_client(monkeypatch, [SimpleNamespace(text="A"), SimpleNamespace(text="B")])
+
+    async def collect():
+        return [chunk async for chunk in assistant_core.ask_gemini_stream_async("Go.")]
+
+    assert asyncio.run(collect()) == ["A", "B"]
+
+
+def _set_counting_client(monkeypatch, text):
+    calls = []
+
+    class FakeModels:
+        def generate_content(self, *args, **kwargs):
+            calls.append(kwargs)
+            return SimpleNamespace(text=text)
+
+        def generate_content_stream(self, *args, **kwargs):
+            calls.append(kwargs)
+            return iter([SimpleNamespace(text=text)])
+
+    monkeypatch.setattr(assistant_core, "client", SimpleNamespace(models=FakeModels()))
+    return calls
+
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    cache = assistant_core.ResponseCache(max_entries=8)
+    monkeypatch.setattr(assistant_core, "response_cache", cache)
+    return cache
+
+
+def test_response_cache_serves_repeated_deterministic_prompt(monkeypatch, response_cache):
+    calls = _set_counting_client(monkeypatch, "Cached answer")
+    history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+
+    first, second = {}, {}
+    assert assistant_core.ask_gemini("What is DNS?", history, temperature=0, metadata=first) == "Cached answer"
+    assert assistant_core.ask_gemini("What is DNS?", history, temperature=0, metadata=second) == "Cached answer"
+
+    assert len(calls) == 1
+    assert first["cached"] is False
+    assert second["cached"] is True
+
+
+def test_response_cache_key_covers_history_and_settings(monkeypatch, response_cache):
+    calls = _set_counting_client(monkeypatch, "Answer")
+
+    assistant_core.ask_gemini("What is DNS?", temperature=0)
+    assistant_core.ask_gemini("What is DNS?", [{"role": "user", "content": "Hi"}], temperature=0)
+    assistant_core.ask_gemini("What is DNS?", temperature=0, max_output_tokens=512)
+    assistant_core.ask_gemini("What is DNS?", temperature=0, model="other-model")
+
+    assert len(calls) == 4
+
+
+def test_response_cache_skips_nondeterministic_and_time_sensitive(monkeypatch, response_cache):
+    calls = _set_counting_client(monkeypatch, "Answer")
+
+    for _ in range(2):
+        assistant_core.ask_gemini("What is DNS?", temperature=0.7)
+        assistant_core.ask_gemini("What is the latest news today?", temperature=0)
+
+    assert len(calls) == 4
+
+    monkeypatch.setattr(assistant_core, "RESPONSE_CACHE_TIME_SENSITIVE_TTL", 60)
+    for _ in range(2):
+        assistant_core.ask_gemini("What is the latest news today?", temperature=0)
+
+    assert len(calls) == 5
+
+
+def test_response_cache_entries_expire(monkeypatch):
+    cache = assistant_core.ResponseCache(max_entries=2)
+    now = [1000.0]
+    monkeypatch.setattr(assistant_core.time, "time", lambda: now[0])
+
+    cache.put("a", "A", ttl=10)
+    assert cache.get("a") == "A"
+    now[0] += 11
+    assert cache.get("a") is None
+
+
+def test_response_cache_disk_tier_survives_restart(tmp_path):
+    cache = assistant_core.ResponseCache(max_entries=1, directory=str(tmp_path))
+    cache.put("a" * 64, "A", ttl=60)
+    cache.put("b" * 64, "B", ttl=60)
+
+    fresh = assistant_core.ResponseCache(max_entries=1, directory=str(tmp_path))
+    assert fresh.get("a" * 64) == "A"
+    assert fresh.get("b" * 64) == "B"
+    assert fresh.get("c" * 64) is None
+
+
+def test_response_cache_disk_writes_from_several_threads(tmp_path, caplog):
+    cache = assistant_core.ResponseCache(max_entries=1, directory=str(tmp_path))
+
+    def write(n):
+        for _ in range(200):
+            cache.put("a" * 64, f"A{n}", ttl=60)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    fresh = assistant_core.ResponseCache(max_entries=1, directory=str(tmp_path))
+    assert fresh.get("a" * 64) in {f"A{n}" for n in range(8)}
+    assert not list(tmp_path.rglob("*.tmp"))
+    assert "Failed to write response cache entry" not in caplog.text
+
+
+def test_response_cache_streams_cached_answer(monkeypatch, response_cache):
+    calls = _set_counting_client(monkeypatch, "Streamed")
+
+    assert list(assistant_core.ask_gemini_stream("What is DNS?", temperature=0)) == ["Streamed"]
+    metadata = {}
+    chunks = list(assistant_core.ask_gemini_stream("What is DNS?", temperature=0, metadata=metadata))
+
+    assert chunks == ["Streamed"]
+    assert metadata["cached"] is True
+    assert len(calls) == 1
+
+
+def test_estimate_tokens_counts_non_ascii_per_character():
+    assert assistant_core.estimate_tokens("") == 0
+    assert assistant_core.estimate_tokens("abcdefgh") == 2
+    assert assistant_core.estimate_tokens("日本語") == 3
+
+
+def test_history_window_keeps_newest_turns_within_budget(monkeypatch):
+    captured = {}
+
+    class FakeModels:
+        def generate_content(self, *args, **kwargs):
+            captured.update(kwargs)
+            return SimpleNamespace(text="ok")
+
+    monkeypatch.setattr(assistant_core, "client", SimpleNamespace(models=FakeModels()))
+    history = []
+    for i in range(30):
+        history.append({"role": "user", "content": f"question {i} " + "x" * 400})
+        history.append({"role": "assistant", "content": f"answer {i} " + "y" * 400})
+    prompt = "Next question?"
+
+    system_only = assistant_core._prepare_request(prompt, [], 0.7, 2048).contents[0].parts[0].text
+    fixed = (
+        assistant_core.estimate_tokens(system_only) + assistant_core.estimate_tokens(prompt)
+        + 3 * assistant_core.MESSAGE_TOKEN_OVERHEAD + 8
+    )
+    monkeypatch.setattr(assistant_core, "HISTORY_TOKEN_BUDGET", fixed + 1000)
+
+    metadata = {}
+    assistant_core.ask_gemini(prompt, history, metadata=metadata)
+
+    stats = metadata["history"]
+    assert 0 < stats["messages"] < len(history)
+    assert stats["tokens"] <= 1000
+    assert stats["messages"] + stats["dropped"] == len(history)
+    sent = [c.parts[0].text for c in captured["contents"][2:-1]]
+    assert sent == [m["content"] for m in history[-stats["messages"]:]]
+    assert captured["contents"][2].role == "user"
+
+
+def test_history_window_uses_model_budget_and_exact_counts(monkeypatch):
+    counted = []
+
+    class FakeModels:
+        def count_tokens(self, model, contents):
+            counted.append(contents)
+            return SimpleNamespace(total_tokens=100)
+
+    monkeypatch.setattr(assistant_core, "client", SimpleNamespace(models=FakeModels()))
+    monkeypatch.setattr(assistant_core, "EXACT_TOKEN_COUNT", True)
+    monkeypatch.setattr(assistant_core, "_exact_token_counts", assistant_core.OrderedDict())
+    monkeypatch.setattr(assistant_core, "MODEL_TOKEN_BUDGETS", {"small-model": 250})
+    turns = [("user", "a"), ("model", "b"), ("user", "c"), ("model", "d")]
+
+    window, stats = assistant_core.select_history(
+        turns, assistant_core.token_budget_for("small-model"), "small-model"
+    )
+
+    # Two turns fit; the window may not start with a model turn.
+    assert window == [("user", "c"), ("model", "d")]
+    assert stats == {"messages": 2, "tokens": 208, "dropped": 2}
+    assistant_core.select_history(turns, 250, "small-model")
+    assert counted == ["d", "c", "b"]
+
+
+def test_exact_token_counts_evict_least_recently_used(monkeypatch):
+    counted = []
+
+    class FakeModels:
+        def count_tokens(self, model, contents):
+            counted.append(contents)
+            return SimpleNamespace(total_tokens=1)
+
+    monkeypatch.setattr(assistant_core, "client", SimpleNamespace(models=FakeModels()))
+    monkeypatch.setattr(assistant_core, "EXACT_TOKEN_COUNT", True)
+    monkeypatch.setattr(assistant_core, "_exact_token_counts", assistant_core.OrderedDict())
+    monkeypatch.setattr(assistant_core, "_EXACT_TOKEN_COUNTS_MAX", 2)
+
+    for text in ["a", "b", "a", "c", "a", "b"]:
+        assistant_core._count_tokens(text, "m")
+
+    # "a" stayed cached because it was used again; "b" was evicted by "c"
+    assert counted == ["a", "b", "c", "b"]
+
+
+def test_history_summary_is_added_to_system_context():
+    request = assistant_core._prepare_request(
+        "And then?", [{"role": "user", "content": "Recent"}], 0.7, 2048,
+        history_summary="The user is planning a trip to Lisbon.",
+    )
+
+    system_message = request.contents[0].parts[0].text
+    assert "Summary of the earlier part of this conversation:" in system_message
+    assert "planning a trip to Lisbon" in system_message
+    assert [c.parts[0].text for c in request.contents[2:]] == ["Recent", "And then?"]
+
+
+def test_summarize_history_sends_previous_summary_and_new_messages(monkeypatch):
+    captured = {}
+
+    class FakeModels:
+        def generate_content(self, *args, **kwargs):
+            captured.update(kwargs)
+            return SimpleNamespace(text=" New summary. ")
+
+    monkeypatch.setattr(assistant_core, "client", SimpleNamespace(models=FakeModels()))
+
+    result = assistant_core.summarize_history(
+        "Old summary.", [{"role": "user", "content": "Book flights"}]
+    )
+
+    assert result == "New summary."
+    assert "Old summary." in captured["contents"]
+    assert "user: Book flights" in captured["contents"]
+
+
+class _FakeCachingClient:
+    """Local stand-in for the Gemini caching API plus generate_content."""
+
+    def __init__(self, fail_create=False, fail_cached_generate=False):
+        self.created = []
+        self.deleted = []
+        self.generated = []
+        self.fail_create = fail_create
+        self.fail_cached_generate = fail_cached_generate
+        self.caches = SimpleNamespace(create=self._create, delete=self._delete)
+        self.models = SimpleNamespace(generate_content=self._generate)
+
+    def _create(self, model, config):
+        if self.fail_create:
+            raise RuntimeError("caching unavailable")
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    def _delete(self, name):
+        self.deleted.append(name)
+
+    def _generate(self, model, contents, config):
+        self.generated.append((contents, config))
+        if config.cached_content and self.fail_cached_generate:
+            raise RuntimeError("cache expired")
+        return SimpleNamespace(text="ok")
+
+
+def _long_history(pairs):
+    history = []
+    for i in range(pairs):
+        history.append({"role": "user", "content": f"question {i} " + "q" * 200})
+        history.append({"role": "assistant", "content": f"answer {i} " + "a" * 200})
+    return history
+
+
+@pytest.fixture
+def context_caching(monkeypatch):
+    monkeypatch.setattr(assistant_core, "CONTEXT_CACHE_ENABLED", True)
+    monkeypatch.setattr(assistant_core, "CONTEXT_CACHE_MIN_TOKENS", 500)
+    monkeypatch.setattr(assistant_core, "CONTEXT_CACHE_STEP", 4)
+    monkeypatch.setattr(assistant_core, "_context_cache_failures", {})
+
+    def install(**kwargs):
+        fake = _FakeCachingClient(**kwargs)
+        monkeypatch.setattr(assistant_core, "client", fake)
+        return fake
+    return install
+
+
+def test_context_cache_created_then_reused(context_caching, monkeypatch):
+    monkeypatch.setattr(assistant_core, "CONTEXT_CACHE_STEP", 8)
+    fake = context_caching()
+    history = _long_history(6)
+
+    metadata = {}
+    assistant_core.ask_gemini("Next?", history, context_cache={}, metadata=metadata)
+    record = metadata["context_cache"]
+
+    assert record["name"] == "cachedContents/1"
+    assert record["message_count"] == 8
+    created = fake.created[0]
+    assert "current time is the time stated there" in created.system_instruction
+    assert len(created.contents) == 8
+    contents, config = fake.generated[0]
+    assert config.cached_content == "cachedContents/1"
+    # Only the uncached tail plus the prompt (with the clock) are sent
+    assert len(contents) == 5
+    assert "The current date is" in contents[-1].parts[0].text
+    assert contents[-1].parts[1].text == "Next?"
+
+    history += [{"role": "user", "content": "Next?"}, {"role": "assistant", "content": "ok"}]
+    metadata = {}
+    assistant_core.ask_gemini("And?", history, context_cache=record, metadata=metadata)
+
+    assert len(fake.created) == 1
+    assert metadata["context_cache"] == record
+    assert fake.generated[1][1].cached_content == "cachedContents/1"
+
+
+def test_context_cache_refreshed_when_prefix_changes_or_expires(context_caching, monkeypatch):
+    fake = context_caching()
+    metadata = {}
+    assistant_core.ask_gemini("Next?", _long_history(6), context_cache={}, metadata=metadata)
+    first = metadata["context_cache"]
+
+    assistant_core.ask_gemini("Next?", _long_history(8), context_cache=first, metadata=metadata)
+    second = metadata["context_cache"]
+    assert second["name"] == "cachedContents/2"
+    assert second["message_count"] == 12
+    assert fake.deleted == ["cachedContents/1"]
+
+    expired = dict(second, expires_at=assistant_core.time.time())
+    assistant_core.ask_gemini("Next?", _long_history(8), context_cache=expired, metadata=metadata)
+    assert metadata["context_cache"]["name"] == "cachedContents/3"
+
+
+def test_context_cache_reused_while_history_window_slides(context_caching, monkeypatch):
+    monkeypatch.setattr(assistant_core, "CONTEXT_CACHE_STEP", 8)
+    # Room for the newest 14 messages of the history only
+    monkeypatch.setattr(assistant_core, "HISTORY_TOKEN_BUDGET", 930)
+    fake = context_caching()
+
+    metadata = {}
+    assistant_core.ask_gemini("Next?", _long_history(13), context_cache={}, metadata=metadata)
+    first = metadata["context_cache"]
+    assert metadata["history"]["dropped"] == 12
+    assert (first["start"], first["message_count"]) == (16, 8)
+
+    # One exchange later the window starts two messages further on
+    assistant_core.ask_gemini("Next?", _long_history(14), context_cache=first, metadata=metadata)
+
+    assert metadata["history"]["dropped"] == 14
+    assert metadata["context_cache"] == first
+    assert len(fake.created) == 1
+    contents, config = fake.generated[1]
+    assert config.cached_content == "cachedContents/1"
+    # Messages 24-27 follow the cached 16-23, then the prompt
+    assert contents[0].parts[0].text.startswith("question 12 ")
+    assert len(contents) == 5
+
+
+def test_context_cache_creation_is_admitted_by_the_rate_limiter(context_caching, monkeypatch):
+    controller = AdmissionController(Limits(requests_per_minute=1), max_queue_time=0)
+    monkeypatch.setattr(assistant_core, "ADMISSION", controller)
+    fake = context_caching()
+
+    # Creating the cache takes the only request of the minute
+    with pytest.raises(assistant_core.RateLimitedError):
+        assistant_core.ask_gemini("Next?", _long_history(6), context_cache={})
+    assert len(fake.created) == 1
+    assert fake.generated == []
+
+
+def test_context_cache_falls_back_when_unavailable(context_caching):
+    fake = context_caching(fail_create=True)
+    history = _long_history(6)
+
+    metadata = {}
+    assert assistant_core.ask_gemini("Next?", history, context_cache={}, metadata=metadata) == "ok"
+    assert metadata["context_cache"] is None
+    assert fake.generated[0][1].cached_content is None
+
+    # The failing prefix is not retried straight away
+    fake.fail_create = False
+    assistant_core.ask_gemini("Next?", history, context_cache={}, metadata=metadata)
+    assert fake.created == []
+
+
+def test_context_cache_failures_drop_only_expired_entries(monkeypatch):
+    monkeypatch.setattr(assistant_core, "_context_cache_failures", {})
+    monkeypatch.setattr(assistant_core, "_CONTEXT_CACHE_FAILURES_MAX", 3)
+    now = [1000.0]
+    monkeypatch.setattr(assistant_core.time, "time", lambda: now[0])
+    error = RuntimeError("quota")
+
+    assistant_core._context_cache_failed("a", error)
+    now[0] += assistant_core.CONTEXT_CACHE_RETRY_AFTER + 1
+    assistant_core._context_cache_failed("b", error)
+    assistant_core._context_cache_failed("c", error)
+    assert list(assistant_core._context_cache_failures) == ["b", "c"]
+
+    # Past the cap the entry closest to expiring goes, not all of them
+    assistant_core._context_cache_failed("d", error)
+    assistant_core._context_cache_failed("e", error)
+    assert list(assistant_core._context_cache_failures) == ["c", "d", "e"]
+
+
+def test_context_cache_retries_without_cache_when_call_fails(context_caching):
+    fake = context_caching(fail_cached_generate=True)
+
+    metadata = {}
+    result = assistant_core.ask_gemini("Next?", _long_history(6), context_cache={}, metadata=metadata)
+
+    assert result == "ok"
+    assert [config.cached_content for _, config in fake.generated] == ["cachedContents/1", None]
+    assert metadata["context_cache"] is None
+
+
+def test_context_cache_skipped_for_short_or_opted_out_requests(context_caching):
+    fake = context_caching()
+
+    metadata = {}
+    assistant_core.ask_gemini("Next?", _long_history(1), context_cache={}, metadata=metadata)
+    assistant_core.ask_gemini("Next?", _long_history(6))
+
+    assert fake.created == []
+    assert metadata["context_cache"] is None
+
+
+def test_prompt_builder_reuses_preamble_within_a_minute(monkeypatch):
+    builder = assistant_core.PromptBuilder()
+    now = [120.0]
+    clock_calls = []
+
+    def fake_clock():
+        clock_calls.append(now[0])
+        return "March 15, 2030", f"10:{int(now[0] // 60):02d} UTC"
+
+    monkeypatch.setattr(assistant_core.time, "time", lambda: now[0])
+    monkeypatch.setattr(assistant_core, "_current_datetime_strings", fake_clock)
+
+    first = builder.preamble((True, False, True))
+    now[0] += 30
+    assert builder.preamble((True, False, True)) is first
+    assert len(clock_calls) == 1
+
+    now[0] += 30
+    refreshed = builder.preamble((True, False, True))
+    assert refreshed is not first
+    assert "10:03 UTC" in refreshed.system_content.parts[0].text
+    assert len(clock_calls) == 2
+
+    with_summary = builder.preamble((True, False, True), "Earlier: trip planning.")
+    assert "Earlier: trip planning." in with_summary.system_content.parts[0].text
+    assert "Earlier: trip planning." in with_summary.stable_system
+    assert "10:03 UTC" in with_summary.dynamic_context
+
+
+def test_prompt_builder_picks_up_extra_context_changes(monkeypatch):
+    builder = assistant_core.PromptBuilder()
+    before = builder.preamble((False, False, False))
+
+    monkeypatch.setattr(assistant_core, "EXTRA_ASSISTANT_CONTEXT", "Be brief.")
+
+    after = builder.preamble((False, False, False))
+    assert "Be brief." not in before.system_content.parts[0].text
+    assert "Be brief." in after.system_content.parts[0].text
+
+
+def test_history_contents_are_bounded_by_total_text_size():
+    builder = assistant_core.PromptBuilder(max_history_bytes=100)
+    first = builder.history_content("user", "a" * 40)
+    builder.history_content("user", "b" * 40)
+    assert builder.history_content("user", "a" * 40) is first
+
+    builder.history_content("user", "c" * 40)
+    # "b" was the least recently used and made room for "c"
+    assert builder.history_content("user", "a" * 40) is first
+    assert ("user", "b" * 40) not in builder._history
+    assert builder._history_bytes == 80
+    # A message bigger than the whole cache is converted but not kept
+    builder.history_content("user", "x" * 101)
+    assert len(builder._history) == 2
+
+
+def test_history_contents_are_converted_once_per_message(monkeypatch):
+    builder = assistant_core.PromptBuilder()
+    monkeypatch.setattr(assistant_core, "PROMPT_BUILDER", builder)
+    monkeypatch.setattr(assistant_core.time, "time", lambda: 600.0)
+    history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+
+    first = assistant_core._prepare_request("Next?", history, 0.7, 2048).contents
+    history += [{"role": "user", "content": "Next?"}, {"role": "assistant", "content": "Sure"}]
+    second = assistant_core._prepare_request("Again?", history, 0.7, 2048).contents
+
+    assert second[0] is first[0]
+    assert second[1] is first[1] is builder.ack_content
+    assert second[2] is first[2] and second[3] is first[3]
+    assert [c.parts[0].text for c in second[4:]] == ["Next?", "Sure", "Again?"]
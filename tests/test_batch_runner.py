@@ -0,0 +1,153 @@
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import pytest
+
+import assistant
+import batch_runner
+from assistant_core import AssistantError
+
+
+def _write_input(path, records):
+    path.write_text("".join(
+        (record if isinstance(record, str) else json.dumps(record)) + "\n" for record in records
+    ), encoding="utf-8")
+
+
+def _read_output(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+@pytest.fixture
+def fake_ask(monkeypatch):
+    """ask_gemini stand-in: 'slow' prompts take longer, 'fail' raises."""
+    calls = []
+
+    def answer(prompt, kwargs):
+        calls.append((prompt, kwargs))
+        if prompt == "fail":
+            raise AssistantError("nope")
+        return f"answer to {prompt}"
+
+    def ask(prompt, metadata=None, **kwargs):
+        time.sleep(0.2 if prompt.startswith("slow") else 0)
+        metadata["model"] = kwargs["model"]
+        return answer(prompt, kwargs)
+
+    async def ask_async(prompt, metadata=None, **kwargs):
+        await asyncio.sleep(0.2 if prompt.startswith("slow") else 0)
+        metadata["model"] = kwargs["model"]
+        return answer(prompt, kwargs)
+
+    monkeypatch.setattr(batch_runner, "ask_gemini", ask)
+    monkeypatch.setattr(batch_runner, "ask_gemini_async", ask_async)
+    return calls
+
+
+@pytest.mark.parametrize("mode", ["thread", "asyncio"])
+def test_input_order_is_preserved(tmp_path, fake_ask, mode):
+    source, target = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source, [{"id": "a", "prompt": "slow one"}, {"id": "b", "prompt": "fast"}])
+
+    summary = batch_runner.run_batch(str(source), str(target), order="input", mode=mode)
+
+    assert [r["id"] for r in _read_output(target)] == ["a", "b"]
+    assert summary.succeeded == 2 and summary.failed == 0
+
+
+@pytest.mark.parametrize("mode", ["thread", "asyncio"])
+def test_completion_order_writes_fast_results_first(tmp_path, fake_ask, mode):
+    source, target = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source, [{"id": "a", "prompt": "slow one"}, {"id": "b", "prompt": "fast"}])
+
+    batch_runner.run_batch(str(source), str(target), mode=mode)
+
+    assert [r["id"] for r in _read_output(target)] == ["b", "a"]
+
+
+def test_per_line_options_override_defaults(tmp_path, fake_ask):
+    source, target = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    history = [{"role": "user", "content": "earlier"}]
+    _write_input(source, [
+        {"prompt": "one", "model": "other-model", "temperature": 0.1, "history": history},
+        {"prompt": "two"},
+    ])
+
+    batch_runner.run_batch(
+        str(source), str(target), order="input", defaults={"model": "base", "temperature": 0.5}
+    )
+
+    first, second = sorted(fake_ask)
+    assert first[1] == {
+        "model": "other-model", "temperature": 0.1, "conversation_history": history,
+    }
+    assert second[1] == {"model": "base", "temperature": 0.5}
+    results = _read_output(target)
+    assert [r["id"] for r in results] == ["1", "2"]
+    assert results[0]["model"] == "other-model"
+
+
+def test_errors_and_bad_lines_are_reported_per_item(tmp_path, fake_ask):
+    source, target = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source, [{"id": "x", "prompt": "fail"}, "{not json", {"id": "y"}, "", {"prompt": "ok"}])
+
+    summary = batch_runner.run_batch(str(source), str(target), order="input")
+
+    results = _read_output(target)
+    assert results[0] == {"id": "x", "error": "nope"}
+    assert results[1]["id"] == "2" and "Invalid input line" in results[1]["error"]
+    assert results[2] == {"id": "y", "error": "Missing prompt"}
+    assert results[3]["response"] == "answer to ok"
+    assert (summary.succeeded, summary.failed) == (1, 3)
+
+
+def test_resume_skips_completed_ids_and_retries_failures(tmp_path, fake_ask):
+    source, target = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source, [{"id": i, "prompt": f"p{i}"} for i in range(4)])
+    # Previous run: 0 succeeded, 1 failed, then crashed mid-line
+    target.write_text(
+        json.dumps({"id": "0", "response": "old"}) + "\n"
+        + json.dumps({"id": "1", "error": "boom"}) + "\n"
+        + '{"id": "2", "resp', encoding="utf-8",
+    )
+
+    summary = batch_runner.run_batch(str(source), str(target), order="input", resume=True)
+
+    assert sorted(prompt for prompt, _ in fake_ask) == ["p1", "p2", "p3"]
+    assert summary.skipped == 1 and summary.succeeded == 3
+    assert batch_runner.completed_ids(str(target)) == {"0", "1", "2", "3"}
+    assert target.read_text(encoding="utf-8").splitlines()[2] == '{"id": "2", "resp'
+
+
+def test_token_bucket_spaces_out_requests():
+    bucket = batch_runner.TokenBucket(rate=20, burst=1)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # First token is free, the next four wait 1/20s each
+    assert time.monotonic() - started >= 0.18
+
+
+def test_summary_reports_throughput_and_latency():
+    summary = batch_runner.BatchSummary(4, 3, 1, 2, 2.0, [0.1, 0.2, 0.4])
+    assert summary.throughput == 2.0
+    assert summary.latency_quantile(0.5) == 0.2
+    text = summary.format()
+    assert "Processed 4 prompts in 2.0s (2.00/s)" in text
+    assert "2 skipped" in text
+    assert "p95=0.40s" in text
+
+
+def test_cli_batch_command(tmp_path, fake_ask, capsys):
+    source, target = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    _write_input(source, [{"id": "a", "prompt": "hello"}])
+
+    assistant.main(["batch", str(source), "-o", str(target), "--rate", "50", "--model", "m"])
+
+    assert _read_output(target)[0]["response"] == "answer to hello"
+    assert fake_ask[0][1]["model"] == "m"
+    assert "Processed 1 prompts" in capsys.readouterr().err
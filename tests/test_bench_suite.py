@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import pytest
+
+from benchmarks import bench_suite
+
+LOGGERS = ("conversation_manager", "conversation_store", "assistant_core", "call_policy", "tracing")
+
+
+@pytest.fixture(autouse=True)
+def restore_log_levels():
+    levels = {name: logging.getLogger(name).level for name in LOGGERS}
+    yield
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+
+def test_compare_reports_only_cases_beyond_the_threshold():
+    baseline = {"a": {"median": 1.0}, "b": {"median": 1.0}, "gone": {"median": 1.0}}
+    results = {"a": {"median": 1.2}, "b": {"median": 1.3}, "new": {"median": 9.0}}
+
+    regressions = bench_suite.compare(results, baseline, threshold=0.25)
+
+    assert len(regressions) == 1
+    assert regressions[0].startswith("b: 1000.000 ms -> 1300.000 ms")
+
+
+def test_small_run_writes_results_and_fails_against_a_faster_baseline(tmp_path):
+    output = tmp_path / "results.json"
+    args = ["--sizes", "5", "--messages", "3", "--min-time", "0", "--workdir", str(tmp_path / "work")]
+
+    assert bench_suite.main(args + ["--output", str(output)]) == 0
+
+    results = json.loads(output.read_text())["results"]
+    for name in (
+        "create_conversation[json,n=5]",
+        "list_conversations[sqlite,n=5,limit=50]",
+        "load_conversation[json,n=5,messages=3]",
+        "add_message[sqlite,n=5,messages=3]",
+        "delete_conversation[sqlite,n=5]",
+        "_analyze_prompt[chars=100]",
+        "ask_gemini[stubbed,messages=3]",
+    ):
+        assert results[name]["rounds"] >= bench_suite.MIN_ROUNDS
+
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"results": {
+        "ask_gemini[stubbed,messages=3]": {"median": 1e-9},
+    }}))
+    assert bench_suite.main(args + ["--filter", "ask_gemini", "--baseline", str(baseline)]) == 1
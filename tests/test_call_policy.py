@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import httpx
+import pytest
+from google.genai import errors as genai_errors
+
+import assistant_core
+import call_policy
+import fake_gemini
+import gemini_client
+from call_policy import CallPolicy
+
+
+class FakeGemini(fake_gemini.FakeGemini):
+    def client(self, **options):
+        options.setdefault("read_timeout", 5)
+        return gemini_client.get_client(
+            "fake-key", gemini_client.ClientOptions(base_url=self.url, http2=False, **options)
+        )
+
+
+@pytest.fixture
+def fake():
+    server = FakeGemini().start()
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def clean_latency():
+    call_policy.LATENCY.clear()
+    yield
+    call_policy.LATENCY.clear()
+
+
+def _policy(**overrides):
+    values = dict(
+        max_attempts=3, base_delay=0, max_delay=0, max_retry_after=30, hedge=False,
+        hedge_delay=None, hedge_quantile=0.95, fallback_model="lite", deadline=30,
+    )
+    values.update(overrides)
+    return CallPolicy(**values)
+
+
+def _generate(client):
+    return lambda model: client.models.generate_content(model=model, contents="hi").text
+
+
+def test_retries_transient_errors_then_succeeds(fake):
+    fake.push({"status": 503}, {"status": 429, "retry_after": 0})
+    metadata = {}
+
+    text = call_policy.call(_generate(fake.client()), "main", _policy(), metadata=metadata)
+
+    assert text == "answer from main"
+    assert [a["outcome"] for a in metadata["attempts"]] == ["error", "error", "ok"]
+    assert [a["status"] for a in metadata["attempts"]] == [503, 429, None]
+    assert [a["kind"] for a in metadata["attempts"]] == ["primary", "retry", "retry"]
+    assert metadata["model"] == "main"
+
+
+def test_non_retryable_error_is_raised_immediately(fake):
+    fake.push({"status": 400})
+    with pytest.raises(genai_errors.ClientError):
+        call_policy.call(_generate(fake.client()), "main", _policy())
+    assert fake.models == ["main"]
+
+
+def test_gives_up_after_max_attempts(fake):
+    fake.push(*[{"status": 500}] * 3)
+    with pytest.raises(genai_errors.ServerError):
+        call_policy.call(_generate(fake.client()), "main", _policy())
+    assert len(fake.models) == 3
+
+
+def test_honours_retry_after(fake):
+    fake.push({"status": 429, "retry_after": 0.3})
+    started = time.monotonic()
+    assert call_policy.call(_generate(fake.client()), "main", _policy()) == "answer from main"
+    assert time.monotonic() - started >= 0.3
+
+
+def test_does_not_wait_for_excessive_retry_after(fake):
+    fake.push({"status": 429, "retry_after": 120})
+    with pytest.raises(genai_errors.ClientError):
+        call_policy.call(_generate(fake.client()), "main", _policy(max_retry_after=5))
+    assert len(fake.models) == 1
+
+
+def test_hedged_request_beats_slow_primary(fake):
+    fake.push({"delay": 1.5})
+    metadata = {}
+    started = time.monotonic()
+
+    text = call_policy.call(
+        _generate(fake.client()), "main", _policy(hedge=True, hedge_delay=0.1), metadata=metadata
+    )
+
+    assert text == "answer from main"
+    assert time.monotonic() - started < 1.0
+    assert len(fake.models) == 2
+    assert [(a["kind"], a["outcome"]) for a in metadata["attempts"]] == [("hedge", "ok")]
+
+
+def test_hedged_attempts_run_in_the_callers_context():
+    request_id = contextvars.ContextVar("request_id", default=None)
+    seen = []
+
+    def slow(model):
+        seen.append((model, request_id.get()))
+        time.sleep(0.3)
+        return model
+
+    request_id.set("r1")
+    assert call_policy.call(slow, "main", _policy(hedge=True, hedge_delay=0.05)) == "main"
+    assert seen == [("main", "r1"), ("main", "r1")]
+
+
+def test_no_hedge_while_hedge_workers_are_busy(monkeypatch):
+    monkeypatch.setattr(call_policy, "_hedge_slots", threading.BoundedSemaphore(1))
+    calls = []
+
+    def slow(model):
+        calls.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return model
+
+    assert call_policy.call(slow, "main", _policy(hedge=True, hedge_delay=0.05)) == "main"
+    assert len(calls) == 1 and calls[0].startswith("gemini-hedge")
+
+    # With none free the primary runs on the calling thread
+    busy = threading.BoundedSemaphore(1)
+    busy.acquire()
+    monkeypatch.setattr(call_policy, "_hedge_slots", busy)
+    assert call_policy.call(slow, "main", _policy(hedge=True, hedge_delay=0.05)) == "main"
+    assert calls[1] == threading.current_thread().name
+
+
+def test_async_hedge_cancels_the_loser(fake):
+    fake.push({"delay": 1.5})
+    client = fake.client()
+    metadata = {}
+
+    async def run():
+        return await call_policy.call_async(
+            lambda model: client.aio.models.generate_content(model=model, contents="hi"),
+            "main", _policy(hedge=True, hedge_delay=0.1), metadata=metadata,
+        )
+
+    started = time.monotonic()
+    response = asyncio.run(run())
+
+    assert response.text == "answer from main"
+    assert time.monotonic() - started < 1.0
+    outcomes = sorted((a["kind"], a["outcome"]) for a in metadata["attempts"])
+    assert outcomes == [("hedge", "ok"), ("primary", "cancelled")]
+
+
+def test_hedge_delay_defaults_to_observed_p95(fake):
+    for _ in range(call_policy.LATENCY.min_samples):
+        call_policy.LATENCY.record("generate", "main", 0.1)
+    fake.push({"delay": 1.5})
+
+    started = time.monotonic()
+    call_policy.call(_generate(fake.client()), "main", _policy(hedge=True))
+    assert time.monotonic() - started < 1.0
+
+
+def test_falls_back_when_deadline_is_at_risk(fake):
+    for _ in range(call_policy.LATENCY.min_samples):
+        call_policy.LATENCY.record("generate", "main", 10.0)
+    metadata = {}
+
+    text = call_policy.call(_generate(fake.client()), "main", _policy(deadline=5), metadata=metadata)
+
+    assert text == "answer from lite"
+    assert fake.models == ["lite"]
+    assert metadata["model"] == "lite"
+
+
+def test_timeout_retries_on_fallback_model(fake):
+    fake.push({"delay": 1.0})
+    text = call_policy.call(_generate(fake.client(read_timeout=0.2)), "main", _policy())
+    assert text == "answer from lite"
+    assert fake.models == ["main", "lite"]
+
+
+def test_attempt_listeners_see_every_attempt(fake):
+    seen = []
+    call_policy.add_attempt_listener(seen.append)
+    try:
+        fake.push({"status": 503})
+        call_policy.call(_generate(fake.client()), "listened", _policy())
+    finally:
+        call_policy.remove_attempt_listener(seen.append)
+    # Abandoned hedges from other tests may report late; only check this call.
+    assert [(a.outcome, a.status) for a in seen if a.model == "listened"] == [
+        ("error", 503), ("ok", None),
+    ]
+
+
+def test_open_stream_retries_until_first_chunk():
+    calls = []
+
+    def stream(model):
+        calls.append(model)
+        if len(calls) == 1:
+            raise ConnectionError("reset")
+        yield "a"
+        yield "b"
+
+    chunks = call_policy.open_stream(stream, "main", _policy())
+    assert list(chunks) == ["a", "b"]
+    assert calls == ["main", "main"]
+
+
+def test_open_stream_async_retries_until_first_chunk():
+    calls = []
+
+    async def chunks():
+        yield "a"
+        yield "b"
+
+    async def stream(model):
+        calls.append(model)
+        if len(calls) == 1:
+            raise httpx.ConnectError("refused")
+        return chunks()
+
+    async def run():
+        stream_iter = await call_policy.open_stream_async(stream, "main", _policy())
+        return [chunk async for chunk in stream_iter]
+
+    assert asyncio.run(run()) == ["a", "b"]
+    assert calls == ["main", "main"]
+
+
+def test_retry_after_parsing():
+    info = genai_errors.APIError(429, {"error": {"details": [
+        {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "13s"},
+    ]}})
+    assert call_policy.retry_after(info) == 13.0
+
+    dated = SimpleNamespace(response=SimpleNamespace(
+        headers={"retry-after": formatdate(time.time() + 30, usegmt=True)}
+    ))
+    assert 25 < call_policy.retry_after(dated) <= 30
+
+    assert call_policy.retry_after(ValueError("no delay")) is None
+
+
+def test_ask_gemini_reports_backend_unavailable(monkeypatch, fake):
+    fake.push(*[{"status": 503, "retry_after": 0}] * 3)
+    monkeypatch.setattr(assistant_core, "client", fake.client())
+    monkeypatch.setattr(call_policy, "CallPolicy", lambda: _policy())
+
+    with pytest.raises(assistant_core.BackendUnavailableError) as info:
+        assistant_core.ask_gemini("hello", temperature=0.7)
+    assert info.value.retry_after == 0
+    assert len(fake.models) == 3
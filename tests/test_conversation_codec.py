@@ -0,0 +1,55 @@
+import gzip
+import json
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import conversation_codec
+import pytest
+
+RECORD = {"id": "c1", "messages": [{"role": "user", "content": "Grüße, 世界"}], "n": 2 ** 70}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def codec(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(conversation_codec, "orjson", None)
+    elif conversation_codec.orjson is None:
+        pytest.skip("orjson is not installed")
+    return conversation_codec
+
+
+def test_dumps_is_compact_and_round_trips(codec):
+    data = codec.dumps(RECORD)
+
+    assert b" " not in data.replace("Grüße, 世界".encode("utf-8"), b"")
+    assert "世界".encode("utf-8") in data
+    assert codec.loads(data) == RECORD
+
+
+def test_decode_detects_the_stored_format(codec, monkeypatch):
+    monkeypatch.setattr(codec, "CONVERSATION_COMPRESS_MIN_BYTES", 10)
+    monkeypatch.setattr(codec, "CONVERSATION_COMPRESSION", "gzip")
+    compressed = codec.encode(RECORD)
+    legacy = json.dumps(RECORD, indent=2, ensure_ascii=False).encode("utf-8")
+
+    assert compressed.startswith(codec.GZIP_MAGIC)
+    assert gzip.decompress(compressed) == codec.dumps(RECORD)
+    assert codec.decode(compressed) == RECORD
+    assert codec.decode(legacy) == RECORD
+
+
+def test_small_records_are_not_compressed(monkeypatch):
+    monkeypatch.setattr(conversation_codec, "CONVERSATION_COMPRESSION", "gzip")
+
+    assert conversation_codec.encode({"id": "c1"}) == b'{"id":"c1"}'
+
+
+def test_zstd_without_the_package_falls_back_to_gzip(monkeypatch):
+    monkeypatch.setattr(conversation_codec, "zstandard", None)
+    monkeypatch.setattr(conversation_codec, "CONVERSATION_COMPRESSION", "zstd")
+    monkeypatch.setattr(conversation_codec, "CONVERSATION_COMPRESS_MIN_BYTES", 0)
+
+    assert conversation_codec.encode(RECORD).startswith(conversation_codec.GZIP_MAGIC)
+    with pytest.raises(RuntimeError, match="zstandard"):
+        conversation_codec.decode(conversation_codec.ZSTD_MAGIC + b"\x00")
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import tempfile
@@ -6,7 +7,9 @@ from pathlib import Path
 
 os.environ.setdefault("GEMINI_API_KEY", "test-key")
 
+import conversation_codec
 import conversation_manager
+import conversation_store
 import pytest
 
 
@@ -31,6 +34,16 @@ def test_create_conversation(temp_conversations_dir):
     assert conv_file.exists()
 
 
+def test_create_conversation_with_id_keeps_an_existing_one(temp_conversations_dir):
+    manager = conversation_manager.ConversationManager
+
+    assert manager.create_conversation("fixed-id") == "fixed-id"
+    manager.add_message("fixed-id", "user", "Hello")
+    assert manager.create_conversation("fixed-id") == "fixed-id"
+
+    assert [m["content"] for m in manager.load_conversation("fixed-id")["messages"]] == ["Hello"]
+
+
 def test_save_and_load_conversation(temp_conversations_dir):
     """Test saving and loading a conversation."""
     conv = {
@@ -112,3 +125,344 @@ def test_add_message_to_nonexistent_conversation(temp_conversations_dir):
     result = conversation_manager.ConversationManager.add_message("nonexistent", "user", "Hello")
     assert result is None
 
+
+def test_async_operations_round_trip(temp_conversations_dir):
+    """Test the async wrappers used by the ASGI app."""
+    manager = conversation_manager.ConversationManager
+
+    async def scenario():
+        conv_id = await manager.create_conversation_async()
+        await manager.add_message_async(conv_id, "user", "Hello")
+        loaded = await manager.load_conversation_async(conv_id)
+        listed = await manager.list_conversations_async()
+        deleted = await manager.delete_conversation_async(conv_id)
+        return loaded, listed, deleted
+
+    loaded, listed, deleted = asyncio.run(scenario())
+
+    assert loaded["messages"][0]["content"] == "Hello"
+    assert listed[0]["message_count"] == 1
+    assert deleted is True
+
+
+def test_list_conversations_uses_index_without_reading_files(temp_conversations_dir, monkeypatch):
+    """Test that listing is served from the metadata index."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.add_message(conv_id, "user", "What is   the tallest mountain?")
+    manager.add_message(conv_id, "assistant", "Mount Everest.")
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("list_conversations should not parse conversation files")
+
+    monkeypatch.setattr(conversation_codec, "decode", _fail)
+    conversations = manager.list_conversations()
+
+    assert conversations == [{
+        "id": conv_id,
+        "created_at": conversations[0]["created_at"],
+        "updated_at": conversations[0]["updated_at"],
+        "message_count": 2,
+        "title": "What is the tallest mountain?",
+        "preview": "Mount Everest.",
+    }]
+
+
+def test_list_conversations_limit_returns_newest(temp_conversations_dir):
+    """Test that limit returns only the most recently updated conversations."""
+    manager = conversation_manager.ConversationManager
+    ids = [manager.create_conversation() for _ in range(3)]
+    manager.add_message(ids[0], "user", "bump")
+
+    conversations = manager.list_conversations(limit=2)
+
+    assert len(conversations) == 2
+    assert conversations[0]["id"] == ids[0]
+
+
+def test_delete_conversation_removes_index_entry(temp_conversations_dir):
+    """Test that deleting a conversation drops it from the listing."""
+    manager = conversation_manager.ConversationManager
+    keep_id = manager.create_conversation()
+    drop_id = manager.create_conversation()
+
+    manager.delete_conversation(drop_id)
+
+    assert [conv["id"] for conv in manager.list_conversations()] == [keep_id]
+
+
+def test_rebuild_index_recovers_from_disk(temp_conversations_dir):
+    """Test rebuilding the index from existing conversation files."""
+    manager = conversation_manager.ConversationManager
+    legacy = {
+        "id": "legacy-id",
+        "created_at": "2024-01-01T00:00:00",
+        "updated_at": "2024-01-01T00:00:00",
+        "messages": [{"role": "user", "content": "Old question", "timestamp": "2024-01-01T00:00:00"}],
+    }
+    with open(Path(temp_conversations_dir) / "legacy-id.json", "w", encoding="utf-8") as f:
+        json.dump(legacy, f)
+    index_path = Path(temp_conversations_dir) / conversation_store.INDEX_FILENAME
+    index_path.write_text("not json at all", encoding="utf-8")
+
+    count = manager.rebuild_index()
+
+    assert count == 1
+    assert manager.list_conversations()[0]["title"] == "Old question"
+
+
+def test_index_survives_torn_trailing_line(temp_conversations_dir):
+    """Test that a partially written index line is skipped, not fatal."""
+    manager = conversation_manager.ConversationManager
+    first_id = manager.create_conversation()
+    index_path = Path(temp_conversations_dir) / conversation_store.INDEX_FILENAME
+    with open(index_path, "a", encoding="utf-8") as f:
+        f.write('{"op": "upsert", "entry": {"id": "tor')
+
+    second_id = manager.create_conversation()
+
+    listed = {conv["id"] for conv in manager.list_conversations()}
+    assert listed == {first_id, second_id}
+
+
+def test_add_messages_appends_without_rewriting_snapshot(temp_conversations_dir):
+    """Test that a user/assistant pair is one log append, not a snapshot rewrite."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    snapshot = Path(temp_conversations_dir) / f"{conv_id}.json"
+    before = snapshot.read_bytes()
+
+    updated = manager.add_messages(conv_id, [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello!"},
+    ])
+
+    assert snapshot.read_bytes() == before
+    assert [m["content"] for m in updated["messages"]] == ["Hi", "Hello!"]
+    log_lines = (Path(temp_conversations_dir) / f"{conv_id}.jsonl").read_text().splitlines()
+    assert len(log_lines) == 3  # header + two messages
+    assert manager.load_conversation(conv_id)["messages"] == updated["messages"]
+
+
+def test_message_log_is_compacted_at_threshold(temp_conversations_dir, monkeypatch):
+    """Test that the log is folded into the snapshot once it grows large."""
+    monkeypatch.setattr(conversation_store, "LOG_COMPACT_THRESHOLD", 3)
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+
+    for i in range(4):
+        manager.add_message(conv_id, "user", f"message {i}")
+
+    with open(Path(temp_conversations_dir) / f"{conv_id}.json", encoding="utf-8") as f:
+        assert len(json.load(f)["messages"]) == 3
+    loaded = manager.load_conversation(conv_id)
+    assert [m["content"] for m in loaded["messages"]] == [f"message {i}" for i in range(4)]
+
+
+def test_message_log_skips_torn_trailing_line(temp_conversations_dir):
+    """Test crash recovery when the last log line was only partially written."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.add_message(conv_id, "user", "kept")
+    log_path = Path(temp_conversations_dir) / f"{conv_id}.jsonl"
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write('{"op": "message", "message": {"role": "assis')
+
+    assert [m["content"] for m in manager.load_conversation(conv_id)["messages"]] == ["kept"]
+
+    manager.add_message(conv_id, "assistant", "after crash")
+    contents = [m["content"] for m in manager.load_conversation(conv_id)["messages"]]
+    assert contents == ["kept", "after crash"]
+
+
+def test_interrupted_compaction_does_not_duplicate_messages(temp_conversations_dir):
+    """Test that a snapshot already containing logged messages skips them on replay."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.add_messages(conv_id, [
+        {"role": "user", "content": "one"},
+        {"role": "assistant", "content": "two"},
+    ])
+    log_path = Path(temp_conversations_dir) / f"{conv_id}.jsonl"
+    stale_log = log_path.read_bytes()
+
+    # Simulate a crash after the snapshot was replaced but before the log reset
+    manager.compact_conversation(conv_id)
+    log_path.write_bytes(stale_log)
+
+    contents = [m["content"] for m in manager.load_conversation(conv_id)["messages"]]
+    assert contents == ["one", "two"]
+
+
+def test_add_message_to_legacy_conversation_file(temp_conversations_dir):
+    """Test appending to a conversation saved before message logs existed."""
+    legacy = {
+        "id": "legacy-id",
+        "created_at": "2024-01-01T00:00:00",
+        "updated_at": "2024-01-01T00:00:00",
+        "messages": [{"role": "user", "content": "Old", "timestamp": "2024-01-01T00:00:00"}],
+    }
+    with open(Path(temp_conversations_dir) / "legacy-id.json", "w", encoding="utf-8") as f:
+        json.dump(legacy, f)
+
+    updated = conversation_manager.ConversationManager.add_message("legacy-id", "assistant", "New")
+
+    assert [m["content"] for m in updated["messages"]] == ["Old", "New"]
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    """Swap in an empty conversation cache with small bounds."""
+    cache = conversation_manager.ConversationCache(max_entries=2, max_bytes=1024 * 1024)
+    monkeypatch.setattr(conversation_manager, "_cache", cache)
+    return cache
+
+
+def test_load_conversation_is_served_from_cache(temp_conversations_dir, fresh_cache, monkeypatch):
+    """Test that repeated loads skip disk while the files are unchanged."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.load_conversation(conv_id)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("cached load should not parse the file")
+
+    monkeypatch.setattr(conversation_codec, "decode", _fail)
+    first = manager.load_conversation(conv_id)
+    first["messages"].append({"role": "user", "content": "local edit"})
+    second = manager.load_conversation(conv_id)
+
+    assert second["messages"] == []
+    assert manager.cache_stats()["hits"] == 2
+
+
+def test_cache_invalidated_by_writes_from_another_process(temp_conversations_dir, fresh_cache):
+    """Test that a write through a different store instance is noticed."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.load_conversation(conv_id)
+
+    other_process = conversation_store.JsonFileStore(Path(temp_conversations_dir))
+    other_process.add_messages(conv_id, [{"role": "user", "content": "from elsewhere", "timestamp": "t"}])
+
+    loaded = manager.load_conversation(conv_id)
+
+    assert [m["content"] for m in loaded["messages"]] == ["from elsewhere"]
+    assert manager.cache_stats()["invalidations"] == 1
+
+
+def test_add_messages_extends_cached_copy_without_parsing_snapshot(temp_conversations_dir, fresh_cache, monkeypatch):
+    """Test that appending to a cached conversation never re-reads the snapshot."""
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.add_message(conv_id, "user", "first")
+    manager.load_conversation(conv_id)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("snapshot should not be parsed")
+
+    monkeypatch.setattr(conversation_codec, "decode", _fail)
+    updated = manager.add_messages(conv_id, [{"role": "assistant", "content": "second"}])
+    reloaded = manager.load_conversation(conv_id)
+
+    assert [m["content"] for m in updated["messages"]] == ["first", "second"]
+    assert reloaded["messages"] == updated["messages"]
+
+
+def test_cache_evicts_least_recently_used(temp_conversations_dir, fresh_cache):
+    """Test eviction by entry count and by approximate size."""
+    manager = conversation_manager.ConversationManager
+    ids = [manager.create_conversation() for _ in range(3)]
+    for conv_id in ids:
+        manager.load_conversation(conv_id)
+
+    stats = manager.cache_stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+
+    fresh_cache.max_bytes = 2048
+    manager.add_message(ids[0], "user", "x" * 800)
+    stats = manager.cache_stats()
+    assert stats["evictions"] == 2
+    assert stats["bytes"] <= 2048
+
+
+def test_list_conversations_page_follows_cursor(temp_conversations_dir):
+    for i in range(5):
+        conversation_manager.ConversationManager.save_conversation({
+            "id": f"c{i}", "created_at": "2024-01-01T00:00:00",
+            "updated_at": f"2024-01-0{i + 1}T00:00:00", "messages": [],
+        })
+
+    first, cursor = conversation_manager.ConversationManager.list_conversations_page(2)
+    second, cursor = conversation_manager.ConversationManager.list_conversations_page(2, cursor)
+    last, end = conversation_manager.ConversationManager.list_conversations_page(2, cursor)
+
+    assert [c["id"] for c in first + second + last] == ["c4", "c3", "c2", "c1", "c0"]
+    assert end is None
+    with pytest.raises(ValueError):
+        conversation_manager.ConversationManager.list_conversations_page(2, "not-a-cursor")
+
+
+def test_load_messages_pages_from_newest(temp_conversations_dir):
+    conv_id = conversation_manager.ConversationManager.create_conversation()
+    for i in range(5):
+        conversation_manager.ConversationManager.add_message(conv_id, "user", str(i))
+
+    page = conversation_manager.ConversationManager.load_messages(conv_id, limit=3)
+    older = conversation_manager.ConversationManager.load_messages(
+        conv_id, before=page["messages_start"], limit=3
+    )
+
+    assert [m["content"] for m in page["messages"]] == ["2", "3", "4"]
+    assert page["message_count"] == 5
+    assert [m["content"] for m in older["messages"]] == ["0", "1"]
+    assert older["messages_start"] == 0
+    assert conversation_manager.ConversationManager.load_messages("missing", limit=3) is None
+
+
+def test_search_index_follows_writes(temp_conversations_dir):
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.add_message(conv_id, "user", "How long do I proof sourdough?")
+    manager.add_message(conv_id, "assistant", "Usually overnight in the fridge.")
+
+    hits = manager.search_conversations("overnight")
+    assert [(h.conversation_id, h.message_index, h.title) for h in hits] == [
+        (conv_id, 1, "How long do I proof sourdough?")
+    ]
+
+    conversation = manager.load_conversation(conv_id)
+    conversation["messages"] = conversation["messages"][:1]
+    manager.save_conversation(conversation)
+    assert manager.search_conversations("overnight") == []
+
+    manager.delete_conversation(conv_id)
+    assert manager.search_conversations("sourdough") == []
+
+
+def test_rebuild_search_index_from_store(temp_conversations_dir, monkeypatch):
+    monkeypatch.setattr(conversation_manager, "CONVERSATION_SEARCH", False)
+    conv_id = conversation_manager.ConversationManager.create_conversation()
+    conversation_manager.ConversationManager.add_message(conv_id, "user", "unindexed words")
+    assert conversation_manager.ConversationManager.search_conversations("unindexed") == []
+
+    monkeypatch.setattr(conversation_manager, "CONVERSATION_SEARCH", True)
+    assert conversation_manager.ConversationManager.rebuild_search_index() == 1
+
+    hits = conversation_manager.ConversationManager.search_conversations("unindexed")
+    assert [h.conversation_id for h in hits] == [conv_id]
+
+
+def test_repack_command_rewrites_indented_snapshots(temp_conversations_dir, capsys):
+    conv_id = conversation_manager.ConversationManager.create_conversation()
+    conversation_manager.ConversationManager.add_message(conv_id, "user", "Hello")
+    snapshot = Path(temp_conversations_dir) / f"{conv_id}.json"
+    snapshot.write_text(json.dumps(json.loads(snapshot.read_bytes()), indent=2), encoding="utf-8")
+
+    conversation_manager.main(["repack"])
+
+    assert capsys.readouterr().out.startswith("Repacked 1 conversations: ")
+    assert b"\n" not in snapshot.read_bytes()
+    loaded = conversation_manager.ConversationManager.load_conversation(conv_id)
+    assert [m["content"] for m in loaded["messages"]] == ["Hello"]
@@ -0,0 +1,96 @@
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import conversation_search
+import pytest
+
+
+def _conversation(conversation_id, *contents):
+    roles = ("user", "assistant")
+    return {
+        "id": conversation_id,
+        "updated_at": "2024-01-01T00:00:00",
+        "messages": [{"role": roles[i % 2], "content": c} for i, c in enumerate(contents)],
+    }
+
+
+@pytest.fixture
+def index(tmp_path):
+    return conversation_search.SearchIndex(tmp_path / "search.db")
+
+
+def test_build_match_query_quotes_terms_and_keeps_phrases_and_prefixes():
+    assert conversation_search.build_match_query('bread "sour dough" bak* AND') == (
+        '"bread" "sour dough" "bak"* "AND"'
+    )
+    assert conversation_search.build_match_query('say "hi') == '"say" "hi"'
+    assert conversation_search.build_match_query(' * "" - ') is None
+
+
+def test_search_ranks_one_hit_per_conversation_with_escaped_snippets(index):
+    index.replace(_conversation("a", "How do I <b>bake</b> bread?", "Bake bread at 230C, bread needs heat."))
+    index.replace(_conversation("b", "What is a sourdough starter?", "Flour and water."))
+
+    hits = index.search("bread")
+
+    assert [hit.conversation_id for hit in hits] == ["a"]
+    assert hits[0].title == "How do I <b>bake</b> bread?"
+    assert hits[0].message_index == 1
+    assert "<mark>bread</mark>" in hits[0].snippet
+    assert index.search("<b>")[0].snippet == (
+        "How do I &lt;<mark>b</mark>&gt;bake&lt;/<mark>b</mark>&gt; bread?"
+    )
+
+
+def test_phrase_prefix_and_role_filters(index):
+    index.replace(_conversation("a", "bread to bake", "I bake bread daily"))
+    index.replace(_conversation("b", "sourdough starter", "water"))
+
+    assert [h.conversation_id for h in index.search('"bake bread"')] == ["a"]
+    assert [(h.role, h.message_index) for h in index.search("bake bread", role="user")] == [("user", 0)]
+    assert index.search("water", role="user") == []
+    assert [h.conversation_id for h in index.search("sour*")] == ["b"]
+
+
+def test_incremental_updates_and_removal(index):
+    index.add_messages("a", 0, [{"role": "user", "content": "first question"}], "2024-01-01")
+    index.add_messages("a", 2, [{"role": "user", "content": "third"}], "2024-01-03")
+    index.add_messages("a", 1, [{"role": "assistant", "content": "second answer"}], "2024-01-02")
+    index.add_messages("a", 1, [{"role": "assistant", "content": "second answer"}], "2024-01-02")
+
+    hits = index.search("second")
+    assert [(h.message_index, h.title) for h in hits] == [(1, "first question")]
+    assert index.search("third")[0].message_index == 2
+
+    index.remove("a")
+
+    assert index.search("first") == []
+
+
+def test_rebuild_replaces_everything(index):
+    index.replace(_conversation("stale", "old words"))
+
+    assert index.rebuild([_conversation("a", "fresh words")]) == 1
+
+    assert [h.conversation_id for h in index.search("words")] == ["a"]
+
+
+def test_only_the_most_recent_matches_are_ranked(index, monkeypatch):
+    monkeypatch.setattr(conversation_search, "SEARCH_RANK_CANDIDATES", 2)
+    # The oldest conversation is the best match but falls outside the window
+    index.replace(_conversation("old", "tea tea tea tea"))
+    index.replace(_conversation("mid", "tea and biscuits and cake and more"))
+    index.replace(_conversation("new", "tea with a long list of other words here"))
+
+    assert [h.conversation_id for h in index.search("tea")] == ["mid", "new"]
+
+
+def test_role_filter_applies_to_the_ranked_window(index, monkeypatch):
+    monkeypatch.setattr(conversation_search, "SEARCH_RANK_CANDIDATES", 2)
+    index.replace(_conversation("asked", "tea please", "here you go"))
+    # Newer assistant matches must not push the user match out of the window
+    index.replace(_conversation("answered", "hello", "tea", "thanks", "more tea"))
+
+    hits = index.search("tea", role="user")
+    assert [(h.conversation_id, h.role) for h in hits] == [("asked", "user")]
@@ -0,0 +1,274 @@
+import json
+import multiprocessing
+import os
+import threading
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import conversation_codec
+import conversation_manager
+import conversation_store
+import pytest
+
+
+def _conversation(conversation_id, updated_at, messages=()):
+    return {
+        "id": conversation_id,
+        "created_at": "2024-01-01T00:00:00",
+        "updated_at": updated_at,
+        "messages": list(messages),
+    }
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "json":
+        return conversation_store.JsonFileStore(tmp_path)
+    return conversation_store.SQLiteStore(tmp_path / "conversations.db")
+
+
+def test_save_and_load_round_trips_extra_fields(store):
+    conversation = _conversation("c1", "2024-01-01T00:00:01", [
+        {"role": "user", "content": "Hi", "timestamp": "2024-01-01T00:00:01", "request_id": "r1"},
+    ])
+    conversation["summary"] = "A greeting."
+
+    store.save(conversation)
+
+    assert store.load("c1") == conversation
+    assert store.load("missing") is None
+
+
+def test_add_messages_appends_and_updates_listing(store):
+    store.save(_conversation("c1", "2024-01-01T00:00:00"))
+
+    updated = store.add_messages("c1", [
+        {"role": "user", "content": "Question?", "timestamp": "2024-01-02T00:00:00"},
+        {"role": "assistant", "content": "Answer.", "timestamp": "2024-01-02T00:00:00"},
+    ])
+
+    assert [m["content"] for m in updated["messages"]] == ["Question?", "Answer."]
+    assert store.list_conversations() == [{
+        "id": "c1",
+        "created_at": "2024-01-01T00:00:00",
+        "updated_at": "2024-01-02T00:00:00",
+        "message_count": 2,
+        "title": "Question?",
+        "preview": "Answer.",
+    }]
+    assert store.add_messages("missing", [{"role": "user", "content": "x"}]) is None
+
+
+def test_list_orders_by_updated_at_and_honours_limit(store):
+    store.save(_conversation("old", "2024-01-01T00:00:00"))
+    store.save(_conversation("new", "2024-03-01T00:00:00"))
+    store.save(_conversation("mid", "2024-02-01T00:00:00"))
+
+    assert [c["id"] for c in store.list_conversations()] == ["new", "mid", "old"]
+    assert [c["id"] for c in store.list_conversations(limit=2)] == ["new", "mid"]
+
+
+def test_keyset_pages_cover_every_conversation_once(store):
+    # Equal timestamps force the id tie-breaker to keep pages disjoint
+    for i in range(7):
+        store.save(_conversation(f"c{i}", "2024-01-02T00:00:00" if i % 2 else "2024-01-01T00:00:00"))
+
+    pages, after = [], None
+    while True:
+        page = store.list_conversations(limit=3, after=after)
+        if not page:
+            break
+        pages.append([c["id"] for c in page])
+        after = (page[-1]["updated_at"], page[-1]["id"])
+
+    assert pages == [["c5", "c3", "c1"], ["c6", "c4", "c2"], ["c0"]]
+
+
+def test_load_page_returns_a_range_of_messages(store):
+    store.save(_conversation("c1", "2024-01-01T00:00:00", [
+        {"role": "user", "content": str(i), "timestamp": "2024-01-01T00:00:00"} for i in range(5)
+    ]))
+
+    newest = store.load_page("c1", limit=2)
+    older = store.load_page("c1", before=newest["messages_start"], limit=2)
+
+    assert [m["content"] for m in newest["messages"]] == ["3", "4"]
+    assert (newest["message_count"], newest["messages_start"]) == (5, 3)
+    assert [m["content"] for m in older["messages"]] == ["1", "2"]
+    assert [m["content"] for m in store.load_page("c1", before=1, limit=10)["messages"]] == ["0"]
+    assert store.load_page("missing", limit=2) is None
+
+
+def test_delete_removes_conversation(store):
+    store.save(_conversation("c1", "2024-01-01T00:00:00", [
+        {"role": "user", "content": "Hi", "timestamp": "2024-01-01T00:00:00"},
+    ]))
+
+    assert store.delete("c1") is True
+    assert store.delete("c1") is False
+    assert store.load("c1") is None
+    assert store.list_conversations() == []
+
+
+def test_json_store_load_retries_when_compacted_mid_read(tmp_path, monkeypatch):
+    store = conversation_store.JsonFileStore(tmp_path)
+    store.save(_conversation("c1", "2024-01-01T00:00:00"))
+    store.add_messages("c1", [{"role": "user", "content": "Hi", "timestamp": "t"}])
+    read_snapshot = conversation_store._read_snapshot
+    reads = []
+
+    def read_then_compact(directory, conversation_id):
+        snapshot = read_snapshot(directory, conversation_id)
+        reads.append(conversation_id)
+        if len(reads) == 1:
+            # Another writer folds the log into a new snapshot before the log is read
+            store.compact("c1")
+        return snapshot
+
+    monkeypatch.setattr(conversation_store, "_read_snapshot", read_then_compact)
+
+    assert [m["content"] for m in store.load("c1")["messages"]] == ["Hi"]
+    assert len(reads) == 3  # the torn read, the compaction's, and the retry
+
+
+def test_sqlite_store_uses_wal_and_survives_concurrent_appends(tmp_path):
+    store = conversation_store.SQLiteStore(tmp_path / "conversations.db")
+    store.save(_conversation("c1", "2024-01-01T00:00:00"))
+
+    def worker(n):
+        for i in range(10):
+            store.add_messages("c1", [{"role": "user", "content": f"{n}-{i}", "timestamp": "t"}])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    mode = store._connect().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    assert len(store.load("c1")["messages"]) == 40
+    assert store.list_conversations()[0]["message_count"] == 40
+
+
+def test_backend_selected_by_setting(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", tmp_path)
+    monkeypatch.setattr(conversation_manager, "CONVERSATION_STORE", "sqlite")
+
+    conv_id = conversation_manager.ConversationManager.create_conversation()
+    conversation_manager.ConversationManager.add_message(conv_id, "user", "Hello")
+
+    assert isinstance(conversation_manager.get_store(), conversation_store.SQLiteStore)
+    assert (tmp_path / "conversations.db").exists()
+    assert not (tmp_path / f"{conv_id}.json").exists()
+    loaded = conversation_manager.ConversationManager.load_conversation(conv_id)
+    assert loaded["messages"][0]["content"] == "Hello"
+
+
+def test_migrate_json_directory_to_sqlite(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", tmp_path)
+    manager = conversation_manager.ConversationManager
+    conv_id = manager.create_conversation()
+    manager.add_messages(conv_id, [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello!"},
+    ])
+    original = manager.load_conversation(conv_id)
+
+    conversation_manager.main(["migrate", "--from", "json", "--to", "sqlite"])
+
+    migrated = conversation_manager.get_store("sqlite").load(conv_id)
+    assert migrated == original
+
+
+def test_update_fields_keeps_messages_and_listing(store):
+    store.save(_conversation("c1", "2024-01-01T00:00:00"))
+    store.add_messages("c1", [
+        {"role": "user", "content": "Question?", "timestamp": "2024-01-02T00:00:00"},
+    ])
+    before = store.version("c1")
+
+    assert store.update_fields("c1", {"summary": {"text": "Asked a question.", "message_count": 1}})
+
+    loaded = store.load("c1")
+    assert loaded["summary"] == {"text": "Asked a question.", "message_count": 1}
+    assert [m["content"] for m in loaded["messages"]] == ["Question?"]
+    assert loaded["updated_at"] == "2024-01-02T00:00:00"
+    assert store.version("c1") != before
+    assert store.list_conversations()[0]["message_count"] == 1
+    assert store.update_fields("missing", {"summary": None}) is False
+
+    store.compact("c1")
+    assert store.load("c1") == loaded
+
+
+def test_conditional_writes_detect_concurrent_changes(store):
+    store.save(_conversation("c1", "2024-01-01T00:00:00"))
+    seen = store.version("c1")
+    store.add_messages("c1", [{"role": "user", "content": "Hi", "timestamp": "t"}])
+
+    with pytest.raises(conversation_store.ConversationConflictError):
+        store.save(_conversation("c1", "2024-01-01T00:00:01"), expected_version=seen)
+    with pytest.raises(conversation_store.ConversationConflictError):
+        store.update_fields("c1", {"summary": None}, expected_version=seen)
+    assert len(store.load("c1")["messages"]) == 1
+
+    current = store.version("c1")
+    assert store.update_fields("c1", {"summary": None}, expected_version=current)
+    store.save(_conversation("c1", "2024-01-01T00:00:02"), expected_version=store.version("c1"))
+    assert store.load("c1")["messages"] == []
+
+
+def _append_from_worker(conv_id, worker, count):
+    manager = conversation_manager.ConversationManager
+    for i in range(count):
+        manager.add_message(conv_id, "user", f"{worker}-{i}")
+        # Keep the cached copy warm so appends also take the extend-in-place path
+        manager.load_conversation(conv_id)
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_concurrent_appends_from_processes_lose_nothing(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", tmp_path)
+    monkeypatch.setattr(conversation_manager, "CONVERSATION_STORE", backend)
+    # Compact often so appends race with snapshot rewrites too
+    monkeypatch.setattr(conversation_store, "LOG_COMPACT_THRESHOLD", 7)
+    monkeypatch.setattr(conversation_store, "CONVERSATION_FSYNC", False)
+    conv_id = conversation_manager.ConversationManager.create_conversation()
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=_append_from_worker, args=(conv_id, n, 25)) for n in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    conversation = conversation_manager.get_store().load(conv_id)
+    contents = sorted(m["content"] for m in conversation["messages"])
+    assert contents == sorted(f"{n}-{i}" for n in range(4) for i in range(25))
+    assert conversation_manager.get_store().list_conversations()[0]["message_count"] == 100
+
+
+def test_json_store_reads_every_snapshot_format_and_repacks(tmp_path, monkeypatch):
+    store = conversation_store.JsonFileStore(tmp_path)
+    legacy = _conversation("legacy", "2024-01-01T00:00:00", [
+        {"role": "user", "content": "Hi", "timestamp": "2024-01-01T00:00:00"},
+    ])
+    (tmp_path / "legacy.json").write_text(json.dumps(legacy, indent=2), encoding="utf-8")
+    store.add_messages("legacy", [{"role": "assistant", "content": "Hello", "timestamp": "t"}])
+    monkeypatch.setattr(conversation_codec, "CONVERSATION_COMPRESSION", "gzip")
+    monkeypatch.setattr(conversation_codec, "CONVERSATION_COMPRESS_MIN_BYTES", 0)
+    store.save(_conversation("packed", "2024-01-02T00:00:00", legacy["messages"]))
+
+    assert (tmp_path / "packed.json").read_bytes().startswith(conversation_codec.GZIP_MAGIC)
+    assert store.load("packed")["messages"] == legacy["messages"]
+
+    before, after = store.repack("legacy")
+
+    assert after < before
+    assert (tmp_path / "legacy.json").read_bytes().startswith(conversation_codec.GZIP_MAGIC)
+    assert [m["content"] for m in store.load("legacy")["messages"]] == ["Hi", "Hello"]
+    assert store.repack("missing") is None
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import conversation_manager
+import conversation_summary
+import pytest
+from conversation_manager import ConversationManager
+
+
+@pytest.fixture
+def temp_conversations_dir(monkeypatch):
+    temp_dir = tempfile.mkdtemp()
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", Path(temp_dir))
+    monkeypatch.setattr(conversation_summary, "SUMMARY_TRIGGER_MESSAGES", 6)
+    monkeypatch.setattr(conversation_summary, "SUMMARY_KEEP_RECENT", 2)
+    yield temp_dir
+    shutil.rmtree(temp_dir)
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    calls = []
+
+    def fake_summarize(previous_summary, messages, **kwargs):
+        calls.append((previous_summary, [m["content"] for m in messages]))
+        return f"summary {len(calls)}"
+
+    monkeypatch.setattr(conversation_summary, "summarize_history", fake_summarize)
+    return calls
+
+
+def _add_turns(conversation_id, start, count):
+    for i in range(start, start + count):
+        conversation = ConversationManager.add_message(conversation_id, "user", f"m{i}")
+    return conversation
+
+
+def test_update_summary_folds_aged_out_messages(temp_conversations_dir, summarizer):
+    conv_id = ConversationManager.create_conversation()
+    _add_turns(conv_id, 0, 6)
+
+    # At the trigger threshold nothing happens yet
+    assert conversation_summary.update_summary(conv_id) is False
+
+    _add_turns(conv_id, 6, 1)
+    assert conversation_summary.update_summary(conv_id) is True
+
+    conversation = ConversationManager.load_conversation(conv_id)
+    assert conversation["summary"] == {"text": "summary 1", "message_count": 5}
+    summary, recent = conversation_summary.split_history(conversation)
+    assert summary == "summary 1"
+    assert [m["content"] for m in recent] == ["m5", "m6"]
+    assert summarizer == [(None, ["m0", "m1", "m2", "m3", "m4"])]
+
+
+def test_update_summary_is_incremental(temp_conversations_dir, summarizer):
+    conv_id = ConversationManager.create_conversation()
+    _add_turns(conv_id, 0, 7)
+    conversation_summary.update_summary(conv_id)
+    _add_turns(conv_id, 7, 5)
+
+    assert conversation_summary.update_summary(conv_id) is True
+
+    # Only the previous summary and newly aged-out messages are sent
+    assert summarizer[1] == ("summary 1", ["m5", "m6", "m7", "m8", "m9"])
+    conversation = ConversationManager.load_conversation(conv_id)
+    assert conversation["summary"]["message_count"] == 10
+    assert len(conversation["messages"]) == 12
+
+
+def test_schedule_summary_runs_in_background_once(temp_conversations_dir, summarizer):
+    conv_id = ConversationManager.create_conversation()
+    conversation = _add_turns(conv_id, 0, 7)
+
+    future = conversation_summary.schedule_summary(conversation)
+
+    assert future is not None
+    assert future.result(timeout=5) is True
+    assert conversation_summary.schedule_summary(None) is None
+    assert conversation_summary.schedule_summary(
+        ConversationManager.load_conversation(conv_id)
+    ) is None
+
+
+def test_failed_summary_is_logged_not_raised(temp_conversations_dir, monkeypatch):
+    def failing(*args, **kwargs):
+        raise conversation_summary.AssistantError("backend down")
+
+    monkeypatch.setattr(conversation_summary, "summarize_history", failing)
+    conv_id = ConversationManager.create_conversation()
+    conversation = _add_turns(conv_id, 0, 7)
+
+    assert conversation_summary.schedule_summary(conversation).result(timeout=5) is False
+    assert "summary" not in ConversationManager.load_conversation(conv_id)
+
+
+def test_rate_limited_summary_is_deferred(temp_conversations_dir, monkeypatch, caplog):
+    def rate_limited(*args, **kwargs):
+        raise conversation_summary.RateLimitedError("busy", retry_after=5)
+
+    monkeypatch.setattr(conversation_summary, "summarize_history", rate_limited)
+    conv_id = ConversationManager.create_conversation()
+    conversation = _add_turns(conv_id, 0, 7)
+
+    with caplog.at_level("INFO", logger="conversation_summary"):
+        assert conversation_summary.schedule_summary(conversation).result(timeout=5) is False
+    assert "deferred" in caplog.text
+    assert not [r for r in caplog.records if r.levelname in ("WARNING", "ERROR")]
+
+    # Nothing is left in flight, so the next exchange can schedule it again
+    assert conversation_summary.schedule_summary(conversation).result(timeout=5) is False
+
+
+def test_summary_survives_messages_appended_while_summarizing(temp_conversations_dir, monkeypatch):
+    conv_id = ConversationManager.create_conversation()
+    _add_turns(conv_id, 0, 7)
+
+    def summarize_during_exchange(previous_summary, messages, **kwargs):
+        _add_turns(conv_id, 7, 2)
+        return "summary"
+
+    monkeypatch.setattr(conversation_summary, "summarize_history", summarize_during_exchange)
+    # The first conditional write sees a stale version and is retried
+    versions = iter(["stale"])
+    real_version = ConversationManager.conversation_version
+    monkeypatch.setattr(
+        ConversationManager, "conversation_version",
+        staticmethod(lambda cid: next(versions, None) or real_version(cid)),
+    )
+
+    assert conversation_summary.update_summary(conv_id) is True
+    conversation = ConversationManager.load_conversation(conv_id)
+    assert conversation["summary"] == {"text": "summary", "message_count": 5}
+    assert len(conversation["messages"]) == 9
+
+
+def test_stale_summary_does_not_overwrite_a_newer_one(temp_conversations_dir, monkeypatch):
+    conv_id = ConversationManager.create_conversation()
+    _add_turns(conv_id, 0, 12)
+
+    def summarize_racing_another_worker(previous_summary, messages, **kwargs):
+        ConversationManager.update_fields(
+            conv_id, {"summary": {"text": "newer", "message_count": 10}}
+        )
+        return "older"
+
+    monkeypatch.setattr(conversation_summary, "summarize_history", summarize_racing_another_worker)
+
+    assert conversation_summary.update_summary(conv_id) is False
+    conversation = ConversationManager.load_conversation(conv_id)
+    assert conversation["summary"] == {"text": "newer", "message_count": 10}
@@ -0,0 +1,55 @@
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import pytest
+from google.genai import errors as genai_errors
+
+import assistant_core
+import gemini_client
+from fake_gemini import FakeGemini
+
+
+def _client(fake):
+    return gemini_client.get_client(
+        "fake-key", gemini_client.ClientOptions(base_url=fake.url, http2=False, read_timeout=5)
+    )
+
+
+@pytest.fixture
+def fake():
+    with FakeGemini(output_tokens=20, chunk_tokens=6, tokens_per_second=1000, seed=1) as server:
+        yield server
+
+
+def test_answers_are_padded_to_output_tokens_and_report_usage(fake, monkeypatch):
+    monkeypatch.setattr(assistant_core, "client", _client(fake))
+    metadata = {}
+
+    text = assistant_core.ask_gemini("Hello there", model="fake-model", metadata=metadata)
+
+    assert text.startswith("answer from fake-model ")
+    assert len(text.split()) == 20
+    assert metadata["usage"]["output"] == 20
+    assert metadata["usage"]["prompt"] > 0
+    assert fake.models == ["fake-model"]
+
+
+def test_streams_the_answer_in_chunks(fake, monkeypatch):
+    monkeypatch.setattr(assistant_core, "client", _client(fake))
+
+    chunks = list(assistant_core.ask_gemini_stream("Hello there", model="fake-model"))
+
+    assert len(chunks) == 4
+    assert "".join(chunks).split() == fake._answer("fake-model").split()
+
+
+def test_error_rate_and_scripted_behaviours(fake):
+    fake.error_rate = 1.0
+    client = _client(fake)
+    with pytest.raises(genai_errors.ServerError):
+        client.models.generate_content(model="m", contents="hi")
+
+    fake.push({"text": "scripted reply"})
+    response = client.models.generate_content(model="m", contents="hi")
+    assert response.text == "scripted reply"
@@ -0,0 +1,116 @@
+import asyncio
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import httpx
+import pytest
+
+import gemini_client
+from gemini_client import ClientOptions
+
+
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    monkeypatch.setattr(gemini_client, "_clients", {})
+    monkeypatch.setattr(gemini_client, "_warm_up_requested", False)
+    yield
+
+
+def test_get_client_is_shared_per_key_and_options():
+    first = gemini_client.get_client("key-a")
+    assert gemini_client.get_client("key-a") is first
+    assert gemini_client.get_client("key-b") is not first
+    assert gemini_client.get_client("key-a", ClientOptions(max_connections=5)) is not first
+
+
+def test_transport_uses_configured_pool_and_timeouts():
+    options = ClientOptions(
+        connect_timeout=3, read_timeout=30, max_connections=7,
+        max_keepalive_connections=2, http2=False,
+    )
+    entry = gemini_client._get_entry("key", options)
+    pool = entry.http._transport._pool
+    assert pool._max_connections == 7
+    assert pool._max_keepalive_connections == 2
+    assert entry.http.timeout.connect == 3
+    assert entry.http.timeout.read == 30
+    assert entry.client._api_client._httpx_client is entry.http
+
+
+def test_sdk_request_without_timeout_keeps_client_timeouts():
+    entry = gemini_client._get_entry("key", ClientOptions(connect_timeout=3, read_timeout=30))
+    request = entry.http.build_request("GET", "https://example.com", timeout=None)
+    assert request.extensions["timeout"] == httpx.Timeout(30, connect=3).as_dict()
+
+    explicit = entry.http.build_request("GET", "https://example.com", timeout=5)
+    assert explicit.extensions["timeout"] == httpx.Timeout(5).as_dict()
+
+
+def test_missing_api_key_raises(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    with pytest.raises(RuntimeError):
+        gemini_client.get_client()
+
+
+def test_client_proxy_resolves_current_client(monkeypatch):
+    proxy = gemini_client.ClientProxy("key")
+    assert proxy.models is gemini_client.get_client("key").models
+
+    # After a fork the proxy picks up the child's new client
+    before = gemini_client.get_client("key")
+    gemini_client._reset_after_fork()
+    assert proxy.models is not before.models
+    assert proxy.models is gemini_client.get_client("key").models
+
+
+def test_registry_is_rebuilt_when_pid_changes(monkeypatch):
+    first = gemini_client.get_client("key")
+    monkeypatch.setattr(gemini_client, "_clients_pid", -1)
+    assert gemini_client.get_client("key") is not first
+    assert gemini_client._clients_pid == os.getpid()
+
+
+def test_reset_after_fork_rewarms_only_if_requested(monkeypatch):
+    calls = []
+    monkeypatch.setattr(gemini_client, "warm_up_in_background", lambda: calls.append(1))
+
+    gemini_client._reset_after_fork()
+    assert calls == []
+
+    monkeypatch.setattr(gemini_client, "_warm_up_requested", True)
+    gemini_client._reset_after_fork()
+    assert calls == [1]
+
+
+def test_warm_up_opens_pooled_connection(monkeypatch):
+    seen = []
+    options = ClientOptions(http2=False, base_url="https://gemini.test/")
+    entry = gemini_client._get_entry("key", options)
+    monkeypatch.setattr(entry.http, "head", lambda url: seen.append(url))
+
+    assert gemini_client.warm_up("key", options) is True
+    assert seen == ["https://gemini.test/"]
+    assert gemini_client._warm_up_requested is True
+
+
+def test_warm_up_reports_connection_failure(monkeypatch):
+    entry = gemini_client._get_entry("key", ClientOptions())
+
+    def fail(url):
+        raise httpx.ConnectError("unreachable")
+
+    monkeypatch.setattr(entry.http, "head", fail)
+    assert gemini_client.warm_up("key") is False
+
+
+def test_warm_up_async_uses_async_pool(monkeypatch):
+    seen = []
+    entry = gemini_client._get_entry("key", ClientOptions())
+
+    async def head(url):
+        seen.append(url)
+
+    monkeypatch.setattr(entry.async_http, "head", head)
+    assert asyncio.run(gemini_client.warm_up_async("key")) is True
+    assert seen == [gemini_client.DEFAULT_BASE_URL]
@@ -0,0 +1,57 @@
+import os
+import threading
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret-key")
+
+import pytest
+from werkzeug.serving import make_server
+
+import assistant_core
+import conversation_manager
+import gemini_client
+import web_ui
+from benchmarks import load_test
+from fake_gemini import FakeGemini
+
+
+def test_parse_mix_rejects_unknown_operations():
+    assert load_test.parse_mix("ask=3,list") == [("ask", 3.0), ("list", 1.0)]
+    with pytest.raises(ValueError):
+        load_test.parse_mix("ask=1,upload=2")
+    with pytest.raises(ValueError):
+        load_test.parse_mix("ask=0")
+
+
+def test_summarize_reports_percentiles_per_operation():
+    samples = [("get", i / 1000, True) for i in range(1, 101)] + [("ask", 2.0, False)]
+
+    report = load_test.summarize(samples, elapsed=10)
+
+    assert report["all"]["requests"] == 101
+    assert report["all"]["throughput"] == pytest.approx(10.1)
+    assert report["get"]["p50_ms"] == pytest.approx(50)
+    assert report["get"]["p99_ms"] == pytest.approx(99)
+    assert report["ask"]["errors"] == 1
+
+
+def test_run_load_drives_every_route(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", tmp_path)
+    with FakeGemini(latency=0.01, output_tokens=10) as fake:
+        monkeypatch.setattr(assistant_core, "client", gemini_client.get_client(
+            "fake-key", gemini_client.ClientOptions(base_url=fake.url, http2=False, read_timeout=5)
+        ))
+        server = make_server("127.0.0.1", 0, web_ui.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            report = load_test.run_load(
+                f"http://127.0.0.1:{server.server_port}", concurrency=3, duration=1.0,
+                mix=load_test.parse_mix("ask=1,get=1,list=1"),
+            )
+        finally:
+            server.shutdown()
+
+    for operation in ("ask", "get", "list"):
+        assert report[operation]["requests"] > 0
+        assert report[operation]["errors"] == 0
+    assert len(fake.models) >= report["ask"]["requests"]
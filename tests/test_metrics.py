@@ -0,0 +1,148 @@
+import json
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret-key")
+
+import pytest
+
+import assistant_core
+import call_policy
+import metrics
+import web_ui
+from metrics import Counter, Histogram, Registry
+
+
+def test_render_uses_the_text_exposition_format():
+    registry = Registry()
+    requests = Counter("demo_requests", "Requests.", ("route",), registry=registry)
+    latency = Histogram("demo_seconds", "Latency.", ("route",), buckets=(0.1, 1.0), registry=registry)
+
+    requests.inc(route="/a")
+    requests.inc(2, route='/say "hi"')
+    latency.observe(0.05, route="/a")
+    latency.observe(0.5, route="/a")
+    latency.observe(5, route="/a")
+
+    lines = registry.render().splitlines()
+    worker = f'worker="{os.getpid()}"'
+    assert "# TYPE demo_requests counter" in lines
+    assert f'demo_requests_total{{route="/a",{worker}}} 1' in lines
+    assert f'demo_requests_total{{route="/say \\"hi\\"",{worker}}} 2' in lines
+    assert "# TYPE demo_seconds histogram" in lines
+    assert f'demo_seconds_bucket{{route="/a",le="0.1",{worker}}} 1' in lines
+    assert f'demo_seconds_bucket{{route="/a",le="1",{worker}}} 2' in lines
+    assert f'demo_seconds_bucket{{route="/a",le="+Inf",{worker}}} 3' in lines
+    assert f'demo_seconds_sum{{route="/a",{worker}}} 5.55' in lines
+    assert f'demo_seconds_count{{route="/a",{worker}}} 3' in lines
+
+
+def test_labels_must_match_declaration():
+    counter = Counter("demo_labels", "Labels.", ("route",), registry=Registry())
+    with pytest.raises(ValueError):
+        counter.inc(path="/a")
+
+
+def test_shared_directory_sums_every_worker(tmp_path):
+    registry = Registry(str(tmp_path), flush_interval=3600)
+    requests = Counter("demo_requests", "Requests.", ("route",), registry=registry)
+    latency = Histogram("demo_seconds", "Latency.", ("route",), buckets=(1.0,), registry=registry)
+    requests.inc(route="/a")
+    latency.observe(0.5, route="/a")
+    # Another worker's snapshot, including a series this process hasn't seen
+    (tmp_path / "worker-999999.json").write_text(json.dumps({
+        "demo_requests": [[["/a"], 2.0], [["/b"], 1.0]],
+        "demo_seconds": [[["/a"], [0, 1, 3.0, 1]]],
+    }))
+    (tmp_path / "worker-888888.json").write_text("{not json")
+
+    lines = registry.render().splitlines()
+
+    assert 'demo_requests_total{route="/a"} 3' in lines
+    assert 'demo_requests_total{route="/b"} 1' in lines
+    assert 'demo_seconds_bucket{route="/a",le="1"} 1' in lines
+    assert 'demo_seconds_bucket{route="/a",le="+Inf"} 2' in lines
+    assert 'demo_seconds_sum{route="/a"} 3.5' in lines
+    # Our own snapshot was written for the other workers to read
+    registry.flush()
+    [own_path] = tmp_path.glob(f"worker-{os.getpid()}-*.json")
+    own = json.loads(own_path.read_text())
+    assert own["demo_requests"] == [[["/a"], 1.0]]
+
+
+def test_exited_worker_with_the_same_pid_is_still_counted(tmp_path):
+    registry = Registry(str(tmp_path), flush_interval=3600)
+    requests = Counter("demo_reused", "Requests.", ("route",), registry=registry)
+    # An earlier process that had this PID before it exited
+    (tmp_path / f"worker-{os.getpid()}-1.json").write_text(json.dumps({
+        "demo_reused": [[["/a"], 5.0]],
+    }))
+    requests.inc(route="/a")
+    registry.flush()
+
+    assert 'demo_reused_total{route="/a"} 6' in registry.render().splitlines()
+    assert len(list(tmp_path.glob("worker-*.json"))) == 2
+
+
+def test_attempt_listener_counts_errors_by_class():
+    before = metrics.GEMINI_ERRORS.value(operation="generate", error="ServerError", status="503")
+    metrics.record_attempt(call_policy.Attempt(
+        "generate", "m", "primary", "error", 0.2, 503, "ServerError: 503 UNAVAILABLE",
+    ))
+    after = metrics.GEMINI_ERRORS.value(operation="generate", error="ServerError", status="503")
+    assert after == before + 1
+    assert metrics.GEMINI_ATTEMPTS.value(
+        operation="generate", model="m", kind="primary", outcome="error"
+    ) >= 1
+
+
+def test_ask_gemini_reports_usage_and_stage_timings(monkeypatch):
+    usage = SimpleNamespace(
+        prompt_token_count=12, candidates_token_count=5,
+        cached_content_token_count=None, thoughts_token_count=3,
+    )
+
+    class Models:
+        def generate_content(self, **kwargs):
+            return SimpleNamespace(text="hi", usage_metadata=usage)
+
+    monkeypatch.setattr(assistant_core, "client", SimpleNamespace(models=Models()))
+    before = metrics.GEMINI_TOKENS.value(model="usage-model", type="prompt")
+    metadata = {}
+
+    assistant_core.ask_gemini("count my tokens", model="usage-model", metadata=metadata)
+
+    assert metadata["usage"] == {"prompt": 12, "output": 5, "cached": 0, "thoughts": 3}
+    assert set(metadata["timings"]) == {"prompt_assembly", "gemini_call"}
+    assert metrics.GEMINI_TOKENS.value(model="usage-model", type="prompt") == before + 12
+
+
+def test_metrics_route_exposes_ask_stages(monkeypatch):
+    client = web_ui.app.test_client()
+
+    def mock_ask_gemini(prompt, metadata=None, **kwargs):
+        metadata["timings"]["gemini_call"] = 0.25
+        return "Hi there"
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "m-id", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: None)
+    stages = ("history_load", "gemini_call", "persistence")
+    before = {s: metrics.ASK_STAGE_SECONDS.count(route="/ask", stage=s) for s in stages}
+    requests = metrics.HTTP_REQUESTS.value(route="/ask", method="POST", status="200")
+
+    ask = client.post("/ask", json={"prompt": "Hello", "conversation_id": "m-id"})
+    assert ask.status_code == 200
+    # Servers close the response once it is sent, which records the request
+    ask.close()
+    resp = client.get("/metrics")
+
+    assert resp.status_code == 200
+    assert resp.content_type == metrics.CONTENT_TYPE
+    for stage in stages:
+        assert metrics.ASK_STAGE_SECONDS.count(route="/ask", stage=stage) == before[stage] + 1
+    assert metrics.HTTP_REQUESTS.value(route="/ask", method="POST", status="200") == requests + 1
+    body = resp.get_data(as_text=True)
+    assert 'assistant_ask_stage_duration_seconds_bucket{route="/ask",stage="gemini_call",le="0.25"' in body
+    assert "# TYPE assistant_store_operation_duration_seconds histogram" in body
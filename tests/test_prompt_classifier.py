@@ -0,0 +1,89 @@
+import json
+import os
+import random
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import assistant_core
+import pytest
+from prompt_classifier import PromptClassifier
+
+
+def _naive_labels(categories, text):
+    lowered = text.lower()
+    return frozenset(
+        name for name, keywords in categories.items()
+        if any(kw in lowered for kw in keywords)
+    )
+
+
+DEFAULT_CATEGORIES = {
+    "sensitive": assistant_core.SENSITIVE_KEYWORDS,
+    "research": assistant_core.RESEARCH_KEYWORDS,
+    "time_sensitive": assistant_core.TIME_SENSITIVE_KEYWORDS,
+}
+
+
+def test_matches_naive_substring_scans_on_random_text():
+    classifier = PromptClassifier(DEFAULT_CATEGORIES)
+    words = sorted(set().union(*DEFAULT_CATEGORIES.values())) + [
+        "the", "known", "snow", "currently", "lawn", "a", "CURRENT EVENT", "Warm",
+    ]
+    rng = random.Random(1234)
+    for _ in range(500):
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(0, 6)))
+        expected = _naive_labels(DEFAULT_CATEGORIES, text)
+        assert classifier.labels(text) == expected, text
+        assert classifier.classify(text).labels == expected, text
+
+
+def test_overlapping_keywords_each_count():
+    classifier = PromptClassifier({"event": ["current event"], "time": ["current", "rent"]})
+
+    result = classifier.classify("Any current event?")
+
+    assert result.labels == {"event", "time"}
+    assert result.scores == {"event": 1.0, "time": 2.0}
+
+
+def test_weights_and_thresholds():
+    classifier = PromptClassifier(
+        {"medical": {"symptom": 0.5, "diagnosis": 1.0, "dose": 0.5}},
+        thresholds={"medical": 1.0},
+    )
+
+    assert classifier.labels("one symptom, symptom again") == frozenset()
+    assert classifier.labels("symptom and dose") == {"medical"}
+    assert classifier.classify("Diagnosis please").scores == {"medical": 1.0}
+
+
+def test_from_config_adds_categories_and_weights(tmp_path):
+    config = tmp_path / "classifier.json"
+    config.write_text(json.dumps({"categories": {
+        "research": {"keywords": {"survey": 1}},
+        "medical": {"keywords": ["diagnosis"], "threshold": 1},
+    }}))
+
+    classifier = PromptClassifier.from_config(DEFAULT_CATEGORIES, config)
+
+    assert classifier.labels("Run a survey") == {"research"}
+    assert classifier.labels("Explain this diagnosis") == {"research", "medical"}
+
+
+def test_classify_many_preserves_order_and_duplicates():
+    classifier = PromptClassifier(DEFAULT_CATEGORIES)
+    prompts = ["latest election news", "hello", "latest election news", "write a thesis"]
+
+    results = classifier.classify_many(prompts)
+
+    assert [r.labels for r in results] == [
+        {"sensitive", "time_sensitive"}, frozenset(), {"sensitive", "time_sensitive"}, {"research"},
+    ]
+    assert assistant_core.classify_many(prompts, processes=2) == results
+
+
+def test_empty_classifier():
+    classifier = PromptClassifier({})
+
+    assert classifier.labels("anything") == frozenset()
+    assert classifier.classify("anything").labels == frozenset()
@@ -0,0 +1,289 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import pytest
+
+import assistant_core
+from rate_limiter import (
+    AdmissionController,
+    AdmissionRejected,
+    ConcurrencyGate,
+    Limits,
+    MemoryBucketStore,
+    SQLiteBucketStore,
+)
+
+
+def test_bucket_allows_a_minute_of_burst_then_waits():
+    store = MemoryBucketStore()
+    for _ in range(60):
+        assert store.reserve([("rpm:m", 60, 1)], max_wait=0) == (True, 0.0)
+
+    granted, wait = store.reserve([("rpm:m", 60, 1)], max_wait=0)
+    assert not granted and 0.9 < wait <= 1.0
+
+    granted, wait = store.reserve([("rpm:m", 60, 1)], max_wait=5)
+    assert granted and 0.9 < wait <= 1.0
+
+
+def test_rejected_reservation_takes_nothing_from_any_bucket():
+    store = MemoryBucketStore()
+    assert store.reserve([("tpm:m", 1000, 1000)], max_wait=0)[0]
+    granted, _ = store.reserve([("rpm:m", 60, 1), ("tpm:m", 1000, 500)], max_wait=1)
+    assert not granted
+    # The request bucket was left untouched
+    assert store.reserve([("rpm:m", 60, 60)], max_wait=0)[0]
+
+
+def test_oversized_request_waits_for_a_full_bucket_only():
+    store = MemoryBucketStore()
+    granted, wait = store.reserve([("tpm:m", 600, 5000)], max_wait=0)
+    assert granted and wait == 0.0
+
+
+def test_sqlite_buckets_are_shared_between_stores(tmp_path):
+    path = str(tmp_path / "limiter.db")
+    first, second = SQLiteBucketStore(path), SQLiteBucketStore(path)
+    assert first.reserve([("rpm:m", 2, 1)], max_wait=0)[0]
+    assert second.reserve([("rpm:m", 2, 1)], max_wait=0)[0]
+    assert not first.reserve([("rpm:m", 2, 1)], max_wait=0)[0]
+
+
+def test_locked_sqlite_store_rejects_instead_of_failing(tmp_path):
+    path = str(tmp_path / "limiter.db")
+    store = SQLiteBucketStore(path, timeout=0.05)
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(AdmissionRejected) as info:
+            store.reserve([("rpm:m", 2, 1)], max_wait=0)
+    finally:
+        other.execute("ROLLBACK")
+    assert info.value.reason == "store"
+    assert store.reserve([("rpm:m", 2, 1)], max_wait=0)[0]
+
+
+def _reserve_many(path, count, results):
+    store = SQLiteBucketStore(path)
+    granted = sum(store.reserve([("rpm:m", 20, 1)], max_wait=0)[0] for _ in range(count))
+    results.put(granted)
+
+
+def test_sqlite_buckets_hold_across_processes(tmp_path):
+    path = str(tmp_path / "limiter.db")
+    SQLiteBucketStore(path)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [context.Process(target=_reserve_many, args=(path, 15, results)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(10)
+    # 45 attempts against a bucket of 20 (plus a sliver of refill)
+    assert 20 <= sum(results.get(timeout=5) for _ in workers) <= 21
+
+
+def test_gate_hands_slots_to_waiters_in_order():
+    gate = ConcurrencyGate(limit=1, max_queue=4)
+    assert gate.acquire(0)
+    order = []
+
+    def wait_for_slot(name):
+        assert gate.acquire(5)
+        order.append(name)
+        gate.release()
+
+    threads = []
+    for name in ("first", "second"):
+        thread = threading.Thread(target=wait_for_slot, args=(name,))
+        thread.start()
+        threads.append(thread)
+        while gate.queued < len(threads):
+            time.sleep(0.01)
+
+    gate.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["first", "second"]
+    assert gate.active == 0
+
+
+def test_gate_times_out_and_rejects_when_queue_is_full():
+    gate = ConcurrencyGate(limit=1, max_queue=1)
+    assert gate.acquire(0)
+    assert not gate.acquire(0.05)
+    assert gate.queued == 0
+
+    waiter = threading.Thread(target=gate.acquire, args=(1,))
+    waiter.start()
+    while gate.queued < 1:
+        time.sleep(0.01)
+    with pytest.raises(AdmissionRejected) as info:
+        gate.acquire(1)
+    assert info.value.reason == "queue"
+    gate.release()
+    waiter.join(5)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_admit_refunds_the_rate_limit_when_no_slot_frees_up(tmp_path, shared):
+    store = SQLiteBucketStore(str(tmp_path / "limiter.db")) if shared else MemoryBucketStore()
+    controller = AdmissionController(
+        Limits(requests_per_minute=2), max_concurrency=1, max_queue_time=0.05, store=store,
+    )
+    with controller.admit("m"):
+        with pytest.raises(AdmissionRejected) as info:
+            with controller.admit("m"):
+                pass
+        assert info.value.reason == "queue"
+    # The rejected call's request went back to the bucket
+    with controller.admit("m"):
+        pass
+
+
+def test_gate_async_waits_for_release_from_a_thread():
+    gate = ConcurrencyGate(limit=1, max_queue=4)
+    assert gate.acquire(0)
+
+    async def run():
+        threading.Timer(0.05, gate.release).start()
+        return await gate.acquire_async(2)
+
+    assert asyncio.run(run()) is True
+    assert gate.active == 1
+
+
+def test_admit_rejects_fast_when_rate_wait_exceeds_queue_time():
+    controller = AdmissionController(
+        Limits(requests_per_minute=1), max_queue_time=0.5, store=MemoryBucketStore()
+    )
+    with controller.admit("m"):
+        pass
+    started = time.monotonic()
+    with pytest.raises(AdmissionRejected) as info:
+        with controller.admit("m"):
+            pass
+    assert time.monotonic() - started < 0.1
+    assert info.value.reason == "rate"
+    assert 55 < info.value.retry_after <= 60
+
+
+def test_admit_uses_per_model_limits():
+    controller = AdmissionController(
+        Limits(), {"pro": Limits(requests_per_minute=1)}, max_queue_time=0,
+    )
+    for _ in range(3):
+        with controller.admit("flash"):
+            pass
+    with controller.admit("pro"):
+        pass
+    with pytest.raises(AdmissionRejected):
+        with controller.admit("pro"):
+            pass
+
+
+def test_admit_charges_estimated_tokens():
+    controller = AdmissionController(Limits(tokens_per_minute=1000), max_queue_time=0)
+    with controller.admit("m", tokens=800):
+        pass
+    with pytest.raises(AdmissionRejected):
+        with controller.admit("m", tokens=300):
+            pass
+
+
+def test_admit_async_limits_concurrency():
+    controller = AdmissionController(max_concurrency=2, max_queue=8, max_queue_time=5)
+    active = []
+    peak = []
+
+    async def call():
+        async with controller.admit_async("m"):
+            active.append(1)
+            peak.append(len(active))
+            await asyncio.sleep(0.02)
+            active.pop()
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(run())
+    assert max(peak) == 2
+
+
+def test_ask_gemini_maps_rejection_to_rate_limited_error(monkeypatch):
+    controller = AdmissionController(Limits(requests_per_minute=1), max_queue_time=0)
+    monkeypatch.setattr(assistant_core, "ADMISSION", controller)
+    calls = []
+
+    class Models:
+        def generate_content(self, **kwargs):
+            calls.append(kwargs)
+            return type("Resp", (), {"text": "hi"})()
+
+    monkeypatch.setattr(assistant_core, "client", type("Client", (), {"models": Models()})())
+
+    assert assistant_core.ask_gemini("one") == "hi"
+    with pytest.raises(assistant_core.RateLimitedError) as info:
+        assistant_core.ask_gemini("two")
+    assert info.value.status_code == 429
+    assert info.value.retry_after > 50
+    assert len(calls) == 1
+
+
+def test_ask_gemini_stream_rejects_before_returning_the_iterator(monkeypatch):
+    controller = AdmissionController(Limits(requests_per_minute=1), max_queue_time=0)
+    monkeypatch.setattr(assistant_core, "ADMISSION", controller)
+
+    class Models:
+        def generate_content_stream(self, **kwargs):
+            return iter([type("Chunk", (), {"text": "hi"})()])
+
+    monkeypatch.setattr(assistant_core, "client", type("Client", (), {"models": Models()})())
+
+    assert list(assistant_core.ask_gemini_stream("one")) == ["hi"]
+    with pytest.raises(assistant_core.RateLimitedError):
+        assistant_core.ask_gemini_stream("two")
+
+
+def test_fallback_attempts_are_charged_to_the_fallback_model(monkeypatch):
+    controller = AdmissionController(
+        Limits(), {"fallback": Limits(requests_per_minute=1)}, max_queue_time=0,
+    )
+    monkeypatch.setattr(assistant_core, "ADMISSION", controller)
+    attempt = assistant_core._charge_fallbacks(lambda m: m, "primary", 10)
+
+    assert [attempt("primary") for _ in range(3)] == ["primary"] * 3
+    assert attempt("fallback") == "fallback"
+    with pytest.raises(AdmissionRejected):
+        attempt("fallback")
+
+    async_attempt = assistant_core._charge_fallbacks_async(
+        lambda m: asyncio.sleep(0, m), "primary", 10
+    )
+    with pytest.raises(AdmissionRejected):
+        asyncio.run(async_attempt("fallback"))
+
+
+def test_summarize_history_goes_through_admission(monkeypatch):
+    controller = AdmissionController(Limits(requests_per_minute=1), max_queue_time=0)
+    monkeypatch.setattr(assistant_core, "ADMISSION", controller)
+    calls = []
+
+    class Models:
+        def generate_content(self, **kwargs):
+            calls.append(kwargs)
+            return type("Resp", (), {"text": "summary"})()
+
+    monkeypatch.setattr(assistant_core, "client", type("Client", (), {"models": Models()})())
+    messages = [{"role": "user", "content": "hello"}]
+
+    assert assistant_core.summarize_history(None, messages) == "summary"
+    with pytest.raises(assistant_core.RateLimitedError):
+        assistant_core.summarize_history("summary", messages)
+    assert len(calls) == 1
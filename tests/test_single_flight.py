@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    flights = SingleFlight()
+    calls = []
+    release = threading.Event()
+    results = []
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return "answer"
+
+    threads = [
+        threading.Thread(target=lambda: results.append(flights.do("k", work)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    while not calls:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(results) == [("answer", False)] + [("answer", True)] * 3
+    assert flights.in_flight() == 0
+
+
+def test_followers_receive_the_leaders_exception():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise ValueError("boom")
+
+    def call():
+        try:
+            flights.do("k", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 2
+
+
+def test_completed_calls_are_not_cached():
+    flights = SingleFlight()
+    counter = iter(range(10))
+    assert flights.do("k", lambda: next(counter)) == (0, False)
+    assert flights.do("k", lambda: next(counter)) == (1, False)
+
+
+def test_async_callers_share_one_call_and_survive_a_cancelled_waiter():
+    flights = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run():
+        first = asyncio.ensure_future(flights.do_async("k", work))
+        second = asyncio.ensure_future(flights.do_async("k", work))
+        third = asyncio.ensure_future(flights.do_async("k", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, await third
+
+    assert asyncio.run(run()) == (("answer", True), ("answer", True))
+    assert len(calls) == 1
+    assert flights.in_flight() == 0
@@ -0,0 +1,94 @@
+import contextvars
+import json
+import os
+
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+os.environ.setdefault("FLASK_SECRET_KEY", "test-secret-key")
+
+import pytest
+
+import conversation_manager
+import tracing
+import web_ui
+
+
+@pytest.fixture
+def temp_conversations_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def profile_settings(tmp_path, monkeypatch):
+    """Point the profiler at a settings file the test can rewrite."""
+    settings = tmp_path / "profile.env"
+    settings.write_text("")
+    monkeypatch.setattr(tracing, "PROFILE_SETTINGS_FILE", str(settings))
+    monkeypatch.setattr(tracing, "PROFILE_SETTINGS_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(tracing, "_sampler", tracing._ProfileSampler())
+    return settings
+
+
+def test_spans_outside_a_trace_only_fill_timings():
+    def run():
+        timings = {}
+        with tracing.span("work", timings):
+            pass
+        return timings, tracing.current()
+
+    # A fresh context, in case an earlier test left a response unclosed
+    timings, trace = contextvars.Context().run(run)
+    assert set(timings) == {"work"}
+    assert trace is None
+
+
+def test_repeated_spans_are_summed_and_counted():
+    trace = tracing.start("GET /x", profile=False)
+    try:
+        tracing.record("store.load", 0.002)
+        tracing.record("store.load", 0.003)
+        tracing.record("gemini_call", 0.5)
+        header = trace.server_timing()
+    finally:
+        tracing.finish(trace)
+
+    assert header.startswith('store.load;dur=5.0;desc="2 calls", gemini_call;dur=500.0, total;dur=')
+    assert trace.summary()["spans"]["store.load"] == {"ms": 5.0, "count": 2}
+    assert tracing.current() is None
+
+
+def test_ask_sets_server_timing_and_logs_one_line(temp_conversations_dir, monkeypatch, caplog):
+    def mock_ask_gemini(prompt, metadata=None, **kwargs):
+        tracing.record("gemini_call", 0.1, metadata["timings"])
+        return "Hi there"
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    client = web_ui.app.test_client()
+
+    with caplog.at_level("INFO", logger="tracing"):
+        resp = client.post("/ask", json={"prompt": "Hello"})
+        resp.close()
+
+    timing = resp.headers["Server-Timing"]
+    for name in ("history_load", "store.save", "store.load", "gemini_call", "store.add_messages", "total"):
+        assert f"{name};dur=" in timing
+    lines = [json.loads(r.getMessage()) for r in caplog.records if r.name == "tracing"]
+    assert len(lines) == 1
+    assert lines[0]["trace"] == "POST /ask"
+    assert lines[0]["status"] == 200
+    assert lines[0]["spans"]["gemini_call"]["count"] == 1
+
+
+def test_profiler_samples_requests_and_can_be_switched_off(profile_settings, tmp_path):
+    profiles = tmp_path / "profiles"
+    profile_settings.write_text(f"ASSISTANT_PROFILE_EVERY=2\nASSISTANT_PROFILE_DIR={profiles}\n")
+    client = web_ui.app.test_client()
+
+    for _ in range(4):
+        client.get("/metrics").close()
+    assert len(list(profiles.glob("*-GET_metrics.prof"))) == 2
+
+    profile_settings.write_text("ASSISTANT_PROFILE_EVERY=0\n")
+    for _ in range(4):
+        client.get("/metrics").close()
+    assert len(list(profiles.glob("*.prof"))) == 2
@@ -1,9 +1,14 @@
 import os
+import threading
+import time
 
 os.environ.setdefault("GEMINI_API_KEY", "test-key")
 os.environ.setdefault("FLASK_SECRET_KEY", "test-secret-key")
 
+import conversation_manager
+import pytest
 import web_ui
+from conversation_search import SearchHit
 
 
 def test_index_route_returns_html():
@@ -19,13 +24,14 @@ def test_ask_route_success(monkeypatch):
     with client.session_transaction() as sess:
         sess['conversation_id'] = None
     
-    def mock_ask_gemini(prompt, conversation_history=None):
+    def mock_ask_gemini(prompt, conversation_history=None, **kwargs):
         return "Hi there"
     
     monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
     monkeypatch.setattr(web_ui.ConversationManager, "create_conversation", lambda: "test-id")
     monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
     monkeypatch.setattr(web_ui.ConversationManager, "add_message", lambda *args: None)
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: None)
 
     resp = client.post("/ask", json={"prompt": "Hello"})
 
@@ -33,12 +39,106 @@ def test_ask_route_success(monkeypatch):
     data = resp.get_json()
     assert data["response"] == "Hi there"
     assert "conversation_id" in data
+    assert data["cached"] is False
+
+
+def test_ask_route_reports_cache_hit(monkeypatch):
+    client = web_ui.app.test_client()
+
+    def mock_ask_gemini(prompt, conversation_history=None, metadata=None, **kwargs):
+        metadata["cached"] = True
+        return "From cache"
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "create_conversation", lambda: "test-id")
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: None)
+
+    resp = client.post("/ask", json={"prompt": "Hello", "temperature": 0})
+
+    assert resp.status_code == 200
+    assert resp.get_json()["cached"] is True
+
+
+def test_ask_route_returns_503_when_backend_unavailable(monkeypatch):
+    client = web_ui.app.test_client()
+
+    def mock_ask_gemini(prompt, conversation_history=None, **kwargs):
+        raise web_ui.BackendUnavailableError("busy", retry_after=2.2)
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "create_conversation", lambda: "test-id")
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+
+    resp = client.post("/ask", json={"prompt": "Hello"})
+
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "3"
+    assert resp.get_json()["error"] == "busy"
+
+
+def test_ask_route_returns_429_with_retry_after(monkeypatch):
+    client = web_ui.app.test_client()
+
+    def mock_ask_gemini(prompt, conversation_history=None, **kwargs):
+        raise web_ui.RateLimitedError("slow down", retry_after=0.2)
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "create_conversation", lambda: "test-id")
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+
+    resp = client.post("/ask", json={"prompt": "Hello"})
+
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "1"
+
+
+@pytest.mark.parametrize("error, status, retry_after", [
+    (web_ui.RateLimitedError("slow down", retry_after=0.2), 429, "1"),
+    (web_ui.BackendUnavailableError("busy", retry_after=2.2), 503, "3"),
+])
+def test_ask_stream_route_returns_status_with_retry_after(monkeypatch, error, status, retry_after):
+    client = web_ui.app.test_client()
+
+    def mock_stream(prompt, conversation_history=None, **kwargs):
+        # The real ask_gemini_stream opens the stream (admission included) eagerly
+        raise error
+
+    monkeypatch.setattr(web_ui, "ask_gemini_stream", mock_stream)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+
+    resp = client.post("/ask/stream", json={"prompt": "Hello", "conversation_id": "test-id"})
+
+    assert resp.status_code == status
+    assert resp.headers["Retry-After"] == retry_after
+    assert resp.get_json()["error"] == str(error)
+
+
+def test_ask_route_stores_new_context_cache_record(monkeypatch):
+    client = web_ui.app.test_client()
+    record = {"name": "cachedContents/1", "key": "k", "message_count": 8, "expires_at": 1.0}
+    updates = []
+
+    def mock_ask_gemini(prompt, conversation_history=None, context_cache=None, metadata=None, **kwargs):
+        assert context_cache == {}
+        metadata["context_cache"] = record
+        return "Hi"
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: None)
+    monkeypatch.setattr(web_ui.ConversationManager, "update_fields", lambda *args: updates.append(args))
+
+    resp = client.post("/ask", json={"prompt": "Hello", "conversation_id": "test-id"})
+
+    assert resp.status_code == 200
+    assert updates == [("test-id", {"context_cache": record})]
 
 
 def test_ask_route_handles_assistant_error(monkeypatch):
     client = web_ui.app.test_client()
     
-    def _raise(prompt, conversation_history=None):
+    def _raise(prompt, conversation_history=None, **kwargs):
         raise web_ui.AssistantError("Nope")
 
     monkeypatch.setattr(web_ui, "ask_gemini", _raise)
@@ -67,6 +167,67 @@ def test_list_conversations_route(monkeypatch):
     assert len(data["conversations"]) == 1
 
 
+def test_list_conversations_route_pages_with_cursor(monkeypatch):
+    client = web_ui.app.test_client()
+    calls = []
+
+    def mock_page(limit, cursor=None):
+        calls.append((limit, cursor))
+        if cursor == "bad":
+            raise ValueError("Invalid cursor: 'bad'")
+        return [{"id": "test-1"}], "next"
+
+    monkeypatch.setattr(web_ui.ConversationManager, "list_conversations_page", mock_page)
+
+    resp = client.get("/conversations?limit=1000&cursor=abc")
+
+    assert resp.status_code == 200
+    assert resp.get_json() == {"conversations": [{"id": "test-1"}], "next_cursor": "next"}
+    assert calls == [(web_ui.PAGE_SIZE_MAX, "abc")]
+    assert client.get("/conversations?limit=10&cursor=bad").status_code == 400
+    assert client.get("/conversations?limit=0").status_code == 400
+
+
+def test_get_conversation_route_pages_messages(monkeypatch):
+    client = web_ui.app.test_client()
+    calls = []
+
+    def mock_load_messages(conversation_id, before, limit):
+        calls.append((conversation_id, before, limit))
+        return {"id": conversation_id, "messages": [], "message_count": 9, "messages_start": 4}
+
+    monkeypatch.setattr(web_ui.ConversationManager, "load_messages", mock_load_messages)
+
+    resp = client.get("/conversations/test-id?before=6&limit=2")
+
+    assert resp.status_code == 200
+    assert resp.get_json()["messages_start"] == 4
+    assert calls == [("test-id", 6, 2)]
+    assert client.get("/conversations/test-id?before=-1").status_code == 400
+    assert client.get("/conversations/test-id?limit=x").status_code == 400
+
+
+def test_search_conversations_route(monkeypatch):
+    client = web_ui.app.test_client()
+    calls = []
+    hit = SearchHit("c1", "Title", "2024-01-01", 3, "user", "a <mark>match</mark>", -1.5)
+
+    def mock_search(query, limit, role):
+        calls.append((query, limit, role))
+        return [hit]
+
+    monkeypatch.setattr(web_ui.ConversationManager, "search_conversations", mock_search)
+
+    resp = client.get("/conversations/search?q=match&role=user")
+
+    assert resp.status_code == 200
+    assert resp.get_json()["results"][0]["snippet"] == "a <mark>match</mark>"
+    assert resp.get_json()["results"][0]["message_index"] == 3
+    assert calls == [("match", web_ui.SEARCH_RESULTS_DEFAULT, "user")]
+    assert client.get("/conversations/search?q=").status_code == 400
+    assert client.get("/conversations/search?q=x&role=system").status_code == 400
+
+
 def test_new_conversation_route(monkeypatch):
     client = web_ui.app.test_client()
     
@@ -102,3 +263,220 @@ def test_delete_conversation_route(monkeypatch):
     assert resp.status_code == 200
     data = resp.get_json()
     assert "message" in data
+
+
+def test_ask_stream_route_emits_chunks_and_persists(monkeypatch):
+    client = web_ui.app.test_client()
+    saved = []
+
+    def mock_stream(prompt, conversation_history=None, **kwargs):
+        return iter(["Hel", "lo"])
+
+    monkeypatch.setattr(web_ui, "ask_gemini_stream", mock_stream)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: saved.append(args))
+
+    resp = client.post("/ask/stream", json={"prompt": "Hi", "conversation_id": "test-id"})
+    body = resp.get_data(as_text=True)
+
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+    assert body.index("event: start") < body.index('"Hel"') < body.index("event: done")
+    assert saved == [("test-id", [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+    ])]
+
+
+def test_ask_stream_route_reports_midstream_error_without_persisting(monkeypatch):
+    client = web_ui.app.test_client()
+    saved = []
+
+    def mock_stream(prompt, conversation_history=None, **kwargs):
+        yield "partial"
+        raise web_ui.AssistantError("Backend hiccup")
+
+    monkeypatch.setattr(web_ui, "ask_gemini_stream", mock_stream)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: saved.append(args))
+
+    resp = client.post("/ask/stream", json={"prompt": "Hi", "conversation_id": "test-id"})
+    body = resp.get_data(as_text=True)
+
+    assert "event: error" in body
+    assert "Backend hiccup" in body
+    assert saved == []
+
+
+def test_ask_stream_persists_partial_answer_on_disconnect(monkeypatch):
+    saved = []
+
+    def mock_stream(prompt, conversation_history=None, **kwargs):
+        return iter(["first ", "second ", "third"])
+
+    monkeypatch.setattr(web_ui, "ask_gemini_stream", mock_stream)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: saved.append(args))
+
+    with web_ui.app.test_request_context(
+        "/ask/stream", method="POST", json={"prompt": "Hi", "conversation_id": "test-id"}
+    ):
+        resp = web_ui.ask_stream()
+        frames = iter(resp.response)
+        next(frames)  # start
+        next(frames)  # first chunk
+        resp.close()  # simulate the client going away
+
+    assert saved == [("test-id", [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "first "},
+    ])]
+
+
+def test_ask_stream_route_rejects_empty_prompt(monkeypatch):
+    client = web_ui.app.test_client()
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "test-id", "messages": []})
+
+    resp = client.post("/ask/stream", json={"prompt": "  ", "conversation_id": "test-id"})
+
+    assert resp.status_code == 400
+    assert "error" in resp.get_json()
+
+
+def test_concurrent_identical_asks_share_one_generation(monkeypatch):
+    calls = []
+    saved = []
+    release = threading.Event()
+
+    def mock_ask_gemini(prompt, conversation_history=None, **kwargs):
+        calls.append(prompt)
+        release.wait(5)
+        return "Only once"
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: {"id": "c1", "messages": []})
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", lambda *args: saved.append(args))
+
+    responses = []
+
+    def post():
+        client = web_ui.app.test_client()
+        responses.append(client.post("/ask", json={"prompt": "Again", "conversation_id": "c1"}))
+
+    threads = [threading.Thread(target=post) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while not calls:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == ["Again"]
+    assert len(saved) == 1
+    assert [r.get_json()["response"] for r in responses] == ["Only once"] * 3
+
+
+def test_idempotency_key_is_stored_and_replayed(monkeypatch):
+    conversation = {"id": "c1", "messages": []}
+    calls = []
+
+    def mock_ask_gemini(prompt, conversation_history=None, **kwargs):
+        calls.append(prompt)
+        return "First answer"
+
+    def add_messages(conversation_id, messages):
+        conversation["messages"].extend(messages)
+        return conversation
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: conversation)
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", add_messages)
+    client = web_ui.app.test_client()
+
+    first = client.post(
+        "/ask", json={"prompt": "Hi", "conversation_id": "c1"}, headers={"Idempotency-Key": "abc"}
+    )
+    retry = client.post(
+        "/ask", json={"prompt": "Hi", "conversation_id": "c1", "idempotency_key": "abc"}
+    )
+
+    assert first.get_json()["response"] == retry.get_json()["response"] == "First answer"
+    assert retry.get_json()["cached"] is True
+    assert calls == ["Hi"]
+    assert conversation["messages"][0]["idempotency_key"] == "abc"
+    assert len(conversation["messages"]) == 2
+
+
+def test_ask_stream_stores_and_replays_idempotency_key(monkeypatch):
+    conversation = {"id": "c1", "messages": []}
+    calls = []
+
+    def mock_stream(prompt, conversation_history=None, **kwargs):
+        calls.append(prompt)
+        return iter(["Hel", "lo"])
+
+    def add_messages(conversation_id, messages):
+        conversation["messages"].extend(messages)
+        return conversation
+
+    monkeypatch.setattr(web_ui, "ask_gemini_stream", mock_stream)
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: conversation)
+    monkeypatch.setattr(web_ui.ConversationManager, "add_messages", add_messages)
+    client = web_ui.app.test_client()
+
+    def ask():
+        return client.post(
+            "/ask/stream", json={"prompt": "Hi", "conversation_id": "c1"},
+            headers={"Idempotency-Key": "abc"},
+        ).get_data(as_text=True)
+
+    first, retry = ask(), ask()
+
+    assert calls == ["Hi"]
+    assert '"Hel"' in first
+    assert '{"text": "Hello"}' in retry and '"cached": true' in retry
+    assert len(conversation["messages"]) == 2
+    assert conversation["messages"][0]["idempotency_key"] == "abc"
+
+
+def test_get_conversation_route_hides_idempotency_keys(monkeypatch):
+    conversation = {"id": "c1", "messages": [
+        {"role": "user", "content": "Hi", "idempotency_key": "abc"},
+        {"role": "assistant", "content": "Hello"},
+    ]}
+    monkeypatch.setattr(web_ui.ConversationManager, "load_conversation", lambda _: conversation)
+
+    data = web_ui.app.test_client().get("/conversations/c1").get_json()
+
+    assert data["messages"] == [
+        {"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"},
+    ]
+    assert conversation["messages"][0]["idempotency_key"] == "abc"
+
+
+def test_idempotent_retry_without_conversation_reuses_the_first_one(monkeypatch, tmp_path):
+    monkeypatch.setattr(conversation_manager, "CONVERSATIONS_DIR", tmp_path)
+    calls = []
+
+    def mock_ask_gemini(prompt, conversation_history=None, **kwargs):
+        calls.append(prompt)
+        return "First answer"
+
+    monkeypatch.setattr(web_ui, "ask_gemini", mock_ask_gemini)
+
+    def ask(key):
+        # A fresh client each time, so no session cookie carries the conversation over
+        return web_ui.app.test_client().post(
+            "/ask", json={"prompt": "Hi"}, headers={"Idempotency-Key": key}
+        ).get_json()
+
+    first, retry, other = ask("retry-me"), ask("retry-me"), ask("another")
+
+    assert retry["conversation_id"] == first["conversation_id"]
+    assert retry["cached"] is True
+    assert other["conversation_id"] != first["conversation_id"]
+    assert calls == ["Hi", "Hi"]
+    conversation = web_ui.ConversationManager.load_conversation(first["conversation_id"])
+    assert len(conversation["messages"]) == 2
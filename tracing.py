@@ -0,0 +1,223 @@
+"""
+Per-request tracing: timed spans, Server-Timing headers and sampled profiles.
+
+A request handler calls start() to open a trace for the current context;
+span()/record() anywhere below it (web_ui, assistant_core,
+ConversationManager) add named durations to that trace, and are no-ops when
+no trace is open. Spans with the same name are summed and counted, so three
+store loads show up as one "store.load" entry with a count of 3. finish()
+logs one JSON line per request; Server-Timing carries the same spans to the
+browser's network panel.
+
+The trace lives in a ContextVar, so it follows the request into
+asyncio.to_thread() calls and tasks it starts.
+
+Sampling profiler: with ASSISTANT_PROFILE_EVERY=N and ASSISTANT_PROFILE_DIR
+set, one in N traced requests runs under cProfile and its stats are dumped
+to that directory (open them with pstats or snakeviz). Both settings are
+re-read from the .env file (ASSISTANT_PROFILE_SETTINGS) about once a second,
+so profiling can be switched on and off without restarting the server.
+"""
+import cProfile
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import dotenv_values
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_console = logging.StreamHandler()
+_console.setFormatter(logging.Formatter(
+    "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+))
+logger.addHandler(_console)
+
+# Set to false to skip spans, Server-Timing headers and per-request log lines
+TRACING_ENABLED = os.getenv("ASSISTANT_TRACING", "true").lower() == "true"
+
+# File checked for ASSISTANT_PROFILE_EVERY / ASSISTANT_PROFILE_DIR at runtime
+PROFILE_SETTINGS_FILE = os.getenv("ASSISTANT_PROFILE_SETTINGS", ".env")
+PROFILE_SETTINGS_CHECK_INTERVAL = 1.0
+
+
+class Trace:
+    """Spans recorded for one request: name -> [total seconds, count]."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: Dict[str, List] = {}
+        self.profile: Optional[cProfile.Profile] = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = [seconds, 1]
+            else:
+                span[0] += seconds
+                span[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """The Server-Timing header value: one entry per span plus the total so far."""
+        with self._lock:
+            spans = list(self.spans.items())
+        entries = []
+        for name, (seconds, count) in spans:
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if count > 1:
+                entry += f';desc="{count} calls"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            spans = {
+                name: {"ms": round(seconds * 1000, 2), "count": count}
+                for name, (seconds, count) in self.spans.items()
+            }
+        return {"trace": self.name, "total_ms": round(self.elapsed() * 1000, 2), "spans": spans}
+
+
+class _ProfileSampler:
+    """Picks one in N requests to run under cProfile, one at a time per process."""
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._dumps = itertools.count(1)
+        self._active = threading.Lock()
+        self._settings: Tuple[int, Optional[str]] = (0, None)
+        self._checked_at = float("-inf")
+        self._settings_lock = threading.Lock()
+
+    def settings(self) -> Tuple[int, Optional[str]]:
+        """(every, directory), re-read from the settings file at most once a second."""
+        now = time.monotonic()
+        with self._settings_lock:
+            if now - self._checked_at >= PROFILE_SETTINGS_CHECK_INTERVAL:
+                self._checked_at = now
+                self._settings = self._read_settings()
+            return self._settings
+
+    @staticmethod
+    def _read_settings() -> Tuple[int, Optional[str]]:
+        values: Dict[str, Optional[str]] = {}
+        if PROFILE_SETTINGS_FILE and os.path.exists(PROFILE_SETTINGS_FILE):
+            values = dotenv_values(PROFILE_SETTINGS_FILE)
+
+        def setting(name: str) -> Optional[str]:
+            value = values.get(name)
+            return value if value is not None else os.getenv(name)
+
+        try:
+            every = int(setting("ASSISTANT_PROFILE_EVERY") or 0)
+        except ValueError:
+            logger.warning("Ignoring invalid ASSISTANT_PROFILE_EVERY")
+            every = 0
+        return every, setting("ASSISTANT_PROFILE_DIR") or None
+
+    def start(self) -> Optional[cProfile.Profile]:
+        every, directory = self.settings()
+        if every <= 0 or not directory or next(self._counter) % every:
+            return None
+        # Only one profiler can be active at a time
+        if not self._active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            self._active.release()
+            return None
+        return profile
+
+    def stop(self, profile: cProfile.Profile, name: str) -> Optional[str]:
+        """Stop profiling and dump the stats; return the file written, if any."""
+        try:
+            profile.disable()
+        finally:
+            self._active.release()
+        _, directory = self.settings()
+        if not directory:
+            return None
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_") or "request"
+        path = Path(directory) / (
+            f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._dumps)}-{slug}.prof"
+        )
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(str(path))
+        except OSError as e:
+            logger.warning("Failed to write profile %s: %s", path, e)
+            return None
+        return str(path)
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_sampler = _ProfileSampler()
+
+
+def start(name: str, profile: bool = True) -> Optional[Trace]:
+    """
+    Open a trace for the current context (and maybe start the sampling
+    profiler). Returns None when tracing is disabled.
+    """
+    if not TRACING_ENABLED:
+        return None
+    trace = Trace(name)
+    _current.set(trace)
+    if profile:
+        trace.profile = _sampler.start()
+    return trace
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def finish(trace: Optional[Trace], **fields) -> None:
+    """Close a trace: dump its profile if sampled and log its summary line."""
+    if trace is None:
+        return
+    if _current.get() is trace:
+        _current.set(None)
+    summary = trace.summary()
+    summary.update(fields)
+    if trace.profile is not None:
+        summary["profile"] = _sampler.stop(trace.profile, trace.name)
+        trace.profile = None
+    logger.info("%s", json.dumps(summary))
+
+
+def record(name: str, seconds: float, timings: Optional[Dict[str, float]] = None) -> None:
+    """Add a duration to the current trace, and to timings[name] when given."""
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+@contextmanager
+def span(name: str, timings: Optional[Dict[str, float]] = None):
+    """Time the with-block (even when it raises) as a span called name."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started, timings)
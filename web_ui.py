@@ -1,11 +1,23 @@
+import json
 import logging
+import math
 import os
+import time
+from uuid import NAMESPACE_URL, uuid5
 
-from flask import Flask, jsonify, render_template, request, session
+from flask import Flask, Response, g, jsonify, render_template, request, session, stream_with_context
 from dotenv import load_dotenv
 
-from assistant_core import ask_gemini, AssistantError
+import metrics
+import tracing
+
+from assistant_core import (
+    ask_gemini, ask_gemini_stream, AssistantError, BackendUnavailableError, RateLimitedError,
+)
 from conversation_manager import ConversationManager
+from conversation_summary import schedule_summary, split_history
+from gemini_client import GEMINI_WARMUP, warm_up_in_background
+from single_flight import SingleFlight
 
 load_dotenv()
 
@@ -20,6 +32,203 @@ _console.setFormatter(logging.Formatter(
 ))
 logger.addHandler(_console)
 
+if GEMINI_WARMUP:
+    # Forked workers re-warm their own pools (see gemini_client)
+    warm_up_in_background()
+
+# Identical /ask requests in flight at the same time share one generation
+ASK_FLIGHTS = SingleFlight("/ask")
+
+# Longest idempotency key accepted; longer ones are truncated
+IDEMPOTENCY_KEY_MAX_LENGTH = 200
+
+# Largest page of conversations or messages served at once; bigger limits are capped
+PAGE_SIZE_MAX = 200
+
+# Search results returned when no ?limit= is given
+SEARCH_RESULTS_DEFAULT = 20
+SEARCH_ROLES = ("user", "assistant")
+
+
+def _load_or_create_conversation(conversation_id, idempotency_key=None):
+    """
+    Load the requested conversation, creating a fresh one (and remembering it in
+    the session) when none was given or the requested one no longer exists.
+    A request with an idempotency key but no conversation starts the one
+    derived from its key, so its retries don't each start another.
+    Returns a (conversation_id, conversation) tuple.
+    """
+    # Create new conversation if none exists
+    if not conversation_id:
+        if idempotency_key:
+            conversation_id = ConversationManager.create_conversation(
+                _idempotent_conversation_id(idempotency_key)
+            )
+        else:
+            conversation_id = ConversationManager.create_conversation()
+        session["conversation_id"] = conversation_id
+
+    # Load conversation history
+    conversation = ConversationManager.load_conversation(conversation_id)
+    if not conversation:
+        # Conversation was deleted, create a new one
+        conversation_id = ConversationManager.create_conversation()
+        session["conversation_id"] = conversation_id
+        conversation = ConversationManager.load_conversation(conversation_id)
+        # Verify the second load succeeded
+        if not conversation:
+            raise AssistantError("Failed to create or load conversation. Please try again.")
+    return conversation_id, conversation
+
+
+def _conversation_history(conversation):
+    """
+    Return (summary, messages) for the next prompt: the stored summary of older
+    turns (or None) and the messages it doesn't cover as role/content pairs.
+    assistant_core trims the messages to the model's token budget.
+    """
+    summary, history = split_history(conversation)
+    return summary, [{"role": msg["role"], "content": msg["content"]} for msg in history]
+
+
+def _remember_context_cache(conversation_id, previous, metadata):
+    """Store the conversation's context cache record if the call changed it."""
+    record = metadata.get("context_cache", previous)
+    if (record or {}) == (previous or {}):
+        return
+    try:
+        ConversationManager.update_fields(conversation_id, {"context_cache": record})
+    except Exception as e:
+        logger.warning("Failed to store context cache record: %s", e)
+
+
+def _idempotency_key(header_value, data):
+    """The request's idempotency key, from the Idempotency-Key header or the JSON body."""
+    key = header_value or data.get("idempotency_key")
+    return str(key)[:IDEMPOTENCY_KEY_MAX_LENGTH] if key else None
+
+
+def _idempotent_conversation_id(idempotency_key):
+    """
+    The ID of the conversation started by a request with this idempotency key
+    and no conversation id: the same on every retry and every worker.
+    """
+    return str(uuid5(NAMESPACE_URL, f"idempotency:{app.secret_key}:{idempotency_key}"))
+
+
+def _idempotent_answer(conversation, idempotency_key):
+    """The stored answer to the user message carrying idempotency_key, or None."""
+    messages = conversation.get("messages", [])
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get("idempotency_key") == idempotency_key:
+            following = messages[index + 1:index + 2]
+            if following and following[0].get("role") == "assistant":
+                return following[0].get("content")
+            return None
+    return None
+
+
+def _ask_flight_key(conversation_id, conversation, prompt, temperature, max_tokens, idempotency_key):
+    """
+    Key under which concurrent /ask requests are coalesced: the idempotency
+    key when given, else the conversation state, prompt and settings.
+    """
+    if idempotency_key:
+        return json.dumps(["idempotency", conversation_id, idempotency_key])
+    messages = conversation.get("messages", [])
+    return json.dumps([
+        "ask", conversation_id, len(messages), conversation.get("updated_at"),
+        prompt, temperature, max_tokens,
+    ], default=str)
+
+
+def _exchange(prompt, answer, idempotency_key):
+    """The user/assistant message pair to persist for one /ask."""
+    user_message = {"role": "user", "content": prompt}
+    if idempotency_key:
+        user_message["idempotency_key"] = idempotency_key
+    return [user_message, {"role": "assistant", "content": answer}]
+
+
+def _without_idempotency_keys(conversation):
+    """A copy of the conversation for clients: idempotency keys stay server-side."""
+    messages = conversation.get("messages")
+    if not messages or not any("idempotency_key" in message for message in messages):
+        return conversation
+    return {**conversation, "messages": [
+        {k: v for k, v in message.items() if k != "idempotency_key"} for message in messages
+    ]}
+
+
+def _replayed_stream(conversation_id, answer):
+    """The SSE frames that replay a stored answer to a retried /ask/stream."""
+    return [
+        _sse("start", {"conversation_id": conversation_id}),
+        _sse("chunk", {"text": answer}),
+        _sse("done", {"conversation_id": conversation_id, "cached": True}),
+    ]
+
+
+def _retry_after_headers(error):
+    """Retry-After header for a BackendUnavailableError, if the backend gave a delay."""
+    if error.retry_after is None:
+        return {}
+    return {"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+
+
+def _sse(event, payload):
+    """Format a single Server-Sent Events frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _int_arg(name, minimum):
+    """Integer query parameter, None when absent; ValueError when malformed."""
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    number = int(value)
+    if number < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return number
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.trace = tracing.start(f"{request.method} {_route()}")
+
+
+@app.after_request
+def _record_request_metrics(response):
+    """
+    Count and time the request by route pattern (not raw path), add its
+    Server-Timing header and log its trace.
+    """
+    route = _route()
+    method = request.method
+    status = str(response.status_code)
+    started = g.get("request_started")
+    trace = g.get("trace")
+    if trace is not None:
+        # For streams this covers the spans recorded before the first byte
+        response.headers["Server-Timing"] = trace.server_timing()
+
+    def record():
+        metrics.HTTP_REQUESTS.inc(route=route, method=method, status=status)
+        if started is not None:
+            metrics.HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started, route=route, method=method
+            )
+        tracing.finish(trace, status=response.status_code)
+
+    # Streamed bodies are still being sent when this hook runs
+    response.call_on_close(record)
+    return response
+
 
 @app.route("/", methods=["GET"])
 def index():
@@ -37,44 +246,57 @@ def ask():
     logger.info("/ask received prompt length=%d, conversation_id=%s, temperature=%.2f, max_tokens=%d", 
                 len(prompt), conversation_id, temperature, max_tokens)
 
-    # Create new conversation if none exists
-    if not conversation_id:
-        conversation_id = ConversationManager.create_conversation()
-        session["conversation_id"] = conversation_id
-
+    timings = {}
     try:
-        # Load conversation history
-        conversation = ConversationManager.load_conversation(conversation_id)
-        if not conversation:
-            # Conversation was deleted, create a new one
-            conversation_id = ConversationManager.create_conversation()
-            session["conversation_id"] = conversation_id
-            conversation = ConversationManager.load_conversation(conversation_id)
-            # Verify the second load succeeded
-            if not conversation:
-                raise AssistantError("Failed to create or load conversation. Please try again.")
-        
-        # Get conversation history (last 20 messages to avoid token limits)
-        history = conversation.get("messages", [])[-20:]
-        conversation_history = [{"role": msg["role"], "content": msg["content"]} 
-                               for msg in history]
-        
-        # Get response from Gemini with configurable settings
-        answer = ask_gemini(
-            prompt, 
-            conversation_history=conversation_history,
-            temperature=temperature,
-            max_output_tokens=max_tokens
+        idempotency_key = _idempotency_key(request.headers.get("Idempotency-Key"), data)
+        with tracing.span("history_load", timings):
+            conversation_id, conversation = _load_or_create_conversation(
+                conversation_id, idempotency_key
+            )
+        if idempotency_key:
+            answer = _idempotent_answer(conversation, idempotency_key)
+            if answer is not None:
+                logger.info("/ask replaying stored answer for idempotency key")
+                return {"response": answer, "conversation_id": conversation_id, "cached": True}
+
+        def generate():
+            summary, conversation_history = _conversation_history(conversation)
+            context_cache = conversation.get("context_cache") or {}
+            # ask_gemini adds its prompt_assembly and gemini_call stages
+            metadata = {"timings": timings}
+
+            # Get response from Gemini with configurable settings
+            answer = ask_gemini(
+                prompt,
+                conversation_history=conversation_history,
+                temperature=temperature,
+                max_output_tokens=max_tokens,
+                history_summary=summary,
+                context_cache=context_cache,
+                metadata=metadata
+            )
+            with tracing.span("persistence", timings):
+                _remember_context_cache(conversation_id, context_cache, metadata)
+
+                # Save user message and assistant response in one write
+                schedule_summary(ConversationManager.add_messages(
+                    conversation_id, _exchange(prompt, answer, idempotency_key)
+                ))
+            return answer, metadata.get("cached", False)
+
+        key = _ask_flight_key(
+            conversation_id, conversation, prompt, temperature, max_tokens, idempotency_key
         )
-        
-        # Save user message and assistant response
-        ConversationManager.add_message(conversation_id, "user", prompt)
-        ConversationManager.add_message(conversation_id, "assistant", answer)
-        
+        (answer, cached), _ = ASK_FLIGHTS.do(key, generate)
+
         return {
             "response": answer,
-            "conversation_id": conversation_id
+            "conversation_id": conversation_id,
+            "cached": cached
         }
+    except BackendUnavailableError as e:
+        logger.warning("Gemini unavailable (%d): %s", e.status_code, e)
+        return {"error": str(e)}, e.status_code, _retry_after_headers(e)
     except AssistantError as e:
         logger.warning("AssistantError: %s", e)
         return {"error": str(e)}, 400
@@ -83,19 +305,180 @@ def ask():
         return {
             "error": "An unexpected error occurred while processing your request."
         }, 500
+    finally:
+        metrics.observe_stages("/ask", timings)
+
+
+@app.route("/ask/stream", methods=["POST"])
+def ask_stream():
+    """
+    Streaming variant of /ask. Emits Server-Sent Events: a "start" event with the
+    conversation id, one "chunk" event per text fragment, then "done" or "error".
+    The exchange is persisted once the stream ends, or with the partial answer if
+    the client disconnects mid-stream. A retry with the Idempotency-Key of a
+    completed stream replays its stored answer as a single chunk.
+    """
+    data = request.get_json(silent=True) or {}
+    prompt = data.get("prompt", "")
+    conversation_id = data.get("conversation_id") or session.get("conversation_id")
+    temperature = data.get("temperature", 0.7)
+    max_tokens = data.get("max_tokens", 2048)
+
+    logger.info("/ask/stream received prompt length=%d, conversation_id=%s", 
+                len(prompt), conversation_id)
+
+    timings = {}
+    try:
+        idempotency_key = _idempotency_key(request.headers.get("Idempotency-Key"), data)
+        with tracing.span("history_load", timings):
+            conversation_id, conversation = _load_or_create_conversation(
+                conversation_id, idempotency_key
+            )
+        answer = _idempotent_answer(conversation, idempotency_key) if idempotency_key else None
+        if answer is not None:
+            logger.info("/ask/stream replaying stored answer for idempotency key")
+            metrics.observe_stages("/ask/stream", timings)
+            return Response(
+                _replayed_stream(conversation_id, answer),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache"},
+            )
+        summary, conversation_history = _conversation_history(conversation)
+        context_cache = conversation.get("context_cache") or {}
+        metadata = {"timings": timings}
+        chunks = ask_gemini_stream(
+            prompt,
+            conversation_history=conversation_history,
+            temperature=temperature,
+            max_output_tokens=max_tokens,
+            history_summary=summary,
+            context_cache=context_cache,
+            metadata=metadata
+        )
+    except BackendUnavailableError as e:
+        # Raised before the first chunk (admission included), so it still
+        # gets a status code and Retry-After instead of an SSE error event
+        logger.warning("Gemini unavailable (%d): %s", e.status_code, e)
+        metrics.observe_stages("/ask/stream", timings)
+        return {"error": str(e)}, e.status_code, _retry_after_headers(e)
+    except AssistantError as e:
+        logger.warning("AssistantError: %s", e)
+        metrics.observe_stages("/ask/stream", timings)
+        return {"error": str(e)}, 400
+    except Exception as e:
+        logger.exception("Unhandled exception in /ask/stream: %s", e)
+        metrics.observe_stages("/ask/stream", timings)
+        return {
+            "error": "An unexpected error occurred while processing your request."
+        }, 500
+
+    def generate():
+        parts = []
+        persist = completed = False
+        try:
+            yield _sse("start", {"conversation_id": conversation_id})
+            for chunk in chunks:
+                parts.append(chunk)
+                yield _sse("chunk", {"text": chunk})
+            persist = completed = True
+            yield _sse("done", {
+                "conversation_id": conversation_id,
+                "cached": metadata.get("cached", False)
+            })
+        except GeneratorExit:
+            # Client went away; keep whatever was already generated.
+            logger.info("/ask/stream client disconnected after %d chunks", len(parts))
+            persist = bool(parts)
+            raise
+        except AssistantError as e:
+            logger.warning("AssistantError during stream: %s", e)
+            yield _sse("error", {"error": str(e)})
+        except Exception as e:
+            logger.exception("Unhandled exception in /ask/stream: %s", e)
+            yield _sse("error", {
+                "error": "An unexpected error occurred while processing your request."
+            })
+        finally:
+            if persist:
+                with tracing.span("persistence", timings):
+                    _remember_context_cache(conversation_id, context_cache, metadata)
+                    # Only a complete answer is replayed to retries
+                    key = idempotency_key if completed else None
+                    try:
+                        schedule_summary(ConversationManager.add_messages(
+                            conversation_id, _exchange(prompt, "".join(parts), key)
+                        ))
+                    except Exception as e:
+                        logger.exception("Failed to persist streamed exchange: %s", e)
+            metrics.observe_stages("/ask/stream", timings)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def export_metrics():
+    """Service metrics in the Prometheus text exposition format."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 @app.route("/conversations", methods=["GET"])
 def list_conversations():
-    """List all conversations."""
+    """
+    List conversations, newest first. With ?limit=N one page is returned,
+    plus a next_cursor to pass as ?cursor= for the following page (null on
+    the last page); without it every conversation is listed.
+    """
+    try:
+        limit = _int_arg("limit", minimum=1)
+    except ValueError as e:
+        return {"error": f"Invalid limit: {e}"}, 400
+    cursor = request.args.get("cursor") or None
     try:
-        conversations = ConversationManager.list_conversations()
-        return jsonify({"conversations": conversations})
+        if limit is None and cursor is None:
+            return jsonify({"conversations": ConversationManager.list_conversations()})
+        conversations, next_cursor = ConversationManager.list_conversations_page(
+            min(limit or PAGE_SIZE_MAX, PAGE_SIZE_MAX), cursor
+        )
+        return jsonify({"conversations": conversations, "next_cursor": next_cursor})
+    except ValueError as e:
+        return {"error": str(e)}, 400
     except Exception as e:
         logger.exception("Error listing conversations: %s", e)
         return {"error": "Failed to list conversations"}, 500
 
 
+@app.route("/conversations/search", methods=["GET"])
+def search_conversations():
+    """
+    Full-text search: ?q= words and "quoted phrases" (word* for a prefix),
+    optionally ?role=user|assistant and ?limit=. Results are conversations,
+    best match first, each with the index, role and an HTML snippet
+    (matches in <mark>) of its best-matching message.
+    """
+    query = request.args.get("q", "").strip()
+    if not query:
+        return {"error": "Query parameter q is required"}, 400
+    role = request.args.get("role") or None
+    if role is not None and role not in SEARCH_ROLES:
+        return {"error": f"Invalid role: must be one of {', '.join(SEARCH_ROLES)}"}, 400
+    try:
+        limit = _int_arg("limit", minimum=1)
+    except ValueError as e:
+        return {"error": f"Invalid limit: {e}"}, 400
+    try:
+        hits = ConversationManager.search_conversations(
+            query, min(limit or SEARCH_RESULTS_DEFAULT, PAGE_SIZE_MAX), role
+        )
+        return jsonify({"query": query, "results": [hit._asdict() for hit in hits]})
+    except Exception as e:
+        logger.exception("Error searching conversations: %s", e)
+        return {"error": "Failed to search conversations"}, 500
+
+
 @app.route("/conversations/new", methods=["POST"])
 def new_conversation():
     """Create a new conversation."""
@@ -113,12 +496,26 @@ def new_conversation():
 
 @app.route("/conversations/<conversation_id>", methods=["GET"])
 def get_conversation(conversation_id):
-    """Get a specific conversation."""
+    """
+    Get a specific conversation. With ?limit=N only the newest N messages are
+    returned (or the N before index ?before=), along with message_count and
+    messages_start, the index of the first message returned.
+    """
     try:
-        conversation = ConversationManager.load_conversation(conversation_id)
+        limit = _int_arg("limit", minimum=1)
+        before = _int_arg("before", minimum=0)
+    except ValueError as e:
+        return {"error": f"Invalid paging parameter: {e}"}, 400
+    try:
+        if limit is None and before is None:
+            conversation = ConversationManager.load_conversation(conversation_id)
+        else:
+            conversation = ConversationManager.load_messages(
+                conversation_id, before, min(limit or PAGE_SIZE_MAX, PAGE_SIZE_MAX)
+            )
         if not conversation:
             return {"error": "Conversation not found"}, 404
-        return jsonify(conversation)
+        return jsonify(_without_idempotency_keys(conversation))
     except Exception as e:
         logger.exception("Error getting conversation: %s", e)
         return {"error": "Failed to get conversation"}, 500